@@ -15,7 +15,6 @@ from typing import Callable, Any, Union
 
 from wikichat.commands import model
 from wikichat.utils.metrics import METRICS
-from wikichat.database_setup import ASTRA_DB, EMBEDDINGS_COLLECTION, METADATA_COLLECTION, SUGGESTIONS_COLLECTION
 
 # ======================================================================================================================
 # Model
@@ -56,30 +55,87 @@ class CliCommand:
 class PipelineCommand(CliCommand):
 
     async def _run_func(self, command_func: Callable, command_args: model.CommonPipelineArgs):
-        from wikichat.utils.pipeline import AsyncPipeline
-        from wikichat import processing
         from wikichat import database
 
+        if command_args.processes > 1:
+            from wikichat.cli import shards
+            # before anything is truncated, so a command that cannot run does not delete the collections
+            shards.check_sharded_args(command_args)
+
         if command_args.truncate_first:
             await database.truncate_all_collections()
 
-        pipeline: AsyncPipeline = processing.create_pipeline(max_items=command_args.max_articles,
-                                                             rotate_collection_every=command_args.rotate_collections_every)
-        metrics_task = asyncio.create_task(METRICS.metrics_reporter_task(pipeline))
-
-        logging.info("Starting...")
-        await command_func(pipeline, command_args)
-
-        await pipeline.join_all_steps()
-        await pipeline.cancel_and_gather()
-
-        metrics_task.cancel()
-        try:
-            logging.debug("Waiting for metrics task to finish")
-            await metrics_task
-        except asyncio.CancelledError:
-            logging.debug("Metrics task cancelled")
-        return
+        if command_args.processes > 1:
+            return await shards.run_sharded(command_func, command_args)
+        return await run_pipeline(lambda pipeline: command_func(pipeline, command_args), command_args,
+                                  collection_empty=command_args.truncate_first)
+
+
+async def run_pipeline(feed: Callable, command_args: model.CommonPipelineArgs, collection_empty: bool = False):
+    """Create the pipeline, call feed with it to put articles into it, and wait for them all to be processed."""
+    from wikichat.utils.pipeline import AsyncPipeline
+    from wikichat.utils.metrics_server import MetricsServer
+    from wikichat.utils.tracing import TRACER
+    from wikichat.utils.profiling import PROFILER
+    from wikichat import processing
+    from wikichat.processing import embeddings
+
+    await processing.load_stored_chunks(capacity=command_args.chunk_filter_capacity,
+                                        error_rate=command_args.chunk_filter_error_rate,
+                                        file=command_args.chunk_filter_file,
+                                        collection_empty=collection_empty)
+
+    pipeline: AsyncPipeline = processing.create_pipeline(
+        max_items=command_args.max_articles,
+        rotate_collection_every=command_args.rotate_collections_every,
+        near_duplicates=command_args.near_duplicates,
+        near_duplicate_threshold=command_args.near_duplicate_threshold,
+        near_duplicate_min_chars=command_args.near_duplicate_min_chars,
+        near_duplicate_max_chunks=command_args.near_duplicate_max_chunks,
+        embedding_batch_size=command_args.embedding_batch_size,
+        embedding_linger_ms=command_args.embedding_linger_ms,
+        embedding_max_requests=command_args.embedding_max_requests,
+        embedding_provider=command_args.embedding_provider,
+        embedding_provider_options=command_args.local_provider_options(),
+        live_weight=command_args.live_weight,
+        bulk_weight=command_args.bulk_weight,
+        shed_queue_depth=command_args.shed_queue_depth,
+        shed_lag_secs=command_args.shed_lag_secs,
+        spill_file=command_args.spill_file,
+        checkpoint_file=command_args.checkpoint_file,
+        checkpoint_steps=[step.strip() for step in command_args.checkpoint_steps.split(",") if step.strip()],
+        retry_max_retries=command_args.retry_max_retries,
+        retry_base_delay_secs=command_args.retry_base_delay_secs,
+        retry_max_delay_secs=command_args.retry_max_delay_secs,
+        retry_rules_json=command_args.retry_rules_json,
+        dead_letter_file=command_args.dead_letter_file,
+        trace_file=command_args.trace_file,
+        trace_sample_rate=command_args.trace_sample_rate)
+    await processing.load_near_duplicates(collection_empty=collection_empty)
+    metrics_task = asyncio.create_task(METRICS.metrics_reporter_task(pipeline))
+    metrics_server = await MetricsServer(pipeline, command_args.metrics_host, command_args.metrics_port).start() \
+        if command_args.metrics_port else None
+    await PROFILER.configure(**command_args.profiler_options()).start()
+
+    logging.info("Starting...")
+    await feed(pipeline)
+
+    await pipeline.join_all_steps()
+    await pipeline.cancel_and_gather()
+    TRACER.close()
+    await processing.save_stored_chunks()
+    await embeddings.close_client()
+    await PROFILER.stop()
+    if metrics_server is not None:
+        await metrics_server.stop()
+
+    metrics_task.cancel()
+    try:
+        logging.debug("Waiting for metrics task to finish")
+        await metrics_task
+    except asyncio.CancelledError:
+        logging.debug("Metrics task cancelled")
+    return
 
 # ======================================================================================================================
 # Delayed loading of the command functions to avoid circular imports
@@ -100,6 +156,26 @@ def _load_and_listen() -> Callable:
     return pipeline.load_and_listen
 
 
+def _replay_dead_letters() -> Callable:
+    from wikichat.commands import pipeline
+    return pipeline.replay_dead_letters
+
+
+def _replay_changes() -> Callable:
+    from wikichat.commands import pipeline
+    return pipeline.replay_changes
+
+
+def _record_changes() -> Callable:
+    from wikichat.commands import recording
+    return recording.record_changes
+
+
+def _trace_report() -> Callable:
+    from wikichat.commands import tracing
+    return tracing.trace_report
+
+
 def _embed_and_search() -> Callable:
     from wikichat.commands import database
     return database.embed_and_search
@@ -112,6 +188,38 @@ def _suggested_search() -> Callable:
     from wikichat.commands import database
     return database.suggested_search
 
+def _gc_chunks() -> Callable:
+    from wikichat.commands import maintenance
+    return maintenance.gc_chunks
+
+def _snapshot() -> Callable:
+    from wikichat.commands import snapshot
+    return snapshot.snapshot
+
+def _restore() -> Callable:
+    from wikichat.commands import snapshot
+    return snapshot.restore
+
+def _splitter_bench() -> Callable:
+    from wikichat.commands import benchmark
+    return benchmark.splitter_bench
+
+def _stage_bench() -> Callable:
+    from wikichat.commands import benchmark
+    return benchmark.stage_bench
+
+def _quantization_bench() -> Callable:
+    from wikichat.commands import benchmark
+    return benchmark.quantization_bench
+
+def _search_bench() -> Callable:
+    from wikichat.commands import benchmark
+    return benchmark.search_bench
+
+def _ingest_bench() -> Callable:
+    from wikichat.commands import ingest_bench
+    return ingest_bench.ingest_bench
+
 # ======================================================================================================================
 # The commands we want to make available on the command line, an object for each command,
 # and the functions to configure the argparse
@@ -136,6 +244,28 @@ ALL_COMMANDS: list[CliCommand] = [
         func_supplier=_load_and_listen,
         args_cls=model.LoadPipelineArgs
     ),
+    PipelineCommand(
+        name="replay-dead-letters",
+        help='Put the articles that ran out of retries back into the pipeline step they failed in',
+        func_supplier=_replay_dead_letters,
+        args_cls=model.ReplayDeadLettersArgs
+    ),
+    PipelineCommand(
+        name="replay-changes",
+        help='Replay a recording of the recent changes stream through the listener, at the recorded speed or faster',
+        func_supplier=_replay_changes,
+        args_cls=model.ReplayChangesArgs
+    ),
+    CliCommand(
+        name="record",
+        help="Record the recent changes stream to rotating gzipped JSON lines files, to replay with replay-changes",
+        func_supplier=_record_changes,
+        args_cls=model.RecordChangesArgs),
+    CliCommand(
+        name="trace-report",
+        help="Summarise the traces written with --trace_file by stage, for the critical path and the slowest items",
+        func_supplier=_trace_report,
+        args_cls=model.TraceReportArgs),
     CliCommand(
         name="embed-and-search",
         help="Embed a question and search the database for similar articles",
@@ -150,7 +280,47 @@ ALL_COMMANDS: list[CliCommand] = [
         name="suggested-search",
         help="Run ANN search based on suggested articles in DB",
         func_supplier=_suggested_search,
-        args_cls=model.SuggestedSearchArgs)
+        args_cls=model.SuggestedSearchArgs),
+    CliCommand(
+        name="gc-chunks",
+        help="Delete chunks that are not in the metadata of any article",
+        func_supplier=_gc_chunks,
+        args_cls=model.GcChunksArgs),
+    CliCommand(
+        name="snapshot",
+        help="Write the chunks and article metadata in the database to a local snapshot",
+        func_supplier=_snapshot,
+        args_cls=model.SnapshotArgs),
+    CliCommand(
+        name="restore",
+        help="Load a local snapshot into the database, without scraping or embedding",
+        func_supplier=_restore,
+        args_cls=model.RestoreArgs),
+    CliCommand(
+        name="splitter-bench",
+        help="Benchmark splitting and hashing article text into chunks",
+        func_supplier=_splitter_bench,
+        args_cls=model.SplitterBenchArgs),
+    CliCommand(
+        name="stage-bench",
+        help="Benchmark the CPU heavy part of each pipeline stage, and fail if a stage is slower than a baseline",
+        func_supplier=_stage_bench,
+        args_cls=model.StageBenchArgs),
+    CliCommand(
+        name="quantization-bench",
+        help="Measure memory and recall of quantized local copies of the stored chunk vectors",
+        func_supplier=_quantization_bench,
+        args_cls=model.QuantizationBenchArgs),
+    CliCommand(
+        name="search-bench",
+        help="Measure the latency and throughput of concurrent embedding and ANN searches",
+        func_supplier=_search_bench,
+        args_cls=model.SearchBenchArgs),
+    CliCommand(
+        name="ingest-bench",
+        help="Measure the throughput of loading and listening, using local stand-ins for Wikipedia, Cohere and Astra",
+        func_supplier=_ingest_bench,
+        args_cls=model.IngestBenchArgs)
 ]
 
 
@@ -164,15 +334,33 @@ def _add_command_args(args_cls, parser: ArgumentParser) -> ArgumentParser:
 
         if arg_field.default_factory is not MISSING or arg_field.default is not MISSING:
             default = arg_field.default_factory if arg_field.default_factory is not MISSING else arg_field.default
-            parser.add_argument(f"--{arg_field.name}", type=arg_field.type, required=False,
-                                default=default,
-                                help=arg_field.metadata.get("help", ""))
+            if arg_field.metadata.get("positional"):
+                # optional positional argument
+                parser.add_argument(arg_field.name, type=_arg_type(arg_field.type), nargs="?", default=default,
+                                    help=arg_field.metadata.get("help", ""))
+            else:
+                parser.add_argument(f"--{arg_field.name}", type=_arg_type(arg_field.type), required=False,
+                                    default=default,
+                                    help=arg_field.metadata.get("help", ""))
         else:
-            parser.add_argument(arg_field.name, type=arg_field.type,
+            parser.add_argument(arg_field.name, type=_arg_type(arg_field.type),
                                 help=arg_field.metadata.get("help", ""))
     return parser
 
 
+def _arg_type(field_type):
+    # bool("False") is True, so flags such as --truncate_first False need their own conversion
+    return _str_to_bool if field_type is bool else field_type
+
+
+def _str_to_bool(value: str) -> bool:
+    if value.lower() in ("true", "yes", "1"):
+        return True
+    if value.lower() in ("false", "no", "0"):
+        return False
+    raise argparse.ArgumentTypeError(f"Expected true or false, got {value}")
+
+
 def config_arg_parse():
     # Create the top-level parser
     parser = ArgumentParser(description="This script loads data from wikipedia and listens for changes.",
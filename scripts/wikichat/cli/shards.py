@@ -0,0 +1,180 @@
+"""
+Runs a pipeline command in several worker processes, so parsing, chunking and encoding are not limited to one core.
+
+Each worker process runs its own pipeline with its own clients, see :func:`wikichat.cli.run_pipeline`. This process
+runs the command as normal, reading the file or listening for changes, but with a :class:`ShardedPipeline` that sends
+each article to a worker over a multiprocessing queue. Articles are assigned to a worker by hashing their url, so
+all changes to an article are processed by the same worker in the order they were received, and the workers do not
+need to share any state.
+
+The workers log through this process, and each reports its own metrics. If metrics_port is set this process serves
+the listener metrics on it, and each worker serves its own on the ports after it.
+"""
+import asyncio
+import dataclasses
+import logging
+import multiprocessing
+import zlib
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Callable
+
+from wikichat.commands import model
+from wikichat.utils import wrap_blocking_io
+from wikichat.utils.metrics import METRICS
+from wikichat.utils.metrics_server import MetricsServer
+from wikichat.utils.pipeline import Priority, WORKER_NAME_CONTEXT_VAR
+from wikichat.utils.profiling import PROFILER
+
+# Workers are started with spawn, forking a process that has a running event loop and threads is not safe
+_MP_CONTEXT = multiprocessing.get_context("spawn")
+
+
+def shard_for_url(url: str, num_shards: int) -> int:
+    """Worker for the url, stable across processes and runs unlike hash()"""
+    return zlib.crc32(url.encode('utf-8')) % num_shards
+
+
+def shard_file(path: str, shard: int) -> str:
+    """Each worker keeps its own copy of files such as the chunk filter"""
+    return f"{path}.shard-{shard}" if path else path
+
+
+class ShardedPipeline:
+    """Used in place of an :class:`~wikichat.utils.pipeline.AsyncPipeline` to send articles to the worker processes"""
+
+    def __init__(self, queues: list, processes: list, max_items: int = 0):
+        self._queues = queues
+        self._processes = processes
+        self.max_items: int = max_items
+        self._put_count: int = 0
+        self.shard_counts: list[int] = [0] * len(queues)
+
+    async def put_to_first_step(self, item: Any, priority: Priority = Priority.LIVE) -> bool:
+        if self.max_items and self._put_count >= self.max_items:
+            return False
+
+        shard = shard_for_url(item.url, len(self._queues))
+        if not self._processes[shard].is_alive():
+            raise RuntimeError(f"Pipeline worker process shard-{shard} has stopped, "
+                               f"exit code {self._processes[shard].exitcode}")
+        # the queues are not bounded so this does not block, the workers shed bulk articles when they are busy
+        self._queues[shard].put((priority, item))
+        self._put_count += 1
+        self.shard_counts[shard] += 1
+        return True
+
+    def close(self) -> None:
+        """Tell the workers there are no more articles, they stop once they have processed the ones they have"""
+        for queue in self._queues:
+            queue.put(None)
+
+
+class _ForwardToLogger(logging.Handler):
+    """Handles the records from the workers with the logger they were logged to, so they go to the same files"""
+
+    def emit(self, record: logging.LogRecord) -> None:
+        logging.getLogger(record.name).handle(record)
+
+
+class _ShardWorkerName(logging.Filter):
+
+    def __init__(self, shard: int):
+        super().__init__()
+        self._shard = shard
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.worker_name = f"shard-{self._shard}/{WORKER_NAME_CONTEXT_VAR.get()}"
+        return True
+
+
+def check_sharded_args(command_args: model.CommonPipelineArgs) -> None:
+    """Raise ValueError if the command cannot be run with more than one process"""
+    if command_args.rotate_collections_every > 0:
+        # a rotation truncates the collections every worker is writing to, deleting chunks the others just inserted
+        raise ValueError("Rotating the collections is not supported with --processes > 1, pass "
+                         "--rotate_collections_every 0")
+
+
+async def run_sharded(command_func: Callable, command_args: model.CommonPipelineArgs) -> None:
+    check_sharded_args(command_args)
+    num_shards = command_args.processes
+    log_queue = _MP_CONTEXT.Queue()
+    log_listener = QueueListener(log_queue, _ForwardToLogger())
+    log_listener.start()
+
+    queues = [_MP_CONTEXT.Queue() for _ in range(num_shards)]
+    processes = [
+        _MP_CONTEXT.Process(target=_shard_main, name=f"shard-{shard}",
+                            args=(shard, command_args, queues[shard], log_queue, logging.getLogger().level))
+        for shard in range(num_shards)
+    ]
+    for process in processes:
+        process.start()
+    logging.info(f"Started {num_shards} pipeline worker processes")
+
+    pipeline = ShardedPipeline(queues, processes, max_items=command_args.max_articles)
+    # the listener metrics are counted in this process
+    metrics_task = asyncio.create_task(METRICS.metrics_reporter_task(None))
+    metrics_server = await MetricsServer(None, command_args.metrics_host, command_args.metrics_port).start() \
+        if command_args.metrics_port else None
+    # this process runs the listener, each worker profiles its own pipeline
+    await PROFILER.configure(**command_args.profiler_options()).start()
+    try:
+        await command_func(pipeline, command_args)
+    finally:
+        pipeline.close()
+        logging.info(f"Waiting for the pipeline worker processes to finish, articles sent to each "
+                     f"{pipeline.shard_counts}")
+        for process in processes:
+            await wrap_blocking_io(process.join)
+        metrics_task.cancel()
+        try:
+            await metrics_task
+        except asyncio.CancelledError:
+            pass
+        await PROFILER.stop()
+        if metrics_server is not None:
+            await metrics_server.stop()
+        log_listener.stop()
+
+    failed = [process.name for process in processes if process.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"Pipeline worker processes {failed} failed")
+
+
+def _shard_main(shard: int, command_args: model.CommonPipelineArgs, queue, log_queue, log_level: int) -> None:
+    """Entry point of a worker process"""
+    log_handler = QueueHandler(log_queue)
+    log_handler.addFilter(_ShardWorkerName(shard))
+    root_logger = logging.getLogger()
+    root_logger.handlers = [log_handler]
+    root_logger.setLevel(log_level)
+
+    asyncio.run(_run_shard(shard, command_args, queue))
+
+
+async def _run_shard(shard: int, command_args: model.CommonPipelineArgs, queue) -> None:
+    from wikichat import cli
+
+    shard_args = dataclasses.replace(
+        command_args,
+        processes=1,
+        # the process sending the articles applies the limit
+        max_articles=0,
+        chunk_filter_file=shard_file(command_args.chunk_filter_file, shard),
+        spill_file=shard_file(command_args.spill_file, shard),
+        checkpoint_file=shard_file(command_args.checkpoint_file, shard),
+        dead_letter_file=shard_file(command_args.dead_letter_file, shard),
+        trace_file=shard_file(command_args.trace_file, shard),
+        metrics_port=command_args.metrics_port + 1 + shard if command_args.metrics_port else 0)
+
+    async def _feed(pipeline) -> None:
+        while True:
+            message = await wrap_blocking_io(queue.get)
+            if message is None:
+                return
+            priority, item = message
+            await pipeline.put_to_first_step(item, priority)
+
+    logging.info(f"Pipeline worker process shard-{shard} starting")
+    await cli.run_pipeline(_feed, shard_args, collection_empty=command_args.truncate_first)
@@ -0,0 +1,499 @@
+"""
+Benchmarks for the CPU heavy parts of the pipeline, the local copies of vectors we keep, and searching the database.
+
+Only search-bench calls Cohere, it can use the local embedding provider instead. These are not used by the wikichat
+application.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import random
+import sys
+import time
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from wikichat.commands.database import question_for_article, configure_search, search_chunks
+from wikichat.commands.model import SplitterBenchArgs, StageBenchArgs, QuantizationBenchArgs, SearchBenchArgs
+from wikichat.database import EMBEDDINGS_COLLECTION, SUGGESTIONS_COLLECTION
+from wikichat.processing import embeddings
+from wikichat.processing.articles import chunk_article, diff_chunks, zero_vector_rows, vectored_diff
+from wikichat.processing.model import RecentArticles, ArticleMetadata, ChunkedArticleMetadataOnly, EmbeddingDocument
+from wikichat.processing.quantization import LocalVectorIndex, Quantization, recall_at_k
+from wikichat.processing.splitter import TextSplitter
+from wikichat.processing.wikipedia import parse_article
+from wikichat.utils import wrap_blocking_io
+from wikichat.utils.metrics import METRICS
+
+# Same configuration as the pipeline, see wikichat.processing.articles.TEXT_SPLITTER
+_CHUNK_SIZE = 1024
+_CHUNK_OVERLAP = 200
+
+STAGES = ["scrape_article", "chunk_article", "calc_chunk_diff", "vectorize_diff", "embedding_document"]
+# vectors are not compared by the stages, random ones the size of the Cohere embeddings are enough
+_VECTOR_DIMENSION = 1024
+# a stage that is only this much slower than the baseline is timer noise, even if it is a large fraction
+_MIN_REGRESSION_MS = 0.5
+
+
+# ======================================================================================================================
+# Commands
+# ======================================================================================================================
+
+async def splitter_bench(args: SplitterBenchArgs) -> None:
+    if args.file:
+        with open(args.file, mode='r') as file:
+            articles: list[str] = [line.strip() for line in file if line.strip()]
+    else:
+        articles = [generate_article(int(size)) for size in args.article_chars.split(",") if size.strip()]
+
+    splitter = TextSplitter(chunk_size=_CHUNK_SIZE, chunk_overlap=_CHUNK_OVERLAP)
+    langchain_splitter = _maybe_langchain_splitter()
+
+    print(f"Splitter benchmark chunk_size={_CHUNK_SIZE} chunk_overlap={_CHUNK_OVERLAP} repeats={args.repeats}")
+    print(f"{'chars':>10} {'chunks':>7} {'split (ms)':>11} {'hash (ms)':>10} {'MB/s':>8} {'chunks/s':>10} "
+          f"{'langchain (ms)':>15} {'speedup':>8}")
+    for article in articles:
+        split_secs = _best_of(args.repeats, lambda: splitter.split_text(article))
+        hash_secs = _best_of(args.repeats, lambda: splitter.split_and_hash(article))
+        chunks = splitter.split_text(article)
+
+        langchain_desc = f"{'-':>15} {'-':>8}"
+        if langchain_splitter:
+            if langchain_splitter.split_text(article) != chunks:
+                raise ValueError(f"Splitter output differs from langchain for article of {len(article)} chars")
+            langchain_secs = _best_of(args.repeats, lambda: langchain_splitter.split_text(article))
+            langchain_desc = f"{langchain_secs * 1000:>15.2f} {langchain_secs / split_secs:>7.1f}x"
+
+        print(f"{len(article):>10} {len(chunks):>7} {split_secs * 1000:>11.2f} {hash_secs * 1000:>10.2f} "
+              f"{len(article) / hash_secs / 1024 / 1024:>8.1f} {len(chunks) / hash_secs:>10.0f} {langchain_desc}")
+
+
+async def stage_bench(args: StageBenchArgs) -> None:
+    stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()] or STAGES
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise ValueError(f"Unknown stages {sorted(unknown)}, expected some of {STAGES}")
+
+    results: list[dict] = []
+    for size in [int(size) for size in args.article_chars.split(",") if size.strip()]:
+        logging.info(f"Timing the stages for an article of {size} chars with {args.revisions} revisions")
+        results.extend(await _time_stages(size, stages, args))
+
+    report = {
+        "python": sys.version.split()[0],
+        "repeats": args.repeats,
+        "revisions": args.revisions,
+        "edit_fraction": args.edit_fraction,
+        "stages": results
+    }
+    baseline = None
+    if args.baseline_file:
+        with open(args.baseline_file, mode='r') as file:
+            baseline = json.load(file)
+        report["regressions"] = stage_regressions(results, baseline["stages"], args.max_regression)
+
+    print(_describe_stage_report(report, baseline))
+    if args.json_file:
+        with open(args.json_file, mode='w') as file:
+            json.dump(report, file, indent=2)
+        logging.info(f"Wrote JSON report to {args.json_file}")
+    else:
+        print(json.dumps(report, indent=2))
+
+    if report.get("regressions"):
+        logging.error(f"{len(report['regressions'])} stages are more than {args.max_regression:.0%} slower than the "
+                      f"baseline {args.baseline_file}")
+        sys.exit(1)
+
+
+def stage_regressions(results: list[dict], baseline: list[dict], max_regression: float) -> list[dict]:
+    """The stages slower than the same stage and article size in the baseline by more than max_regression"""
+    baseline_ms = {(result["stage"], result["article_chars"]): result["best_ms"] for result in baseline}
+    regressions: list[dict] = []
+    for result in results:
+        previous = baseline_ms.get((result["stage"], result["article_chars"]))
+        if not previous:
+            continue
+        if result["best_ms"] > previous * (1 + max_regression) and result["best_ms"] - previous > _MIN_REGRESSION_MS:
+            regressions.append({"stage": result["stage"], "article_chars": result["article_chars"],
+                                "baseline_ms": previous, "best_ms": result["best_ms"]})
+    return regressions
+
+
+async def quantization_bench(args: QuantizationBenchArgs) -> None:
+    logging.info(f"Reading {args.sample + args.queries} stored chunk vectors")
+    docs = await wrap_blocking_io(
+        lambda: list(itertools.islice(
+            EMBEDDINGS_COLLECTION.paginated_find(projection={"_id": 1, "$vector": 1}),
+            args.sample + args.queries))
+    )
+    if len(docs) <= args.queries:
+        raise ValueError(f"Only found {len(docs)} stored chunks, need more than {args.queries} to hold out as queries")
+
+    # the held out queries are not in the index, so this is like searching for a question
+    ids: list[str] = [doc["_id"] for doc in docs[:-args.queries]]
+    vectors = np.asarray([doc["$vector"] for doc in docs[:-args.queries]], dtype=np.float32)
+    queries = np.asarray([doc["$vector"] for doc in docs[-args.queries:]], dtype=np.float32)
+
+    expected: list[list[str]] = []
+    print(f"Quantization benchmark vectors={len(ids)} dimension={vectors.shape[1]} queries={len(queries)} k={args.k} "
+          f"rescore_factor={args.rescore_factor}")
+    print(f"{'quantization':>12} {'bytes/vector':>13} {'MB':>8} {'smaller':>8} {'recall@k':>9} {'search (ms)':>12}")
+    for quantization in Quantization:
+        index = LocalVectorIndex(quantization, rescore_factor=args.rescore_factor)
+        index.add(ids, vectors)
+
+        start = time.perf_counter()
+        actual = [[doc_id for doc_id, _ in index.search(query, args.k)] for query in queries]
+        search_secs = (time.perf_counter() - start) / len(queries)
+        if quantization == Quantization.NONE:
+            expected = actual
+
+        print(f"{quantization.value:>12} {index.nbytes // len(index):>13} {index.nbytes / 1024 / 1024:>8.1f} "
+              f"{vectors.nbytes / index.nbytes:>7.1f}x {recall_at_k(expected, actual, args.k):>9.3f} "
+              f"{search_secs * 1000:>12.2f}")
+
+
+async def search_bench(args: SearchBenchArgs) -> None:
+    configure_search(args)
+    queries = await _load_search_queries(args.query_file)
+    if not queries:
+        raise ValueError("No queries to search with, give a query file or load some articles first")
+    search_filter = json.loads(args.filter_json) if args.filter_json else {}
+    logging.info(f"Running {args.requests} searches using {len(queries)} queries with "
+                 f"{f'rate={args.rate}/s' if args.rate else f'concurrency={args.concurrency}'} limit={args.limit} "
+                 f"filter={search_filter}")
+
+    samples: list[SearchSample] = []
+    query_iter = itertools.islice(itertools.cycle(queries), args.requests)
+
+    async def _search(query: str) -> None:
+        samples.append(await _timed_search(query, args.limit, search_filter))
+
+    start = time.perf_counter()
+    if args.rate:
+        # open loop, a new search starts on schedule even if the earlier ones are slow, like chat traffic
+        tasks: list[asyncio.Task] = []
+        for i, query in enumerate(query_iter):
+            await asyncio.sleep(max(0.0, start + i / args.rate - time.perf_counter()))
+            tasks.append(asyncio.create_task(_search(query)))
+        await asyncio.gather(*tasks)
+    else:
+        async def _worker() -> None:
+            for query in query_iter:
+                await _search(query)
+
+        await asyncio.gather(*[_worker() for _ in range(max(args.concurrency, 1))])
+    elapsed_secs = time.perf_counter() - start
+    await embeddings.close_client()
+
+    report = search_bench_report(samples, elapsed_secs, args)
+    print(_describe_search_report(report))
+    if args.json_file:
+        with open(args.json_file, mode='w') as file:
+            json.dump(report, file, indent=2)
+        logging.info(f"Wrote JSON report to {args.json_file}")
+    else:
+        print(json.dumps(report, indent=2))
+
+
+@dataclass
+class SearchSample:
+    """Timing of one search, the search phase is not run if the embed phase failed"""
+    embed_secs: float = 0.0
+    search_secs: float = 0.0
+    error_phase: str = ""
+    error: str = ""
+    total_secs: float = field(init=False, default=0.0)
+
+    def __post_init__(self):
+        self.total_secs = self.embed_secs + self.search_secs
+
+
+def search_bench_report(samples: list[SearchSample], elapsed_secs: float, args: SearchBenchArgs) -> dict:
+    """Latency percentiles in milliseconds for each phase of the successful searches, and the errors"""
+    ok = [sample for sample in samples if not sample.error_phase]
+    errors: dict[str, dict[str, int]] = {}
+    for sample in samples:
+        if sample.error_phase:
+            phase_errors = errors.setdefault(sample.error_phase, {})
+            phase_errors[sample.error] = phase_errors.get(sample.error, 0) + 1
+
+    return {
+        "requests": len(samples),
+        "succeeded": len(ok),
+        "failed": len(samples) - len(ok),
+        "elapsed_secs": round(elapsed_secs, 3),
+        "throughput_per_sec": round(len(ok) / elapsed_secs, 2) if elapsed_secs else 0.0,
+        "concurrency": 0 if args.rate else args.concurrency,
+        "rate": args.rate,
+        "limit": args.limit,
+        "embedding_provider": args.embedding_provider,
+        "latency_ms": {
+            "embed": _latency_percentiles([sample.embed_secs for sample in ok]),
+            "search": _latency_percentiles([sample.search_secs for sample in ok]),
+            "total": _latency_percentiles([sample.total_secs for sample in ok]),
+        },
+        "query_cache": METRICS.query_cache_summary() if args.query_cache_size else None,
+        "search_cache": METRICS.search_cache_summary() if args.search_cache_size else None,
+        "errors": errors
+    }
+
+
+# ======================================================================================================================
+# Helpers
+# ======================================================================================================================
+
+def generate_article(num_chars: int, seed: int = 42) -> str:
+    """Generate text that looks like a scraped article, see wikichat.processing.wikipedia.scrape_article.
+
+    Scraped articles have had their whitespace collapsed to single spaces and most punctuation removed.
+    """
+    rand = random.Random(seed)
+    vocab: list[str] = [
+        "".join(rand.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rand.randint(1, 12)))
+        for _ in range(5000)
+    ]
+    words: list[str] = []
+    length = 0
+    while length < num_chars:
+        word = rand.choice(vocab)
+        if rand.random() < 0.05:
+            word = word.capitalize()
+        if rand.random() < 0.08:
+            word += ","
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)[:num_chars]
+
+
+def generate_article_page(paragraphs: list[str], title: str = "Benchmark Article") -> str:
+    """HTML like a wikipedia article page, with the elements wikichat.processing.wikipedia.parse_article reads"""
+    # a section heading every few paragraphs, and the citation markers parse_article removes
+    body = "\n".join(
+        f"<h2>Section {idx}</h2><p>{paragraph}</p>" if idx % 3 == 0
+        else f"<p>{paragraph}<sup class=\"reference\">[{idx}]</sup></p>"
+        for idx, paragraph in enumerate(paragraphs)
+    )
+    return (f"<html><head><title>{title} - Wikipedia</title></head><body>"
+            f"<h1 id=\"firstHeading\">{title}</h1><div id=\"mw-content-text\">"
+            f"<img src=\"figure.png\">{body}</div></body></html>")
+
+
+def generate_edit_history(num_chars: int, revisions: int, edit_fraction: float, seed: int = 42) -> list[list[str]]:
+    """The paragraphs of an article after each of a series of edits, the first item is the original article.
+
+    Each edit replaces, inserts or deletes a random edit_fraction of the paragraphs, like a busy article being edited.
+    """
+    rand = random.Random(seed)
+    text = generate_article(num_chars, seed)
+    paragraphs: list[str] = []
+    start = 0
+    while start < len(text):
+        end = text.find(" ", start + rand.randint(300, 900))
+        end = len(text) if end == -1 else end
+        paragraphs.append(text[start:end].strip())
+        start = end + 1
+
+    history = [paragraphs]
+    for revision in range(revisions):
+        paragraphs = list(paragraphs)
+        for edit in range(max(1, round(len(paragraphs) * edit_fraction))):
+            idx = rand.randrange(len(paragraphs))
+            new_paragraph = generate_article(rand.randint(300, 900), seed=seed + revision * 1000 + edit + 1)
+            match rand.choice(["replace", "insert", "delete"]):
+                case "replace":
+                    paragraphs[idx] = new_paragraph
+                case "insert":
+                    paragraphs.insert(idx, new_paragraph)
+                case "delete" if len(paragraphs) > 1:
+                    del paragraphs[idx]
+        history.append(paragraphs)
+    return history
+
+
+async def _time_stages(num_chars: int, stages: list[str], args: StageBenchArgs) -> list[dict]:
+    # the stages are run on the output of the earlier ones, so every stage is run once to build its input
+    meta = ArticleMetadata(title="Benchmark Article", url="https://en.wikipedia.org/wiki/Benchmark_Article")
+    pages = [generate_article_page(paragraphs) for paragraphs in
+             generate_edit_history(num_chars, args.revisions, args.edit_fraction)]
+    articles = [_parse_or_raise(meta, page) for page in pages]
+    chunked_articles = [await chunk_article(article) for article in articles]
+    prev_docs = [ChunkedArticleMetadataOnly.from_chunked_article(chunked).to_dict() for chunked in chunked_articles]
+
+    def _calc_chunk_diffs() -> list:
+        return [
+            diff_chunks(chunked, ChunkedArticleMetadataOnly.from_chunked_article(chunked), prev_doc)
+            for chunked, prev_doc in zip(chunked_articles[1:], prev_docs)
+        ]
+
+    # vectorize the first version of the article, when all the chunks are new
+    first_diff = diff_chunks(chunked_articles[0], None, None)
+    vectors = np.random.default_rng(42).random((len(first_diff.new_chunks), _VECTOR_DIMENSION), dtype=np.float32)
+
+    def _vectorize_diff():
+        zero_vector_rows(vectors)
+        return vectored_diff(first_diff, first_diff.new_chunks, first_diff.new_chunks, vectors, {})
+
+    vectored = _vectorize_diff()
+    chunks = len(chunked_articles[0].chunks)
+    # the size of the input each stage works on, the diffs are timed across all the revisions
+    timed = {
+        "scrape_article": (lambda: parse_article(meta, pages[0]), len(pages[0]), chunks),
+        "chunk_article": (lambda: chunk_article(articles[0]), len(articles[0].content), chunks),
+        "calc_chunk_diff": (_calc_chunk_diffs, sum(len(a.content) for a in articles[1:]),
+                            sum(len(chunked.chunks) for chunked in chunked_articles[1:])),
+        "vectorize_diff": (_vectorize_diff, vectors.nbytes, chunks),
+        "embedding_document": (
+            lambda: [EmbeddingDocument.from_vectored_chunk(chunk).to_dict() for chunk in vectored.new_chunks],
+            len(articles[0].content), chunks)
+    }
+
+    results: list[dict] = []
+    for stage in stages:
+        func, num_bytes, num_chunks = timed[stage]
+        # chunk_article is a coroutine because it updates the metrics
+        if stage == "chunk_article":
+            best_secs = await _best_of_async(args.repeats, func)
+        else:
+            best_secs = _best_of(args.repeats, func)
+        results.append({
+            "stage": stage,
+            "article_chars": num_chars,
+            "chunks": num_chunks,
+            "best_ms": round(best_secs * 1000, 3),
+            "us_per_chunk": round(best_secs * 1_000_000 / max(num_chunks, 1), 2),
+            "mb_per_sec": round(num_bytes / best_secs / 1024 / 1024, 1) if best_secs else 0.0
+        })
+    return results
+
+
+def _parse_or_raise(meta: ArticleMetadata, page: str):
+    article, _ = parse_article(meta, page)
+    if not article:
+        raise ValueError(f"Could not parse the generated page for {meta.url}")
+    return article
+
+
+def _best_of(repeats: int, func) -> float:
+    best = float("inf")
+    for _ in range(max(repeats, 1)):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+async def _best_of_async(repeats: int, func) -> float:
+    best = float("inf")
+    for _ in range(max(repeats, 1)):
+        start = time.perf_counter()
+        await func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _maybe_langchain_splitter():
+    # langchain is no longer a dependency, if it is installed we compare against the splitter we replaced
+    try:
+        from langchain.text_splitter import RecursiveCharacterTextSplitter
+    except ImportError:
+        return None
+    return RecursiveCharacterTextSplitter(chunk_size=_CHUNK_SIZE, chunk_overlap=_CHUNK_OVERLAP, length_function=len)
+
+
+async def _load_search_queries(query_file: str) -> list[str]:
+    if query_file:
+        with open(query_file, mode='r') as file:
+            return [line.strip() for line in file if line.strip()]
+
+    resp = await wrap_blocking_io(
+        lambda: SUGGESTIONS_COLLECTION.find(filter={"_id": "recent_articles"})
+    )
+    if not resp["data"]["documents"]:
+        return []
+    recent_articles = RecentArticles.from_dict(resp["data"]["documents"][0])
+
+    # the question suggested_search asks, and the start of each suggested chunk as a more specific question
+    queries: list[str] = []
+    for recent_article in recent_articles.recent_articles:
+        queries.append(question_for_article(recent_article.metadata.title))
+        queries.extend(" ".join(chunk.content.split()[:20]) for chunk in recent_article.suggested_chunks)
+    return queries
+
+
+async def _timed_search(query: str, limit: int, search_filter: dict) -> SearchSample:
+    start = time.perf_counter()
+    try:
+        question_vector = (await embeddings.embed_queries([query]))[0]
+    except Exception as e:
+        return SearchSample(embed_secs=time.perf_counter() - start, error_phase="embed", error=_error_name(e))
+    embed_secs = time.perf_counter() - start
+
+    start = time.perf_counter()
+    try:
+        await search_chunks(question_vector, limit=limit, search_filter=search_filter,
+                            projection={"title": 1, "url": 1, "content": 1})
+    except Exception as e:
+        return SearchSample(embed_secs=embed_secs, search_secs=time.perf_counter() - start, error_phase="search",
+                            error=_error_name(e))
+    return SearchSample(embed_secs=embed_secs, search_secs=time.perf_counter() - start)
+
+
+def _error_name(error: Exception) -> str:
+    # HTTP errors are broken down by status, such as rate limits
+    status = getattr(error, "status", None) or getattr(getattr(error, "response", None), "status_code", None)
+    return f"{error.__class__.__name__} {status}" if status else error.__class__.__name__
+
+
+def _latency_percentiles(latencies_secs: list[float]) -> dict[str, float]:
+    if not latencies_secs:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "mean": 0.0, "max": 0.0}
+    latencies_ms = np.asarray(latencies_secs) * 1000
+    p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99])
+    return {"p50": round(float(p50), 2), "p95": round(float(p95), 2), "p99": round(float(p99), 2),
+            "mean": round(float(latencies_ms.mean()), 2), "max": round(float(latencies_ms.max()), 2)}
+
+
+def _describe_search_report(report: dict) -> str:
+    lines = [
+        f"Search benchmark requests={report['requests']} succeeded={report['succeeded']} failed={report['failed']} "
+        f"elapsed={report['elapsed_secs']}s throughput={report['throughput_per_sec']}/s",
+        f"{'phase':>8} {'p50 (ms)':>10} {'p95 (ms)':>10} {'p99 (ms)':>10} {'mean (ms)':>10} {'max (ms)':>10}"
+    ]
+    for phase, latency in report["latency_ms"].items():
+        lines.append(f"{phase:>8} {latency['p50']:>10.2f} {latency['p95']:>10.2f} {latency['p99']:>10.2f} "
+                     f"{latency['mean']:>10.2f} {latency['max']:>10.2f}")
+    if report["query_cache"]:
+        lines.append(f"query cache hits={report['query_cache']['hits'] + report['query_cache']['waits']} "
+                     f"misses={report['query_cache']['misses']}, the embed latencies include the hits")
+    if report["search_cache"]:
+        lines.append(f"search cache hits={report['search_cache']['hits']} "
+                     f"misses={report['search_cache']['misses']}, the search latencies include the hits")
+    for phase, phase_errors in report["errors"].items():
+        for error, count in phase_errors.items():
+            lines.append(f"{phase} error {error}: {count}")
+    return "\n".join(lines)
+
+
+def _describe_stage_report(report: dict, baseline: dict | None = None) -> str:
+    baseline_ms = {(result["stage"], result["article_chars"]): result["best_ms"]
+                   for result in (baseline or {}).get("stages", [])}
+    lines = [
+        f"Stage benchmark repeats={report['repeats']} revisions={report['revisions']} "
+        f"edit_fraction={report['edit_fraction']}",
+        f"{'stage':>18} {'chars':>10} {'chunks':>7} {'best (ms)':>10} {'us/chunk':>9} {'MB/s':>8} {'baseline':>10}"
+    ]
+    for result in report["stages"]:
+        previous = baseline_ms.get((result["stage"], result["article_chars"]))
+        change = f"{(result['best_ms'] - previous) / previous:>+10.1%}" if previous else f"{'-':>10}"
+        lines.append(f"{result['stage']:>18} {result['article_chars']:>10} {result['chunks']:>7} "
+                     f"{result['best_ms']:>10.2f} {result['us_per_chunk']:>9.2f} {result['mb_per_sec']:>8.1f} "
+                     f"{change}")
+    for regression in report.get("regressions", []):
+        lines.append(f"Regression {regression['stage']} at {regression['article_chars']} chars: "
+                     f"{regression['baseline_ms']} ms -> {regression['best_ms']} ms")
+    return "\n".join(lines)
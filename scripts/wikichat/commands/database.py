@@ -4,15 +4,29 @@ Utility commands for interacting with the database to view when has been written
 These are not used by the wikichat application, but are useful for debugging and understanding what is in the database.
 """
 import asyncio
+import contextlib
+import itertools
 import json
 import logging
+import random
+import sys
+import time
+from typing import Any, ContextManager, Iterator, TextIO
+
+import numpy as np
 
 from wikichat import database
-from wikichat.commands.model import EmbedAndSearchArgs, SuggestedSearchArgs
-from wikichat.database import EMBEDDINGS_COLLECTION, SUGGESTIONS_COLLECTION
+from wikichat.commands.model import EmbedAndSearchArgs, SuggestedSearchArgs, QueryCacheArgs
+from wikichat.database import EMBEDDINGS_COLLECTION, METADATA_COLLECTION, SUGGESTIONS_COLLECTION
 from wikichat.processing import embeddings
 from wikichat.processing.model import RecentArticles
-from wikichat.utils import wrap_blocking_io
+from wikichat.processing.query_cache import QUERY_CACHE
+from wikichat.processing.search_cache import SEARCH_CACHE
+from wikichat.utils.metrics import METRICS
+from wikichat.utils import batch_list, wrap_blocking_io
+
+# Fraction of search cache hits to check against the database, see configure_search
+_SEARCH_CACHE_VERIFY_RATE: float = 0.0
 
 
 # ======================================================================================================================
@@ -30,27 +44,34 @@ async def suggested_articles(args: None) -> None:
 
 
 async def embed_and_search(args: EmbedAndSearchArgs) -> None:
+    configure_search(args)
+    if args.query_file:
+        await _bulk_embed_and_search(args)
+        await embeddings.close_client()
+        return
+    if not args.query:
+        raise ValueError("Give a query to search for, or a query_file")
+
     # embed the question
-    question_vectors = await embeddings.get_embeddings([args.query], input_type='search_query')
-    question_vector: list[float] = question_vectors[0]
+    question_vectors = await embeddings.embed_queries([args.query])
+    await embeddings.close_client()
 
     limit = args.limit or 5
     filter = args._filter or {}
-    resp = EMBEDDINGS_COLLECTION.find(
-        filter=filter,
-        sort={"$vector": question_vector},
-        projection={"title": 1, "url": 1, "content": 1},
-        options={"limit": limit})
+    docs = await search_chunks(question_vectors[0], limit=limit, search_filter=filter,
+                               projection={"title": 1, "url": 1, "content": 1})
 
     print(f"QUERY: {args.query}")
     print(f"Filter: {filter}")
     print(f"Limit: {limit} ")
     print("Ordered Results:")
-    for doc in resp["data"]["documents"]:
+    for doc in docs:
         print(json.dumps(doc, indent=2))
 
 
 async def suggested_search(args: SuggestedSearchArgs) -> None:
+    configure_search(args)
+
     count = 1
     while args.repeats == 0 or (args.repeats != 0 and count <= args.repeats):
         resp = await wrap_blocking_io(
@@ -60,20 +81,199 @@ async def suggested_search(args: SuggestedSearchArgs) -> None:
         )
         recent_articles = RecentArticles.from_dict(resp["data"]["documents"][0])
 
-        question = f"I want to know more about this topic: {recent_articles.recent_articles[0].metadata.title}"
-        question_vectors = await embeddings.get_embeddings([question], input_type='search_query')
-        question_vector: list[float] = question_vectors[0]
+        question = question_for_article(recent_articles.recent_articles[0].metadata.title)
+        question_vectors = await embeddings.embed_queries([question])
+        docs = await search_chunks(question_vectors[0], limit=args.limit,
+                                   projection={"title": 1, "url": 1, "content": 1})
+
+        logging.info(f"QUERY: {question}")
+        for doc in docs:
+            logging.info(f"Title: {doc['title']}\nURL: {doc['url']}\nContent: {doc['content'][:100]}...\n")
+        count += 1
+
+        await asyncio.sleep(args.delay_secs)
+    await embeddings.close_client()
+    _log_cache_summary()
+
+
+# ======================================================================================================================
+# Helpers
+# ======================================================================================================================
+
+async def _bulk_embed_and_search(args: EmbedAndSearchArgs) -> None:
+    """Search for each query in the file and write a JSON line for it as soon as it completes.
+
+    Queries are read and embedded a batch at a time, and the queue between embedding and searching is bounded, so
+    memory use does not grow with the size of the file. Lines are written in the order the searches complete, use
+    the index to match them to the file.
+    """
+    limit = args.limit or 5
+    search_filter = args._filter or {}
+    concurrency = max(args.concurrency, 1)
+    # (index, query, vector, embed_ms), or None to stop a search worker
+    search_queue: asyncio.Queue[tuple[int, str, np.ndarray, float] | None] = asyncio.Queue(maxsize=concurrency * 2)
+    counts = {"queries": 0, "errors": 0}
+
+    def _write(output: TextIO, result: dict[str, Any]) -> None:
+        output.write(json.dumps(result) + "\n")
+        output.flush()
+        counts["queries"] += 1
+        counts["errors"] += 1 if "error" in result else 0
+
+    async def _embed_batches(lines: Iterator[str], output: TextIO) -> None:
+        index = 0
+        while raw_lines := await wrap_blocking_io(lambda: list(itertools.islice(lines, args.batch_size))):
+            batch: list[tuple[int, str]] = []
+            for line in raw_lines:
+                if line.strip():
+                    batch.append((index, line.strip()))
+                    index += 1
+            if not batch:
+                continue
+
+            start = time.perf_counter()
+            try:
+                vectors = await embeddings.embed_queries([query for _, query in batch])
+            except Exception as e:
+                logging.warning(f"Error embedding batch of {len(batch)} queries", exc_info=True)
+                for query_index, query in batch:
+                    _write(output, {"index": query_index, "query": query, "error": f"embed: {e!r}"})
+                continue
+            embed_ms = round((time.perf_counter() - start) * 1000, 2)
+            for (query_index, query), vector in zip(batch, vectors):
+                await search_queue.put((query_index, query, vector, embed_ms))
+
+    async def _search_worker(output: TextIO) -> None:
+        while (item := await search_queue.get()) is not None:
+            query_index, query, vector, embed_ms = item
+            result: dict[str, Any] = {"index": query_index, "query": query}
+            start = time.perf_counter()
+            try:
+                docs = await search_chunks(vector, limit=limit, search_filter=search_filter, projection={"url": 1},
+                                           include_similarity=True)
+                result.update({
+                    "ids": [doc["_id"] for doc in docs],
+                    "urls": [doc.get("url") for doc in docs],
+                    "scores": [doc.get("$similarity") for doc in docs],
+                })
+            except Exception as e:
+                result["error"] = f"search: {e!r}"
+            result.update({"embed_ms": embed_ms, "search_ms": round((time.perf_counter() - start) * 1000, 2)})
+            _write(output, result)
+
+    async def _feed(lines: Iterator[str], output: TextIO) -> None:
+        await _embed_batches(lines, output)
+        for _ in range(concurrency):
+            await search_queue.put(None)
 
+    with _open_query_lines(args.query_file) as lines, _open_output(args.output_file) as output:
+        # waited for together, so if the workers fail, such as when the output is closed, the feeder does not
+        # block forever on the full queue and the error is raised
+        tasks = [asyncio.create_task(_feed(iter(lines), output))]
+        tasks.extend(asyncio.create_task(_search_worker(output)) for _ in range(concurrency))
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    logging.info(f"Searched for {counts['queries']} queries with {counts['errors']} errors")
+    _log_cache_summary()
+
+
+async def _article_versions(urls: list[str]) -> dict[str, float]:
+    """The updated_at of the stored metadata for each of the article urls that has metadata"""
+    versions: dict[str, float] = {}
+    # the Data API returns at most 20 documents per request
+    for batch in batch_list(urls, 20):
+        with METRICS.timer("astra", "metadata.find"):
+            resp = await wrap_blocking_io(
+                lambda x: METADATA_COLLECTION.find(filter={"_id": {"$in": x}}, projection={"updated_at": 1},
+                                                   options={"limit": len(x)}),
+                batch)
+        versions.update((doc["_id"], doc.get("updated_at", 0.0)) for doc in resp["data"]["documents"])
+    return versions
+
+
+def _log_cache_summary() -> None:
+    if QUERY_CACHE.enabled:
+        logging.info(f"Query cache {METRICS.query_cache_summary()}")
+    if SEARCH_CACHE.enabled:
+        logging.info(f"Search cache {METRICS.search_cache_summary()}")
+
+
+def _open_query_lines(query_file: str) -> ContextManager[TextIO]:
+    return contextlib.nullcontext(sys.stdin) if query_file == "-" else open(query_file, mode='r')
+
+
+def _open_output(output_file: str) -> ContextManager[TextIO]:
+    return contextlib.nullcontext(sys.stdout) if not output_file else open(output_file, mode='w')
+
+
+def configure_search(args: QueryCacheArgs) -> None:
+    """Use the embedding provider, query cache and search cache from the command args"""
+    global _SEARCH_CACHE_VERIFY_RATE
+    embeddings.use_provider(args.embedding_provider, **args.local_provider_options())
+    QUERY_CACHE.configure(max_entries=args.query_cache_size, ttl_secs=args.query_cache_ttl_secs)
+    SEARCH_CACHE.configure(max_entries=args.search_cache_size, ttl_secs=args.search_cache_ttl_secs,
+                           threshold=args.search_cache_threshold)
+    _SEARCH_CACHE_VERIFY_RATE = args.search_cache_verify_rate
+
+
+async def search_chunks(question_vector: np.ndarray, limit: int, search_filter: dict[str, Any] = None,
+                        projection: dict[str, Any] = None, include_similarity: bool = False) -> list[dict[str, Any]]:
+    """ANN search of the stored chunks, using the results of a similar recent search from SEARCH_CACHE if there is one.
+
+    The url is always included in the projection, so the cached results can be checked against the versions of the
+    articles in them.
+    """
+    search_filter = search_filter or {}
+    projection = {**(projection or {}), "url": 1}
+    options = {"limit": limit, "includeSimilarity": True} if include_similarity else {"limit": limit}
+    params_key = SEARCH_CACHE.params_key(limit, search_filter, {**projection, "$similarity": include_similarity})
+
+    lookup = SEARCH_CACHE.lookup(question_vector, params_key)
+    hit = lookup.hit
+    if hit is not None and await _article_versions(list(hit.versions)) != hit.versions:
+        # an article in the results has changed since they were cached
+        SEARCH_CACHE.remove(hit.slot)
+        await METRICS.update_search_cache(invalidations=1)
+        hit = None
+    verify = hit is not None and random.random() < _SEARCH_CACHE_VERIFY_RATE
+    if hit is not None and not verify:
+        await METRICS.update_search_cache(hits=1, hit_age_secs=hit.age_secs)
+        return hit.docs
+
+    question_vector_list: list[float] = np.asarray(question_vector, dtype=np.float32).tolist()
+    with METRICS.timer("astra", "embeddings.vector_search"):
         resp = await wrap_blocking_io(
             lambda: EMBEDDINGS_COLLECTION.find(
-                sort={"$vector": question_vector},
-                projection={"title": 1, "url": 1, "content": 1},
-                options={"limit": args.limit})
+                filter=search_filter,
+                sort={"$vector": question_vector_list},
+                projection=projection,
+                options=options)
         )
+    docs: list[dict[str, Any]] = resp["data"]["documents"]
+
+    if verify:
+        stale = [doc["_id"] for doc in hit.docs] != [doc["_id"] for doc in docs]
+        # replace the entry so the fresh results are used from now on
+        SEARCH_CACHE.remove(hit.slot)
+        await METRICS.update_search_cache(hits=1, hit_age_secs=hit.age_secs, verified=1, stale=1 if stale else 0)
+    else:
+        await METRICS.update_search_cache(misses=1, expired=lookup.expired)
+    if not SEARCH_CACHE.enabled:
+        return docs
+    versions = await _article_versions(list({doc["url"] for doc in docs if doc.get("url")}))
+    evicted = SEARCH_CACHE.put(question_vector, params_key, docs, versions)
+    if evicted:
+        await METRICS.update_search_cache(evictions=evicted)
+    return docs
 
-        logging.info(f"QUERY: {question}")
-        for doc in resp["data"]["documents"]:
-            logging.info(f"Title: {doc['title']}\nURL: {doc['url']}\nContent: {doc['content'][:100]}...\n")
-        count += 1
 
-        await asyncio.sleep(args.delay_secs)
\ No newline at end of file
+def question_for_article(title: str) -> str:
+    """The question we ask to search for an article suggested to the user"""
+    return f"I want to know more about this topic: {title}"
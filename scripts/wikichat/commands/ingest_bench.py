@@ -0,0 +1,285 @@
+"""
+End to end benchmark of ingesting articles, using local stand-ins for Wikipedia, Cohere and Astra so the results
+can be repeated and compared between commits, see :mod:`wikichat.utils.standins`.
+
+The articles are bulk loaded, and then edits to them are read from the stand-in recent changes stream, each through
+a pipeline made by the same code as the load and listen commands. The report has the articles and chunks per second,
+how busy the workers of each step were, and the peak memory of this process.
+
+The database client is created from the environment when wikichat.database is first imported, so this module only
+imports it once the stand-ins are running and the environment points at them.
+"""
+import dataclasses
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable
+
+import aiohttp
+
+from wikichat.commands.model import IngestBenchArgs
+from wikichat.utils.metrics import METRICS
+from wikichat.utils.pipeline import AsyncPipeline
+from wikichat.utils.standins import StandIns, StandInOptions, article_titles, SERVICE_WIKIPEDIA, \
+    SERVICE_EMBEDDINGS, SERVICE_ASTRA, CHANGES_PATH, STATS_PATH
+
+
+# ======================================================================================================================
+# Commands
+# ======================================================================================================================
+
+async def ingest_bench(args: IngestBenchArgs) -> None:
+    if args.processes > 1:
+        raise ValueError("The ingest benchmark runs one pipeline process, use --processes 1")
+    titles = article_titles(args.corpus_dir, args.load_articles)
+    if not titles:
+        raise ValueError(f"No articles to load, no .html files in {args.corpus_dir}")
+
+    stand_ins = StandIns(_stand_in_options(args, titles)).start()
+    try:
+        _use_stand_ins(stand_ins)
+        with tempfile.TemporaryDirectory(prefix="ingest-bench-") as tmp_dir:
+            # listening carries on with the stored chunk filter saved by the bulk load, as it does when the
+            # application is restarted, rather than scanning the collection
+            phase_args = dataclasses.replace(
+                args, chunk_filter_file=args.chunk_filter_file or os.path.join(tmp_dir, "stored_chunks.filter"))
+            phases = [await _run_phase("load", phase_args, _load_feed(stand_ins, titles), collection_empty=True)]
+            if args.listen_articles > 0:
+                phases.append(await _run_phase("listen", dataclasses.replace(
+                    phase_args, max_articles=args.listen_articles,
+                    changes_url=stand_ins.urls[SERVICE_WIKIPEDIA] + CHANGES_PATH), _listen_feed))
+        stand_in_stats = await _stand_in_stats(stand_ins)
+    finally:
+        stand_ins.stop()
+
+    report = ingest_bench_report(args, phases, stand_in_stats)
+    baseline = None
+    if args.baseline_file:
+        with open(args.baseline_file, mode='r') as file:
+            baseline = json.load(file)
+    print(_describe_ingest_report(report, baseline))
+    if args.json_file:
+        with open(args.json_file, mode='w') as file:
+            json.dump(report, file, indent=2)
+        logging.info(f"Wrote JSON report to {args.json_file}")
+    else:
+        print(json.dumps(report, indent=2))
+
+
+def ingest_bench_report(args: IngestBenchArgs, phases: list[dict[str, Any]],
+                        stand_in_stats: dict[str, dict[str, int]]) -> dict[str, Any]:
+    return {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "args": args.to_dict(),
+        "phases": phases,
+        "peak_rss_mb": _peak_rss_mb(),
+        "stand_ins": stand_in_stats
+    }
+
+
+# ======================================================================================================================
+# Helpers
+# ======================================================================================================================
+
+def _stand_in_options(args: IngestBenchArgs, titles: list[str]) -> dict[str, StandInOptions]:
+    options = {
+        SERVICE_WIKIPEDIA: StandInOptions(
+            latency_ms=args.wikipedia_latency_ms, error_rate=args.wikipedia_error_rate, seed=args.stand_in_seed,
+            corpus_dir=args.corpus_dir,
+            article_chars=tuple(int(size) for size in args.article_chars.split(",") if size.strip()),
+            titles=titles, events_file=args.events_file, events_per_sec=args.events_per_sec,
+            disconnect_every=args.disconnect_every),
+        SERVICE_ASTRA: StandInOptions(latency_ms=args.astra_latency_ms, error_rate=args.astra_error_rate,
+                                      seed=args.stand_in_seed)
+    }
+    # the local provider embeds in this process, there is nothing to stand in for
+    if args.embedding_provider == "cohere":
+        options[SERVICE_EMBEDDINGS] = StandInOptions(latency_ms=args.embeddings_latency_ms,
+                                                     error_rate=args.embeddings_error_rate, seed=args.stand_in_seed)
+    return options
+
+
+def _use_stand_ins(stand_ins: StandIns) -> None:
+    """Point the clients at the stand-ins, before wikichat.database creates the Astra client"""
+    if "wikichat.database_setup" in sys.modules:
+        raise RuntimeError("The Astra client was created before the stand-ins started")
+    os.environ["ASTRA_DB_APPLICATION_TOKEN"] = "stand-in"
+    os.environ["ASTRA_DB_API_ENDPOINT"] = stand_ins.urls[SERVICE_ASTRA]
+    if SERVICE_EMBEDDINGS in stand_ins.urls:
+        # read by the Cohere client when it is created
+        os.environ["CO_API_URL"] = stand_ins.urls[SERVICE_EMBEDDINGS]
+        os.environ["COHERE_API_KEY"] = "stand-in"
+
+
+def _load_feed(stand_ins: StandIns, titles: list[str]) -> Callable:
+    async def _feed(pipeline: AsyncPipeline, args: IngestBenchArgs) -> None:
+        from wikichat.processing.articles import process_article_metadata
+        from wikichat.processing.model import ArticleMetadata
+        from wikichat.utils.pipeline import Priority
+
+        base_url = stand_ins.urls[SERVICE_WIKIPEDIA]
+        # the same as load_base_data, without the file of urls
+        await process_article_metadata(pipeline,
+                                       [ArticleMetadata(url=f"{base_url}/wiki/{title}") for title in titles],
+                                       priority=Priority.BULK)
+
+    return _feed
+
+
+async def _listen_feed(pipeline: AsyncPipeline, args: IngestBenchArgs) -> None:
+    from wikichat.commands.pipeline import listen_for_changes
+    await listen_for_changes(pipeline, args)
+
+
+async def _run_phase(name: str, args: IngestBenchArgs, feed: Callable, collection_empty: bool = False) -> dict:
+    """Run a pipeline with the feed, and report on the work it did from the change in the metrics"""
+    # delayed imports, see the module docs
+    from wikichat import database
+    from wikichat.cli import run_pipeline
+
+    if collection_empty:
+        await database.truncate_all_collections()
+
+    num_workers: dict[str, int] = {}
+    started: list[float] = []
+    before = METRICS.snapshot()
+
+    async def _feed(pipeline: AsyncPipeline) -> None:
+        num_workers.update({step.name: step.num_tasks for step in pipeline.steps})
+        # loading the stored chunk filter before the pipeline starts is not part of the phase
+        started.append(time.perf_counter())
+        await feed(pipeline, args)
+
+    logging.info(f"Starting ingest benchmark phase {name}")
+    await run_pipeline(_feed, args, collection_empty=collection_empty)
+    elapsed_secs = time.perf_counter() - started[0]
+    return _phase_report(name, elapsed_secs, num_workers, before, METRICS.snapshot())
+
+
+def _phase_report(name: str, elapsed_secs: float, num_workers: dict[str, int], before: dict[str, Any],
+                  after: dict[str, Any]) -> dict[str, Any]:
+    def _counter(key: str) -> float:
+        return after["counters"].get(key, 0) - before["counters"].get(key, 0)
+
+    def _by_step(histograms: str) -> dict[str, tuple[int, float]]:
+        start = {row["step"]: row for row in before[histograms]}
+        return {
+            row["step"]: (row["count"] - start.get(row["step"], {}).get("count", 0),
+                          row["sum"] - start.get(row["step"], {}).get("sum", 0.0))
+            for row in after[histograms]
+        }
+
+    processing = _by_step("step_processing_secs")
+    waiting = _by_step("step_queue_wait_secs")
+    articles = _counter("DBMetrics.articles_inserted")
+    chunks = _counter("DBMetrics.chunks_inserted")
+    return {
+        "phase": name,
+        "elapsed_secs": round(elapsed_secs, 3),
+        "articles": articles,
+        "articles_per_sec": round(articles / elapsed_secs, 2) if elapsed_secs else 0.0,
+        "chunks": chunks,
+        "chunks_per_sec": round(chunks / elapsed_secs, 2) if elapsed_secs else 0.0,
+        "chunks_created": _counter("Chunks.chunks_created"),
+        "chunks_vectorized": _counter("Chunks.chunks_vectorized"),
+        "embedding_requests": _counter("EmbeddingMetrics.requests"),
+        "listener_reconnects": _counter("ListenerMetrics.reconnects"),
+        "listener_duplicate_events": _counter("ListenerMetrics.duplicate_events"),
+        "stages": {
+            step: {
+                "workers": workers,
+                "items": processing.get(step, (0, 0.0))[0],
+                "busy_secs": round(processing.get(step, (0, 0.0))[1], 3),
+                # the fraction of the time the workers of the step were processing an item
+                "utilization": round(processing.get(step, (0, 0.0))[1] / (workers * elapsed_secs), 4)
+                if elapsed_secs else 0.0,
+                "mean_wait_ms": round(waiting[step][1] / waiting[step][0] * 1000, 2)
+                if waiting.get(step, (0, 0.0))[0] else 0.0
+            }
+            for step, workers in num_workers.items()
+        },
+        "errors": _dict_change(before["errors"], after["errors"]),
+        "retries": _dict_change(before["retries"], after["retries"]),
+        "dead_letters": _dict_change(before["dead_letters"], after["dead_letters"]),
+        # the peak of the process so far, it includes the earlier phases
+        "peak_rss_mb": _peak_rss_mb()
+    }
+
+
+def _dict_change(before: dict[str, int], after: dict[str, int]) -> dict[str, int]:
+    return {key: count - before.get(key, 0) for key, count in after.items() if count != before.get(key, 0)}
+
+
+async def _stand_in_stats(stand_ins: StandIns) -> dict[str, dict[str, int]]:
+    async with aiohttp.ClientSession() as session:
+        stats = {}
+        for service, url in stand_ins.urls.items():
+            async with session.get(url + STATS_PATH) as response:
+                stats[service] = await response.json()
+        return stats
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return round(peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024, 1)
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def _describe_ingest_report(report: dict[str, Any], baseline: dict[str, Any] | None = None) -> str:
+    lines = [
+        f"Ingest benchmark commit={report['commit'] or '-'} peak_rss={report['peak_rss_mb']}MB "
+        f"embedding_provider={report['args']['embedding_provider']}",
+        f"{'phase':>8} {'elapsed (s)':>12} {'articles':>9} {'articles/s':>11} {'chunks':>8} {'chunks/s':>9} "
+        f"{'embed requests':>15} {'peak RSS (MB)':>14}"
+    ]
+    for phase in report["phases"]:
+        lines.append(f"{phase['phase']:>8} {phase['elapsed_secs']:>12.2f} {phase['articles']:>9} "
+                     f"{phase['articles_per_sec']:>11.2f} {phase['chunks']:>8} {phase['chunks_per_sec']:>9.2f} "
+                     f"{phase['embedding_requests']:>15} {phase['peak_rss_mb']:>14.1f}")
+
+    lines.append("")
+    lines.append(f"{'phase':>8} {'stage':>20} {'workers':>8} {'items':>7} {'busy (s)':>9} {'utilization':>12} "
+                 f"{'mean wait (ms)':>15}")
+    for phase in report["phases"]:
+        for step, stage in phase["stages"].items():
+            lines.append(f"{phase['phase']:>8} {step:>20} {stage['workers']:>8} {stage['items']:>7} "
+                         f"{stage['busy_secs']:>9.2f} {stage['utilization']:>12.1%} {stage['mean_wait_ms']:>15.2f}")
+
+    for phase in report["phases"]:
+        for kind in ("errors", "retries", "dead_letters"):
+            for code, count in phase[kind].items():
+                lines.append(f"{phase['phase']} {kind} {code}: {count}")
+
+    if baseline:
+        lines.append("")
+        lines.append(f"Compared with baseline commit={baseline.get('commit') or '-'}:")
+        baseline_phases = {phase["phase"]: phase for phase in baseline.get("phases", [])}
+        for phase in report["phases"]:
+            previous = baseline_phases.get(phase["phase"])
+            if previous is None:
+                continue
+            changes = ", ".join(
+                f"{metric} {previous[metric]} -> {phase[metric]} ({_change(previous[metric], phase[metric])})"
+                for metric in ("articles_per_sec", "chunks_per_sec", "peak_rss_mb")
+            )
+            lines.append(f"{phase['phase']:>8} {changes}")
+    return "\n".join(lines)
+
+
+def _change(previous: float, current: float) -> str:
+    return f"{(current - previous) / previous:+.1%}" if previous else "-"
@@ -0,0 +1,91 @@
+"""
+Commands to keep the collections tidy while the pipeline is running.
+
+These are not used by the wikichat application.
+"""
+import asyncio
+import json
+import logging
+import time
+from typing import Any
+
+from wikichat.commands.model import GcChunksArgs
+from wikichat.database import EMBEDDINGS_COLLECTION, METADATA_COLLECTION
+from wikichat.utils import batch_list, wrap_blocking_io
+
+# Most documents the Data API will return or delete by id in one request
+_BATCH_SIZE = 20
+
+
+# ======================================================================================================================
+# Commands
+# ======================================================================================================================
+
+async def gc_chunks(args: GcChunksArgs) -> None:
+    """Delete chunks in the embeddings collection that are not in the chunks_metadata of any article.
+
+    These are left when storing an article fails part way, or an item is dropped by the pipeline after its chunks
+    were inserted. The chunk ids are read before the metadata, the pipeline writes the metadata for an article
+    before inserting its chunks, so a chunk inserted while we are scanning is not mistaken for an orphan.
+    """
+    start = time.perf_counter()
+    chunk_ids: set[str] = await wrap_blocking_io(_scan_chunk_ids)
+    logging.info(f"Read {len(chunk_ids)} chunk ids from the embeddings collection")
+    referenced_ids, articles = await wrap_blocking_io(_scan_referenced_chunk_ids)
+    logging.info(f"Read {len(referenced_ids)} chunk ids from the metadata of {articles} articles")
+
+    orphan_ids = sorted(chunk_ids - referenced_ids)
+    logging.info(f"Found {len(orphan_ids)} orphaned chunks of {len(chunk_ids)}"
+                 f"{', not deleting them' if args.dry_run else ''}")
+
+    deleted = 0
+    reclaimed_bytes = 0
+    batches = iter(batch_list(orphan_ids, _BATCH_SIZE))
+
+    async def _worker() -> None:
+        nonlocal deleted, reclaimed_bytes
+        # the workers share the iterator of batches
+        for batch in batches:
+            reclaimed_bytes += await wrap_blocking_io(_stored_bytes, batch)
+            if args.dry_run:
+                continue
+            resp = await wrap_blocking_io(
+                lambda x: EMBEDDINGS_COLLECTION.delete_many(filter={"_id": {"$in": x}}),
+                batch)
+            deleted += resp.get("status", {}).get("deletedCount", 0)
+
+    await asyncio.gather(*[_worker() for _ in range(max(args.concurrency, 1))])
+    logging.info(f"{'Would reclaim' if args.dry_run else 'Reclaimed'} about {reclaimed_bytes / 1024 / 1024:.2f} MB, "
+                 f"deleted {deleted} of {len(orphan_ids)} orphaned chunks, in {time.perf_counter() - start:.1f} secs")
+
+
+# ======================================================================================================================
+# Helpers
+# ======================================================================================================================
+
+def _scan_chunk_ids() -> set[str]:
+    """All the ids in the embeddings collection, makes blocking calls"""
+    return {doc["_id"] for doc in EMBEDDINGS_COLLECTION.paginated_find(projection={"_id": 1})}
+
+
+def _scan_referenced_chunk_ids() -> tuple[set[str], int]:
+    """The chunk ids in the metadata of every article, and the number of articles, makes blocking calls"""
+    referenced_ids: set[str] = set()
+    articles = 0
+    for doc in METADATA_COLLECTION.paginated_find(projection={"chunks_metadata": 1}):
+        referenced_ids.update(doc.get("chunks_metadata", {}).keys())
+        articles += 1
+    return referenced_ids, articles
+
+
+def _stored_bytes(chunk_ids: list[str]) -> int:
+    """Approximate size of the chunks, the JSON of the fields and 4 bytes per vector dimension, makes blocking calls"""
+    resp = EMBEDDINGS_COLLECTION.find(filter={"_id": {"$in": chunk_ids}},
+                                      projection={"_id": 1, "url": 1, "title": 1, "document_id": 1,
+                                                  "chunk_index": 1, "content": 1, "$vector": 1},
+                                      options={"limit": len(chunk_ids)})
+    total = 0
+    for doc in resp["data"]["documents"]:
+        vector: list[Any] = doc.pop("$vector", None) or []
+        total += len(json.dumps(doc).encode('utf-8')) + 4 * len(vector)
+    return total
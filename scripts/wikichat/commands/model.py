@@ -4,18 +4,69 @@ Arguments used by the command functions.
 This module is loaded by the CLI to understand what command line options to expose via argparse. It should not
 load other parts of the wikichat application.
 """
+import json
 from dataclasses import dataclass, field
 
 from dataclasses_json import dataclass_json
 
 
+# ======================================================================================================================
+# embedding provider, used by all commands that embed text
+# ======================================================================================================================
+
+@dataclass_json
+@dataclass(kw_only=True)
+class EmbeddingProviderArgs():
+    embedding_provider: str = field(default="cohere",
+                                    metadata={
+                                        "help": "Service to embed text with: cohere, or local to hash words into vectors "
+                                                "on the CPU for offline testing."})
+
+    local_dimension: int = field(default=1024,
+                                 metadata={
+                                     "help": "Dimension of the vectors from the local embedding provider."})
+
+    local_latency_ms: float = field(default=0,
+                                    metadata={
+                                        "help": "Milliseconds the local embedding provider waits for each request."})
+
+    local_latency_jitter_ms: float = field(default=0,
+                                           metadata={
+                                               "help": "Up to this many random extra milliseconds the local embedding "
+                                                       "provider waits for each request."})
+
+    local_error_rate: float = field(default=0,
+                                    metadata={
+                                        "help": "Fraction of local embedding requests that fail and are not retried."})
+
+    local_rate_limit_rate: float = field(default=0,
+                                         metadata={
+                                             "help": "Fraction of local embedding requests that fail with a 429 and "
+                                                     "are retried."})
+
+    local_seed: int = field(default=0,
+                            metadata={
+                                "help": "Seed for the random latency and failures of the local embedding provider."})
+
+    def local_provider_options(self) -> dict[str, float | int]:
+        """Keyword arguments for wikichat.processing.embedding_providers.LocalProvider"""
+        return {
+            "dimension": self.local_dimension,
+            "latency_ms": self.local_latency_ms,
+            "latency_jitter_ms": self.local_latency_jitter_ms,
+            "error_rate": self.local_error_rate,
+            "rate_limit_rate": self.local_rate_limit_rate,
+            "seed": self.local_seed
+        }
+
+
 # ======================================================================================================================
 # pipeline commands
 # ======================================================================================================================
 
 @dataclass_json
 @dataclass
-class CommonPipelineArgs():
+class CommonPipelineArgs(EmbeddingProviderArgs):
     max_articles: int = field(default=2000,
                               metadata={
                                   "help": 'Maximum number of articles to process, from both bulk loading and listening.'})
@@ -28,6 +79,196 @@ class CommonPipelineArgs():
                                           metadata={
                                               "help": "Rotate the database collection every N chunks, 0 to disable."})
 
+    changes_url: str = field(default="",
+                             metadata={
+                                 "help": "URL of the server-sent events stream of recent changes to listen to, empty "
+                                         "for the Wikipedia stream."})
+
+    changes_position_file: str = field(default="",
+                                       metadata={
+                                           "help": "File to keep the position in the recent changes stream in, so "
+                                                   "listening resumes from the last event after a restart. Empty to "
+                                                   "start from the current events."})
+
+    near_duplicates: str = field(default="off",
+                                 metadata={
+                                     "help": "What to do with new chunks that are near duplicates of stored chunks from "
+                                             "other articles: off, skip them, or alias to reuse the stored vector."})
+
+    near_duplicate_threshold: float = field(default=0.95,
+                                            metadata={
+                                                "help": "Minimum fingerprint similarity, from 0.75 to 1, for a chunk to be "
+                                                        "a near duplicate."})
+
+    near_duplicate_min_chars: int = field(default=200,
+                                          metadata={
+                                              "help": "Chunks shorter than this are never near duplicates."})
+
+    near_duplicate_max_chunks: int = field(default=100000,
+                                           metadata={
+                                               "help": "Maximum number of stored chunks to keep fingerprints for, "
+                                                       "the index is filled from the embeddings collection at "
+                                                       "startup."})
+
+    chunk_filter_capacity: int = field(default=500000,
+                                       metadata={
+                                           "help": "Number of chunk ids to size the filter of stored chunks for, used to "
+                                                   "avoid vectorizing chunks that are already stored. 0 to disable."})
+
+    chunk_filter_error_rate: float = field(default=0.01,
+                                           metadata={
+                                               "help": "False positive rate of the filter of stored chunks when it is at "
+                                                       "capacity."})
+
+    chunk_filter_file: str = field(default="",
+                                   metadata={
+                                       "help": "File to save the filter of stored chunks to when stopping, and load it "
+                                               "from when starting. Empty to scan the collection when starting."})
+
+    embedding_batch_size: int = field(default=96,
+                                      metadata={
+                                          "help": "Maximum number of texts to send in one embedding request, texts from "
+                                                  "all articles being vectorized are packed into requests."})
+
+    embedding_linger_ms: int = field(default=20,
+                                     metadata={
+                                         "help": "Milliseconds to wait for more texts before sending an embedding "
+                                                 "request that is not full."})
+
+    embedding_max_requests: int = field(default=8,
+                                        metadata={
+                                            "help": "Maximum number of embedding requests to send at the same time."})
+
+    live_weight: int = field(default=4,
+                             metadata={
+                                 "help": "Share of the pipeline workers given to live edits when bulk loaded articles "
+                                         "are also waiting, relative to --bulk_weight."})
+
+    bulk_weight: int = field(default=1,
+                             metadata={
+                                 "help": "Share of the pipeline workers given to bulk loaded articles when live edits "
+                                         "are also waiting, relative to --live_weight."})
+
+    shed_queue_depth: int = field(default=1000,
+                                  metadata={
+                                      "help": "Set bulk loaded articles aside when this many items are waiting in the "
+                                              "pipeline, they are processed when it has room. 0 to disable."})
+
+    shed_lag_secs: float = field(default=30,
+                                 metadata={
+                                     "help": "Set bulk loaded articles aside when a live edit has been waiting in the "
+                                             "pipeline for this many seconds. 0 to disable."})
+
+    checkpoint_file: str = field(default="",
+                                 metadata={
+                                     "help": "SQLite file to keep the articles waiting for the --checkpoint_steps in, "
+                                             "and the count of articles for --max_articles. Articles left in the file "
+                                             "when we stop are processed on the next run. Empty to disable."})
+
+    checkpoint_steps: str = field(default="load_article,store_article_diff",
+                                  metadata={
+                                      "help": "Comma separated pipeline steps to keep the waiting articles for in the "
+                                              "--checkpoint_file, the others are only kept in memory. Checkpointing "
+                                              "store_article_diff keeps the vectors we have paid for."})
+
+    retry_max_retries: int = field(default=3,
+                                   metadata={
+                                       "help": "Number of times to retry an article that failed in a pipeline step, "
+                                               "for errors without a rule in --retry_rules_json."})
+
+    retry_base_delay_secs: float = field(default=1.0,
+                                         metadata={
+                                             "help": "Seconds to wait before the first retry, doubled for each retry "
+                                                     "after that."})
+
+    retry_max_delay_secs: float = field(default=60.0,
+                                        metadata={
+                                            "help": "Maximum seconds to wait before a retry."})
+
+    retry_rules_json: str = field(default="",
+                                  metadata={
+                                      "help": "JSON object of retry rules by error code, added to the defaults for "
+                                              "CONCURRENCY_FAILURE and query timeouts. e.g. "
+                                              "'{\"CONCURRENCY_FAILURE\": {\"max_retries\": 8, "
+                                              "\"base_delay_secs\": 0.5, \"max_delay_secs\": 30}}'"})
+
+    dead_letter_file: str = field(default="",
+                                  metadata={
+                                      "help": "SQLite file to keep articles that ran out of retries in, see the "
+                                              "replay-dead-letters command. Empty to drop them."})
+
+    processes: int = field(default=1,
+                           metadata={
+                               "help": "Number of worker processes to run the pipeline in, each article url always "
+                                       "goes to the same process. 1 to run the pipeline in this process. More than "
+                                       "1 needs --rotate_collections_every 0."})
+
+    spill_file: str = field(default="",
+                            metadata={
+                                "help": "File to keep bulk loaded articles that were set aside in, empty to keep them "
+                                        "in memory. Articles left in the file are loaded again on the next run."})
+
+    metrics_port: int = field(default=0,
+                              metadata={
+                                  "help": "Port to serve the metrics on, /metrics in the OpenMetrics text format and "
+                                          "/metrics.json as a JSON snapshot. 0 to disable. With more than one process "
+                                          "each worker uses the next port, starting at metrics_port + 1."})
+
+    metrics_host: str = field(default="127.0.0.1",
+                              metadata={
+                                  "help": "Host to serve the metrics on, 0.0.0.0 to serve them on all interfaces."})
+
+    trace_file: str = field(default="",
+                            metadata={
+                                "help": "File to append the spans of the traced articles to, see the trace-report "
+                                        "command. Empty to disable tracing."})
+
+    trace_sample_rate: float = field(default=0.01,
+                                     metadata={
+                                         "help": "Fraction of the articles to trace when trace_file is set, 1 to "
+                                                 "trace them all."})
+
+    loop_lag_interval_secs: float = field(default=0.5,
+                                          metadata={
+                                              "help": "Seconds between measurements of the event loop lag, 0 to "
+                                                      "disable the lag and slow callback monitoring."})
+
+    slow_callback_ms: float = field(default=100,
+                                    metadata={
+                                        "help": "Log the stack of code that blocks the event loop for longer than this, "
+                                                "0 to disable."})
+
+    profiler: str = field(default="sample",
+                          metadata={
+                              "help": "Profiler to run when sent SIGUSR1 or after --profile_after_secs: sample to "
+                                      "write folded stacks for a flame graph, or cprofile to write pstats."})
+
+    profile_secs: float = field(default=30,
+                                metadata={
+                                    "help": "Seconds to profile for each time the profiler is started."})
+
+    profile_after_secs: float = field(default=-1,
+                                      metadata={
+                                          "help": "Start the profiler this many seconds after starting, -1 to only "
+                                                  "start it when the process is sent SIGUSR1."})
+
+    tracemalloc_frames: int = field(default=0,
+                                    metadata={
+                                        "help": "Trace memory allocations keeping this many frames, and write the "
+                                                "allocations that have grown when sent SIGUSR2 or after profiling. "
+                                                "0 to disable, tracing slows the process down."})
+
+    def profiler_options(self) -> dict[str, float | int | str]:
+        """Keyword arguments for wikichat.utils.profiling.PROFILER.configure"""
+        return {
+            "lag_interval_secs": self.loop_lag_interval_secs,
+            "slow_callback_ms": self.slow_callback_ms,
+            "profiler": self.profiler,
+            "profile_secs": self.profile_secs,
+            "profile_after_secs": self.profile_after_secs,
+            "tracemalloc_frames": self.tracemalloc_frames
+        }
+
 
 @dataclass_json
 @dataclass
@@ -41,16 +282,109 @@ class LoadPipelineArgs(CommonPipelineArgs):
                           "help": 'File of urls, one per line'})
 
 
+@dataclass_json
+@dataclass
+class ReplayDeadLettersArgs(CommonPipelineArgs):
+    truncate_first: bool = field(default=False,
+                                 metadata={
+                                     "help": 'Truncate the database before starting the pipeline.'})
+
+    error_code: str = field(default="",
+                            metadata={
+                                "help": "Only replay the dead letters with this error code, empty for all of them."})
+
+
+@dataclass_json
+@dataclass
+class ReplayChangesArgs(CommonPipelineArgs):
+    recording: str = field(default="",
+                           metadata={
+                               "help": 'Directory of the recording made with the record command, or one file of it.'})
+    replay_speed: float = field(default=1.0,
+                                metadata={
+                                    "help": 'How many times faster than they were recorded to replay the events, '
+                                            '0 to replay them as fast as the pipeline takes them.'})
+    replay_loops: int = field(default=1,
+                              metadata={
+                                  "help": 'Number of times to replay the recording, 0 to replay it until '
+                                          '--max_articles are processed.'})
+
+
+# ======================================================================================================================
+# recording commands
+# ======================================================================================================================
+
+@dataclass_json
+@dataclass
+class RecordChangesArgs():
+    directory: str = field(default="changes_recording",
+                           metadata={
+                               "help": 'Directory to write the gzipped JSON lines files of the recording to.'})
+    changes_url: str = field(default="",
+                             metadata={
+                                 "help": "URL of the server-sent events stream of recent changes to record, empty "
+                                         "for the Wikipedia stream."})
+    max_events: int = field(default=0,
+                            metadata={
+                                "help": 'Stop after recording this many events, 0 for no limit.'})
+    duration_secs: float = field(default=0,
+                                 metadata={
+                                     "help": 'Stop after recording for this long, 0 for no limit.'})
+    max_file_events: int = field(default=100000,
+                                 metadata={
+                                     "help": 'Start a new file after this many events, 0 for no limit.'})
+    max_file_secs: float = field(default=3600,
+                                 metadata={
+                                     "help": 'Start a new file after this long, 0 for no limit.'})
+    max_files: int = field(default=0,
+                           metadata={
+                               "help": 'Delete the oldest files to keep this many, 0 to keep them all.'})
+
+
 # ======================================================================================================================
 # database commands
 # ======================================================================================================================
 
+@dataclass_json
+@dataclass(kw_only=True)
+class QueryCacheArgs(EmbeddingProviderArgs):
+    query_cache_size: int = field(default=10000,
+                                  metadata={
+                                      "help": "Maximum number of query vectors to cache so repeated queries are not "
+                                              "embedded again, 0 to disable."})
+
+    query_cache_ttl_secs: float = field(default=3600,
+                                        metadata={
+                                            "help": "Seconds to keep a query vector in the cache."})
+
+    search_cache_size: int = field(default=1000,
+                                   metadata={
+                                       "help": "Maximum number of search results to cache so similar questions do not "
+                                               "search the database again, 0 to disable."})
+
+    search_cache_ttl_secs: float = field(default=60,
+                                         metadata={
+                                             "help": "Seconds to keep search results in the cache."})
+
+    search_cache_threshold: float = field(default=0.98,
+                                          metadata={
+                                              "help": "Minimum cosine similarity of a question to a cached question to "
+                                                      "reuse its search results."})
+
+    search_cache_verify_rate: float = field(default=0,
+                                            metadata={
+                                                "help": "Fraction of search cache hits to also search the database "
+                                                        "for, to measure how often cached results are stale."})
+
+
 @dataclass_json
 @dataclass
-class EmbedAndSearchArgs():
-    query: str = field(metadata={
-        "help": 'String to embedd and using for ANN search'}
-    )
+class EmbedAndSearchArgs(QueryCacheArgs):
+    query: str = field(default="",
+                       metadata={
+                           "help": 'String to embedd and using for ANN search, not needed when using query_file',
+                           "positional": True}
+                       )
     limit: int = field(default=5,
                        metadata={
                            "help": 'Limit to use for ANN search.'
@@ -59,6 +393,23 @@ class EmbedAndSearchArgs():
                              metadata={
                                  "help": 'JSON string to parse to create a filter for the ANN search.'
                              })
+    query_file: str = field(default="",
+                            metadata={
+                                "help": 'File of queries, one per line, or - for stdin. Each query is searched and a '
+                                        'JSON line written for it, rather than searching for query.'
+                            })
+    output_file: str = field(default="",
+                             metadata={
+                                 "help": 'File to write the JSON lines to when using query_file. Empty for stdout.'
+                             })
+    batch_size: int = field(default=96,
+                            metadata={
+                                "help": 'Number of queries to embed in each request when using query_file.'
+                            })
+    concurrency: int = field(default=16,
+                             metadata={
+                                 "help": 'Number of searches to run at the same time when using query_file.'
+                             })
     _filter: dict[str, any] | None = field(init=False)
 
     def __post_init__(self):
@@ -67,7 +418,7 @@ class EmbedAndSearchArgs():
 
 @dataclass_json
 @dataclass
-class SuggestedSearchArgs():
+class SuggestedSearchArgs(QueryCacheArgs):
     repeats: int = field(default=3,
                          metadata={
                              "help": 'Number of times to search using a new suggested article, 0 for continuous.'
@@ -82,3 +433,286 @@ class SuggestedSearchArgs():
                               metadata={
                                   "help": 'Delay between searches.'
                               })
+
+
+# ======================================================================================================================
+# maintenance commands
+# ======================================================================================================================
+
+@dataclass_json
+@dataclass
+class GcChunksArgs():
+    dry_run: bool = field(default=False,
+                          metadata={
+                              "help": 'Pass true to find and measure the orphaned chunks without deleting them, '
+                                      'false deletes them.'
+                          })
+    concurrency: int = field(default=8,
+                             metadata={
+                                 "help": 'Number of delete requests to run at the same time.'
+                             })
+
+
+# ======================================================================================================================
+# snapshot commands
+# ======================================================================================================================
+
+@dataclass_json
+@dataclass
+class SnapshotArgs():
+    path: str = field(metadata={
+        "help": 'Directory to write the snapshot to, it must not already have a snapshot in it.'}
+    )
+    max_chunks: int = field(default=0,
+                            metadata={
+                                "help": 'Maximum number of chunks to write, 0 for all of them.'
+                            })
+
+
+@dataclass_json
+@dataclass
+class RestoreArgs():
+    path: str = field(metadata={
+        "help": 'Directory of the snapshot to restore.'}
+    )
+    truncate_first: bool = field(default=False,
+                                 metadata={
+                                     "help": 'Truncate the database before restoring, otherwise chunks that already '
+                                             'exist are skipped.'})
+    concurrency: int = field(default=8,
+                             metadata={
+                                 "help": 'Number of insert requests to run at the same time.'
+                             })
+
+
+# ======================================================================================================================
+# tracing commands
+# ======================================================================================================================
+
+@dataclass_json
+@dataclass
+class TraceReportArgs():
+    file: str = field(metadata={
+        "help": 'File of spans written with --trace_file. The .shard-N files written by the worker processes are '
+                'read as well.'}
+    )
+    tail_percentile: float = field(default=99,
+                                   metadata={
+                                       "help": 'Traces at or above this percentile of their total time are the tail '
+                                               'that gets its own breakdown.'
+                                   })
+    slowest: int = field(default=10,
+                         metadata={
+                             "help": 'Number of the slowest traces to list with their critical path.'
+                         })
+    json_file: str = field(default="",
+                           metadata={
+                               "help": 'File to write the JSON report to. Empty to only print the text report.'
+                           })
+
+
+# ======================================================================================================================
+# benchmark commands
+# ======================================================================================================================
+
+@dataclass_json
+@dataclass
+class SplitterBenchArgs():
+    file: str = field(default="",
+                      metadata={
+                          "help": 'File of article text to split, one article per line. Empty to use generated articles.'
+                      })
+    article_chars: str = field(default="10000,100000,1000000",
+                               metadata={
+                                   "help": 'Comma separated sizes, in characters, of the generated articles.'
+                               })
+    repeats: int = field(default=5,
+                         metadata={
+                             "help": 'Number of times to split each article, the best time is reported.'
+                         })
+
+
+@dataclass_json
+@dataclass
+class StageBenchArgs():
+    article_chars: str = field(default="2000,20000,200000,1000000",
+                               metadata={
+                                   "help": 'Comma separated sizes, in characters of text, of the generated articles.'
+                               })
+    revisions: int = field(default=20,
+                           metadata={
+                               "help": 'Number of edits in the generated history of each article, the chunk diff is '
+                                       'timed for each edit.'
+                           })
+    edit_fraction: float = field(default=0.05,
+                                 metadata={
+                                     "help": 'Fraction of the paragraphs of the article changed, added or removed by '
+                                             'each edit.'
+                                 })
+    repeats: int = field(default=5,
+                         metadata={
+                             "help": 'Number of times to run each stage, the best time is reported.'
+                         })
+    stages: str = field(default="",
+                        metadata={
+                            "help": 'Comma separated stages to run, empty for all of them: scrape_article, '
+                                    'chunk_article, calc_chunk_diff, vectorize_diff, embedding_document.'
+                        })
+    json_file: str = field(default="",
+                           metadata={
+                               "help": 'File to write the JSON report to, it can be used as the baseline of later runs.'
+                           })
+    baseline_file: str = field(default="",
+                               metadata={
+                                   "help": 'JSON report of an earlier run on the same machine. The run fails if a stage '
+                                           'is slower than it by more than --max_regression.'
+                               })
+    max_regression: float = field(default=0.2,
+                                  metadata={
+                                      "help": 'Fraction a stage can be slower than the baseline before the run fails.'
+                                  })
+
+
+@dataclass_json
+@dataclass
+class QuantizationBenchArgs():
+    sample: int = field(default=10000,
+                        metadata={
+                            "help": 'Number of stored chunk vectors to read from the database and index.'
+                        })
+    queries: int = field(default=100,
+                         metadata={
+                             "help": 'Number of further stored chunk vectors to hold out and use as queries.'
+                         })
+    k: int = field(default=10,
+                   metadata={
+                       "help": 'Number of results per query to measure recall on.'
+                   })
+    rescore_factor: int = field(default=4,
+                                metadata={
+                                    "help": 'Candidates per result to rescore when using binary quantization.'
+                                })
+
+
+@dataclass_json
+@dataclass
+class SearchBenchArgs(QueryCacheArgs):
+    query_cache_size: int = field(default=0,
+                                  metadata={
+                                      "help": "Maximum number of query vectors to cache, 0 by default so every query "
+                                              "is embedded. When set the embed latencies include the cache hits, "
+                                              "which are counted in the report."})
+    search_cache_size: int = field(default=0,
+                                   metadata={
+                                       "help": "Maximum number of search results to cache, 0 by default so every "
+                                               "search goes to the database. When set the search latencies include "
+                                               "the cache hits, which are counted in the report."})
+    query_file: str = field(default="",
+                            metadata={
+                                "help": 'File of queries, one per line. Empty to make queries from the recent articles.'
+                            })
+    requests: int = field(default=500,
+                          metadata={
+                              "help": 'Number of searches to run, the queries are repeated if there are fewer.'
+                          })
+    concurrency: int = field(default=8,
+                             metadata={
+                                 "help": 'Number of workers each running one search at a time, used when rate is 0.'
+                             })
+    rate: float = field(default=0,
+                        metadata={
+                            "help": 'Searches to start per second whether or not earlier searches have finished, 0 to '
+                                    'use concurrency instead.'
+                        })
+    limit: int = field(default=5,
+                       metadata={
+                           "help": 'Limit to use for ANN search.'
+                       })
+    filter_json: str = field(default="",
+                             metadata={
+                                 "help": 'JSON string to parse to create a filter for the ANN search.'
+                             })
+    json_file: str = field(default="",
+                           metadata={
+                               "help": 'File to write the JSON report to. Empty to print it after the text report.'
+                           })
+
+
+@dataclass_json
+@dataclass
+class IngestBenchArgs(CommonPipelineArgs):
+    load_articles: int = field(default=200,
+                               metadata={
+                                   "help": 'Number of generated articles to bulk load, not used with --corpus_dir.'
+                               })
+    listen_articles: int = field(default=200,
+                                 metadata={
+                                     "help": 'Number of edited articles to process after the bulk load, 0 to skip '
+                                             'listening.'
+                                 })
+    corpus_dir: str = field(default="",
+                            metadata={
+                                "help": 'Directory of saved article pages named <title>.html to bulk load. Empty to '
+                                        'generate the articles.'
+                            })
+    article_chars: str = field(default="2000,10000,50000",
+                               metadata={
+                                   "help": 'Comma separated sizes, in characters, of the generated articles.'
+                               })
+    events_file: str = field(default="",
+                             metadata={
+                                 "help": 'JSON lines file of recent change events to replay when listening, can be '
+                                         'gzipped or a recording made with the record command. Empty to generate '
+                                         'edits to the loaded articles.'
+                             })
+    events_per_sec: float = field(default=0,
+                                  metadata={
+                                      "help": 'Recent change events to send per second, 0 to send them as fast as '
+                                              'the listener reads them.'
+                                  })
+    disconnect_every: int = field(default=0,
+                                  metadata={
+                                      "help": 'Close the recent changes stream after this many events, so the '
+                                              'listener has to reconnect and resume. 0 to keep it open.'
+                                  })
+    wikipedia_latency_ms: float = field(default=0,
+                                        metadata={
+                                            "help": 'Milliseconds the Wikipedia stand-in waits for each page, varied '
+                                                    'by up to half either way.'
+                                        })
+    wikipedia_error_rate: float = field(default=0,
+                                        metadata={
+                                            "help": 'Fraction of pages the Wikipedia stand-in fails with a 503.'
+                                        })
+    embeddings_latency_ms: float = field(default=0,
+                                         metadata={
+                                             "help": 'Milliseconds the embedding stand-in waits for each request, '
+                                                     'varied by up to half either way.'
+                                         })
+    embeddings_error_rate: float = field(default=0,
+                                         metadata={
+                                             "help": 'Fraction of requests the embedding stand-in fails with a 429.'
+                                         })
+    astra_latency_ms: float = field(default=0,
+                                    metadata={
+                                        "help": 'Milliseconds the Astra stand-in waits for each request, varied by up '
+                                                'to half either way.'
+                                    })
+    astra_error_rate: float = field(default=0,
+                                    metadata={
+                                        "help": 'Fraction of requests the Astra stand-in fails with a '
+                                                'CONCURRENCY_FAILURE.'
+                                    })
+    stand_in_seed: int = field(default=0,
+                               metadata={
+                                   "help": 'Seed for the generated articles and edits, and the injected latency and '
+                                           'errors.'
+                               })
+    json_file: str = field(default="",
+                           metadata={
+                               "help": 'File to write the JSON report to. Empty to print it after the text report.'
+                           })
+    baseline_file: str = field(default="",
+                               metadata={
+                                   "help": 'JSON report of an earlier run, such as on another commit, to compare with.'
+                               })
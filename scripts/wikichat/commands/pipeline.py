@@ -3,16 +3,20 @@ COmmands that process articles through the pipeline
 """
 import json
 import logging
+import time
 from typing import Any
 
 from aiohttp import ClientPayloadError
 from aiohttp_sse_client2.client import MessageEvent, EventSource
 
-from wikichat.commands.model import CommonPipelineArgs, LoadPipelineArgs
+from wikichat.commands.model import CommonPipelineArgs, LoadPipelineArgs, ReplayDeadLettersArgs, ReplayChangesArgs
 from wikichat.processing.articles import process_article_metadata
 from wikichat.processing.model import ArticleMetadata
 from wikichat.utils.metrics import METRICS
-from wikichat.utils.pipeline import AsyncPipeline
+from wikichat.utils.pipeline import AsyncPipeline, Priority
+from wikichat.utils.recording import read_recording, replay
+from wikichat.utils.stream_position import StreamPosition
+from wikichat.utils.retry import DeadLetterStore
 from wikichat.database import SUGGESTIONS_COLLECTION
 
 
@@ -24,8 +28,10 @@ WIKIPEDIA_CHANGES_URL = 'https://stream.wikimedia.org/v2/stream/recentchange'
 # ======================================================================================================================
 
 async def load_base_data(pipeline: AsyncPipeline, args: LoadPipelineArgs) -> bool:
+    # bulk loading gives way to live edits, see --live_weight and --shed_queue_depth
     return await process_article_metadata(pipeline,
-                                          read_popular_links(args.file, max_file_lines=args.max_file_lines))
+                                          read_popular_links(args.file, max_file_lines=args.max_file_lines),
+                                          priority=Priority.BULK)
 
 
 async def listen_for_changes(pipeline: AsyncPipeline, args: CommonPipelineArgs) -> bool:
@@ -33,50 +39,77 @@ async def listen_for_changes(pipeline: AsyncPipeline, args: CommonPipelineArgs)
 
     event: MessageEvent
     keep_listening: bool = True
+    # resume from the last event processed when reconnecting, and after a restart with --changes_position_file
+    position = StreamPosition(args.changes_position_file)
+    disconnected_at: float | None = None
+
+    def _disconnected() -> None:
+        # also called by the event source when it reconnects by itself
+        nonlocal disconnected_at
+        if disconnected_at is None:
+            disconnected_at = time.monotonic()
 
     # Issue with timeout
     # see https://github.com/rtfol/aiohttp-sse-client/issues/2
-    while keep_listening:
-        async with EventSource(WIKIPEDIA_CHANGES_URL, timeout=None) as event_source:
-            try:
-                async for event in event_source:
-                    event_doc: dict[Any, Any] = maybe_parse_wiki_event(event)
-                    match event_doc:
-                        case {"meta": {"domain": "canary"}}:
-                            # these are events used by wikipedia to test the service, ignore them
-                            await METRICS.update_listener(total_events=1, canary_events=1)
-                            pass
-                        case {"bot": True}:
-                            # ignore bot edits
-                            await METRICS.update_listener(total_events=1, bot_events=1)
-                            pass
-                        case {"namespace": 0, "wiki": "enwiki", "type": "edit"}:
-                            # namespace 0 is the  wikipedia article namespace, this skips talk pages etc.
-                            # see https://en.wikipedia.org/wiki/Wikipedia:Namespace
-                            article_metadata: ArticleMetadata = ArticleMetadata(
-                                title=event_doc['title'],
-                                url=event_doc['title_url']
-                            )
-
-                            # Let's process this article!
-                            if not await process_article_metadata(pipeline, [article_metadata]):
-                                keep_listening = False
-                                break
-                            await METRICS.update_listener(total_events=1, enwiki_edits=1)
-                        case _:
-                            await METRICS.update_listener(total_events=1, skipped_events=1)
-
-            except ConnectionError:
-                pass
-            except ClientPayloadError:
-                # see https://github.com/aio-libs/aiohttp/issues/4581
-                # there seems to be no work around for this yet (Jen 2024) so just retry
-                logging.debug("Error in event source, retrying see https://github.com/aio-libs/aiohttp/issues/4581",
-                              exc_info=True)
-                pass
+    try:
+        while keep_listening:
+            url, headers = position.resume_request(args.changes_url or WIKIPEDIA_CHANGES_URL)
+            if position.has_position:
+                logging.info(f"Resuming changes stream after event id={position.last_event_id or '-'} "
+                             f"time={position.last_event_dt or '-'}")
+            async with EventSource(url, timeout=None, headers=headers, on_error=_disconnected) as event_source:
+                try:
+                    async for event in event_source:
+                        if disconnected_at is not None:
+                            await METRICS.update_listener(reconnect_gap_secs=time.monotonic() - disconnected_at)
+                            disconnected_at = None
+
+                        event_doc: dict[Any, Any] = maybe_parse_wiki_event(event)
+                        event_key = _event_key(event_doc)
+                        if position.is_duplicate(event_key):
+                            await METRICS.update_listener(total_events=1, duplicate_events=1)
+                            continue
+                        if not await handle_change_event(pipeline, event_doc):
+                            keep_listening = False
+                            break
+                        position.update(event.last_event_id, _event_dt(event_doc), event_key)
+                except ConnectionError:
+                    pass
+                except ClientPayloadError:
+                    # see https://github.com/aio-libs/aiohttp/issues/4581
+                    # there seems to be no work around for this yet (Jen 2024) so just retry
+                    logging.debug("Error in event source, retrying see https://github.com/aio-libs/aiohttp/issues/4581",
+                                  exc_info=True)
+                    pass
+            if keep_listening:
+                _disconnected()
+    finally:
+        position.close()
     return False
 
 
+async def replay_changes(pipeline: AsyncPipeline, args: ReplayChangesArgs) -> bool:
+    if not args.recording:
+        raise ValueError("Pass the --recording to replay, see the record command")
+
+    loops = 0
+    while not args.replay_loops or loops < args.replay_loops:
+        loops += 1
+        replayed = 0
+        async for recorded in replay(read_recording(args.recording), speed=args.replay_speed):
+            # the same handling as events from the live stream
+            event = MessageEvent(type=recorded.type, message=recorded.type, data=recorded.data,
+                                 origin=args.recording, last_event_id=recorded.id)
+            if not await handle_change_event(pipeline, maybe_parse_wiki_event(event)):
+                logging.info(f"Reached max item quota after replaying {replayed} events in loop {loops}")
+                return False
+            replayed += 1
+        if not replayed:
+            raise ValueError(f"No events to replay in the recording {args.recording}")
+        logging.info(f"Replayed {replayed} events from {args.recording} in loop {loops}")
+    return True
+
+
 async def load_and_listen(pipeline: AsyncPipeline, args: LoadPipelineArgs) -> bool:
     if await load_base_data(pipeline, args):
         logging.info("Starting to listen for changes")
@@ -86,10 +119,64 @@ async def load_and_listen(pipeline: AsyncPipeline, args: LoadPipelineArgs) -> bo
     return False
 
 
+async def replay_dead_letters(pipeline: AsyncPipeline, args: ReplayDeadLettersArgs) -> bool:
+    if not args.dead_letter_file:
+        raise ValueError("Pass the --dead_letter_file to replay")
+    if args.processes > 1:
+        raise ValueError("Replay the dead letters of each worker process with --processes 1 and the "
+                         "--dead_letter_file of the worker")
+
+    dead_letters = DeadLetterStore(args.dead_letter_file)
+    replayed: list[int] = []
+    try:
+        for letter in dead_letters.letters(error_code=args.error_code):
+            logging.debug(f"Replaying dead letter {letter.id} into step {letter.step}, failed with {letter.error}")
+            await pipeline.put_to_step(letter.step, letter.item, Priority(letter.priority))
+            replayed.append(letter.id)
+
+        # the letters are only removed once the pipeline is finished with them, articles that fail again have been
+        # added as new dead letters by then, and if the process stops first they are left to be replayed again
+        await pipeline.join_all_steps()
+        for letter_id in replayed:
+            dead_letters.remove(letter_id)
+    finally:
+        dead_letters.close()
+    logging.info(f"Replayed {len(replayed)} dead letters from {args.dead_letter_file}")
+    return True
+
+
 # ======================================================================================================================
 # Helpers
 # ======================================================================================================================
 
+async def handle_change_event(pipeline: AsyncPipeline, event_doc: dict[Any, Any] | None) -> bool:
+    """Put the article of an edit to english wikipedia into the pipeline, False if it has reached the max items"""
+    match event_doc:
+        case {"meta": {"domain": "canary"}}:
+            # these are events used by wikipedia to test the service, ignore them
+            await METRICS.update_listener(total_events=1, canary_events=1)
+            pass
+        case {"bot": True}:
+            # ignore bot edits
+            await METRICS.update_listener(total_events=1, bot_events=1)
+            pass
+        case {"namespace": 0, "wiki": "enwiki", "type": "edit"}:
+            # namespace 0 is the  wikipedia article namespace, this skips talk pages etc.
+            # see https://en.wikipedia.org/wiki/Wikipedia:Namespace
+            article_metadata: ArticleMetadata = ArticleMetadata(
+                title=event_doc['title'],
+                url=event_doc['title_url']
+            )
+
+            # Let's process this article!
+            if not await process_article_metadata(pipeline, [article_metadata]):
+                return False
+            await METRICS.update_listener(total_events=1, enwiki_edits=1)
+        case _:
+            await METRICS.update_listener(total_events=1, skipped_events=1)
+    return True
+
+
 def read_popular_links(file_path: str, max_file_lines: int):
     """Read the popular links file we use to bootstrap the system"""
     # Sample of the line in the file
@@ -123,3 +210,18 @@ def maybe_parse_wiki_event(event: MessageEvent) -> dict[Any, Any] | None:
     except ValueError:
         logging.debug(f"Error parsing event data, continuing: {event.data}")
         return None
+
+
+def _event_key(event_doc: dict[Any, Any] | None) -> str | None:
+    # the id in the meta is unique to each event, the id of the server-sent event is where it is in the stream
+    match event_doc:
+        case {"meta": {"id": str(event_id)}}:
+            return event_id
+    return None
+
+
+def _event_dt(event_doc: dict[Any, Any] | None) -> str | None:
+    match event_doc:
+        case {"meta": {"dt": str(event_dt)}}:
+            return event_dt
+    return None
@@ -0,0 +1,57 @@
+"""
+Commands to record the stream of recent changes, so it can be replayed through the pipeline with replay-changes
+"""
+import asyncio
+import logging
+import time
+
+from aiohttp import ClientPayloadError
+from aiohttp_sse_client2.client import MessageEvent, EventSource
+
+from wikichat.commands.model import RecordChangesArgs
+from wikichat.commands.pipeline import WIKIPEDIA_CHANGES_URL
+from wikichat.utils.recording import RecordingWriter, RecordedEvent
+
+
+# ======================================================================================================================
+# Commands
+# ======================================================================================================================
+
+async def record_changes(args: RecordChangesArgs) -> None:
+    url = args.changes_url or WIKIPEDIA_CHANGES_URL
+    writer = RecordingWriter(args.directory, max_file_events=args.max_file_events,
+                             max_file_secs=args.max_file_secs, max_files=args.max_files)
+    logging.info(f"Recording events from {url} to {args.directory}")
+    start = time.monotonic()
+    try:
+        async with asyncio.timeout(args.duration_secs or None):
+            await _record(url, writer, args.max_events)
+    except TimeoutError:
+        logging.info(f"Stopped recording after {args.duration_secs} seconds")
+    finally:
+        writer.close()
+    logging.info(f"Recorded {writer.events_written} events in {time.monotonic() - start:.1f} seconds")
+
+
+# ======================================================================================================================
+# Helpers
+# ======================================================================================================================
+
+async def _record(url: str, writer: RecordingWriter, max_events: int) -> None:
+    event: MessageEvent
+    # reconnect in the same way as listen_for_changes
+    while True:
+        async with EventSource(url, timeout=None) as event_source:
+            try:
+                async for event in event_source:
+                    # the data is kept as text so the replay parses it like the live stream
+                    writer.write(RecordedEvent(received_at=time.time(), id=event.last_event_id, type=event.type,
+                                               data=event.data))
+                    if max_events and writer.events_written >= max_events:
+                        return
+            except ConnectionError:
+                pass
+            except ClientPayloadError:
+                logging.debug("Error in event source, retrying see https://github.com/aio-libs/aiohttp/issues/4581",
+                              exc_info=True)
+                pass
@@ -0,0 +1,127 @@
+"""
+Commands to copy the chunks and article metadata in the database to a local snapshot, and load them back.
+
+Restoring a snapshot rebuilds an environment without scraping Wikipedia or calling Cohere, see
+wikichat.processing.snapshot for the format.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Iterator
+
+from wikichat import database
+from wikichat.commands.model import SnapshotArgs, RestoreArgs
+from wikichat.database import EMBEDDINGS_COLLECTION, METADATA_COLLECTION, SUGGESTIONS_COLLECTION
+from wikichat.processing.snapshot import SnapshotWriter, SnapshotReader, SnapshotManifest, CHUNK_FIELDS
+from wikichat.utils import wrap_blocking_io
+
+# Most documents the Data API will insert in one request
+_INSERT_BATCH_SIZE = 20
+_LOG_EVERY_DOCS = 10000
+
+
+# ======================================================================================================================
+# Commands
+# ======================================================================================================================
+
+async def snapshot(args: SnapshotArgs) -> None:
+    start = time.perf_counter()
+    # paging through a collection is a series of blocking calls, so do it all on one thread
+    manifest: SnapshotManifest = await wrap_blocking_io(_write_snapshot, args.path, args.max_chunks)
+    logging.info(f"Wrote snapshot {args.path} with {manifest.chunks} chunks of dimension {manifest.dimension}, "
+                 f"{manifest.metadata} article metadata, {manifest.suggestions} suggestions in "
+                 f"{time.perf_counter() - start:.1f} secs")
+
+
+async def restore(args: RestoreArgs) -> None:
+    reader = SnapshotReader(args.path)
+    manifest = reader.manifest
+    if args.truncate_first:
+        await database.truncate_all_collections(dimension=manifest.dimension or 1024)
+
+    start = time.perf_counter()
+    inserted = await _insert_all(EMBEDDINGS_COLLECTION, reader.iter_chunk_batches(_INSERT_BATCH_SIZE),
+                                 args.concurrency, "chunks")
+    inserted_metadata = await _insert_all(METADATA_COLLECTION, _batches(reader.iter_metadata(), _INSERT_BATCH_SIZE),
+                                          args.concurrency, "article metadata")
+    for doc in reader.iter_suggestions():
+        await wrap_blocking_io(
+            lambda x: SUGGESTIONS_COLLECTION.find_one_and_replace(filter={"_id": x["_id"]}, replacement=x,
+                                                                  options={"upsert": True}),
+            doc)
+    logging.info(f"Restored snapshot {args.path} with {inserted} of {manifest.chunks} chunks, {inserted_metadata} "
+                 f"of {manifest.metadata} article metadata, {manifest.suggestions} suggestions in "
+                 f"{time.perf_counter() - start:.1f} secs")
+
+
+# ======================================================================================================================
+# Helpers
+# ======================================================================================================================
+
+def _write_snapshot(path: str, max_chunks: int) -> SnapshotManifest:
+    """Page through the collections and write them to the snapshot, makes blocking calls"""
+    writer = SnapshotWriter(path)
+    page: list[dict[str, Any]] = []
+    projection = {name: 1 for name in CHUNK_FIELDS} | {"$vector": 1}
+    for doc in EMBEDDINGS_COLLECTION.paginated_find(projection=projection):
+        page.append(doc)
+        if len(page) >= _INSERT_BATCH_SIZE:
+            writer.add_chunks(page)
+            page = []
+            if writer.manifest.chunks % _LOG_EVERY_DOCS == 0:
+                logging.info(f"Written {writer.manifest.chunks} chunks to snapshot")
+        if max_chunks and writer.manifest.chunks + len(page) >= max_chunks:
+            break
+    writer.add_chunks(page)
+
+    for doc in METADATA_COLLECTION.paginated_find():
+        writer.add_metadata(doc)
+    for doc in SUGGESTIONS_COLLECTION.paginated_find():
+        writer.add_suggestions(doc)
+    return writer.close()
+
+
+async def _insert_all(collection, batches: Iterator[list[dict[str, Any]]], concurrency: int, name: str) -> int:
+    """Insert the batches of documents using concurrent workers, returns the number inserted.
+
+    Documents that already exist are skipped, any other error stops the restore.
+    """
+    inserted = 0
+    next_log = _LOG_EVERY_DOCS
+
+    async def _worker() -> None:
+        nonlocal inserted, next_log
+        # the workers share the iterator, reading the next batch does not block
+        for batch in batches:
+            resp = await wrap_blocking_io(
+                lambda x: collection.insert_many(documents=x, options={"ordered": False},
+                                                 partial_failures_allowed=True),
+                batch)
+            errors = [error for error in resp.get("errors", []) if error.get("errorCode") != "DOCUMENT_ALREADY_EXISTS"]
+            if errors:
+                raise ValueError(f"Error restoring {name}: {errors}")
+            inserted += len(resp["status"]["insertedIds"])
+            if inserted >= next_log:
+                logging.info(f"Restored {inserted} {name}")
+                next_log += _LOG_EVERY_DOCS
+
+    # stop the other workers as soon as one fails, rather than carrying on with the rest of the batches
+    tasks = [asyncio.create_task(_worker()) for _ in range(max(concurrency, 1))]
+    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    for task in done:
+        task.result()
+    return inserted
+
+
+def _batches(docs: Iterator[dict[str, Any]], batch_size: int) -> Iterator[list[dict[str, Any]]]:
+    batch: list[dict[str, Any]] = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,203 @@
+"""
+Report on the traces written by the pipeline when it is run with --trace_file, see :mod:`wikichat.utils.tracing`.
+
+An item goes through the pipeline steps one after the other, so the critical path of a trace is the time it waited in
+the queue of each step and the time each step took, with the time of the external calls made by the step broken out.
+Time in the trace that is not in any step, such as waiting to be retried, is reported as untracked. The report adds
+up the critical paths of all the traces, and of the slowest traces in the tail, to show which parts of which stages
+the time goes to.
+"""
+import glob
+import json
+import logging
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from wikichat.commands.model import TraceReportArgs
+from wikichat.utils.tracing import Span, read_spans, SPAN_KIND_TRACE, SPAN_KIND_QUEUE, SPAN_KIND_STEP
+
+_UNTRACKED = ("(untracked)", "")
+
+
+# ======================================================================================================================
+# Commands
+# ======================================================================================================================
+
+async def trace_report(args: TraceReportArgs) -> None:
+    paths = [args.file] + sorted(glob.glob(f"{glob.escape(args.file)}.shard-*"))
+    spans: list[Span] = [span for path in paths for span in read_spans(path)]
+    logging.info(f"Read {len(spans)} spans from {paths}")
+
+    traces = critical_paths(spans)
+    if not traces:
+        raise ValueError(f"No complete traces in {paths}, was the pipeline run with --trace_file?")
+
+    report = trace_report_data(traces, args.tail_percentile, args.slowest)
+    print(_describe_trace_report(report))
+    if args.json_file:
+        with open(args.json_file, mode='w') as file:
+            json.dump(report, file, indent=2)
+        logging.info(f"Wrote JSON report to {args.json_file}")
+
+
+@dataclass
+class TracePath:
+    """Critical path of one trace, seconds in each (stage, part) where part is queue, self, or a client call"""
+    trace_id: str
+    name: str
+    total_secs: float
+    error: str = ""
+    parts: dict[tuple[str, str], float] = field(default_factory=dict)
+
+
+def critical_paths(spans: list[Span]) -> list[TracePath]:
+    """The critical path of each trace that has finished, traces still in the pipeline have no trace span"""
+    by_trace: dict[str, list[Span]] = defaultdict(list)
+    for span in spans:
+        by_trace[span.trace_id].append(span)
+
+    paths: list[TracePath] = []
+    for trace_id, trace_spans in by_trace.items():
+        root = next((span for span in trace_spans if span.kind == SPAN_KIND_TRACE), None)
+        if root is None:
+            continue
+        children: dict[str, list[Span]] = defaultdict(list)
+        for span in trace_spans:
+            children[span.parent_id].append(span)
+
+        path = TracePath(trace_id=trace_id, name=root.name, total_secs=root.duration_secs,
+                         error=root.attributes.get("error", ""))
+        tracked = 0.0
+        for span in children[root.span_id]:
+            if span.kind == SPAN_KIND_QUEUE:
+                _add(path, (span.name, "queue"), span.duration_secs)
+            elif span.kind == SPAN_KIND_STEP:
+                client_secs = _client_secs(span, children)
+                for part, secs in client_secs.items():
+                    _add(path, (span.name, part), secs)
+                _add(path, (span.name, "self"), max(span.duration_secs - sum(client_secs.values()), 0.0))
+            else:
+                continue
+            tracked += span.duration_secs
+        if root.duration_secs - tracked > 0:
+            _add(path, _UNTRACKED, root.duration_secs - tracked)
+        paths.append(path)
+    return paths
+
+
+def trace_report_data(traces: list[TracePath], tail_percentile: float, slowest: int) -> dict:
+    """Time in each part of the critical path for all the traces and for the tail, and the slowest traces"""
+    totals = np.asarray([trace.total_secs for trace in traces])
+    tail_secs = float(np.percentile(totals, tail_percentile))
+    tail = [trace for trace in traces if trace.total_secs >= tail_secs]
+    slowest_traces = sorted(traces, key=lambda trace: trace.total_secs, reverse=True)[:slowest]
+
+    return {
+        "traces": len(traces),
+        "failed": sum(1 for trace in traces if trace.error),
+        "total_ms": _latency_percentiles(totals.tolist()),
+        "tail_percentile": tail_percentile,
+        "tail_traces": len(tail),
+        "tail_threshold_ms": round(tail_secs * 1000, 2),
+        "critical_path": _breakdown(traces),
+        "tail_critical_path": _breakdown(tail),
+        "slowest": [
+            {
+                "trace_id": trace.trace_id,
+                "name": trace.name,
+                "total_ms": round(trace.total_secs * 1000, 2),
+                "error": trace.error,
+                "top_parts": [
+                    {"stage": stage, "part": part, "ms": round(secs * 1000, 2)}
+                    for (stage, part), secs in sorted(trace.parts.items(), key=lambda x: x[1], reverse=True)[:3]
+                ]
+            }
+            for trace in slowest_traces
+        ]
+    }
+
+
+# ======================================================================================================================
+# Helpers
+# ======================================================================================================================
+
+def _add(path: TracePath, key: tuple[str, str], secs: float) -> None:
+    path.parts[key] = path.parts.get(key, 0.0) + secs
+
+
+def _client_secs(step_span: Span, children: dict[str, list[Span]]) -> dict[str, float]:
+    """Seconds the step spent in each kind of client call, calls made at the same time are only counted once"""
+    by_name: dict[str, list[tuple[float, float]]] = defaultdict(list)
+    for span in children[step_span.span_id]:
+        by_name[span.name].append((span.start, span.start + span.duration_secs))
+
+    secs: dict[str, float] = {}
+    for name, intervals in by_name.items():
+        covered, end = 0.0, float("-inf")
+        for start, stop in sorted(intervals):
+            if stop > end:
+                covered += stop - max(start, end)
+                end = stop
+        secs[name] = covered
+    return secs
+
+
+def _breakdown(traces: list[TracePath]) -> list[dict]:
+    """Each part of the critical path with its share of the total time and its latency in the traces that had it"""
+    part_secs: dict[tuple[str, str], list[float]] = defaultdict(list)
+    for trace in traces:
+        for key, secs in trace.parts.items():
+            part_secs[key].append(secs)
+    total = sum(trace.total_secs for trace in traces) or 1.0
+
+    breakdown = [
+        {
+            "stage": stage,
+            "part": part,
+            "share": round(sum(secs) / total, 4),
+            "mean_ms_per_trace": round(sum(secs) / len(traces) * 1000, 2),
+            **{f"{name}_ms": value for name, value in _latency_percentiles(secs).items()}
+        }
+        for (stage, part), secs in part_secs.items()
+    ]
+    return sorted(breakdown, key=lambda row: row["share"], reverse=True)
+
+
+def _latency_percentiles(latencies_secs: list[float]) -> dict[str, float]:
+    if not latencies_secs:
+        return {"p50": 0.0, "p90": 0.0, "p99": 0.0, "max": 0.0}
+    latencies_ms = np.asarray(latencies_secs) * 1000
+    p50, p90, p99 = np.percentile(latencies_ms, [50, 90, 99])
+    return {"p50": round(float(p50), 2), "p90": round(float(p90), 2), "p99": round(float(p99), 2),
+            "max": round(float(latencies_ms.max()), 2)}
+
+
+def _describe_trace_report(report: dict) -> str:
+    total = report["total_ms"]
+    lines = [
+        f"Trace report traces={report['traces']} failed={report['failed']} total p50={total['p50']}ms "
+        f"p90={total['p90']}ms p99={total['p99']}ms max={total['max']}ms"
+    ]
+
+    def _table(title: str, breakdown: list[dict]) -> None:
+        lines.append("")
+        lines.append(title)
+        lines.append(f"{'stage':>20} {'part':>36} {'share':>7} {'mean (ms)':>10} {'p50 (ms)':>10} {'p99 (ms)':>10} "
+                     f"{'max (ms)':>10}")
+        for row in breakdown:
+            lines.append(f"{row['stage']:>20} {row['part']:>36} {row['share']:>7.1%} {row['mean_ms_per_trace']:>10.2f} "
+                         f"{row['p50_ms']:>10.2f} {row['p99_ms']:>10.2f} {row['max_ms']:>10.2f}")
+
+    _table("Critical path, all traces:", report["critical_path"])
+    _table(f"Critical path, traces at or above p{report['tail_percentile']:g} "
+           f"({report['tail_traces']} traces >= {report['tail_threshold_ms']}ms):", report["tail_critical_path"])
+
+    lines.append("")
+    lines.append("Slowest traces:")
+    for trace in report["slowest"]:
+        parts = ", ".join(f"{part['stage']} {part['part']} {part['ms']}ms" for part in trace["top_parts"])
+        error = f" error={trace['error']}" if trace["error"] else ""
+        lines.append(f"{trace['total_ms']:>10.2f}ms {trace['name']}{error} - {parts}")
+    return "\n".join(lines)
@@ -10,8 +10,8 @@ load_dotenv()
 # Add the parent directory of 'wikichat' to the system path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from wikichat.processing.embeddings import get_embeddings  # Adjust the import based on your project structure
 from wikichat.database_setup import ASTRA_DB, EMBEDDINGS_COLLECTION, METADATA_COLLECTION, SUGGESTIONS_COLLECTION
+from wikichat.utils import wrap_blocking_io
 
 # Access environment variables securely
 ASTRA_DB_APPLICATION_TOKEN = os.getenv("ASTRA_DB_APPLICATION_TOKEN")
@@ -48,6 +48,9 @@ def create_collection(collection_name, dimension=None):
 
 # Function to process articles and get embeddings
 async def process_and_embed_articles(articles: list[str]) -> None:
+    # delayed import, wikichat.processing imports this module
+    from wikichat.processing.embeddings import get_embeddings
+
     try:
         embeddings, embedding_dimension = await get_embeddings(articles)
         logging.info(f"Received {len(embeddings)} embeddings with dimension {embedding_dimension}")
@@ -55,7 +58,7 @@ async def process_and_embed_articles(articles: list[str]) -> None:
         # Truncate embeddings to 1000 dimensions if necessary
         if embedding_dimension > 1000:
             logging.warning(f"Truncating embeddings from {embedding_dimension} to 1000 dimensions")
-            embeddings = [embedding[:1000] for embedding in embeddings]
+            embeddings = embeddings[:, :1000]
             embedding_dimension = 1000
 
         # Recreate the collection with the retrieved embedding dimension
@@ -66,16 +69,32 @@ async def process_and_embed_articles(articles: list[str]) -> None:
         for i, embedding in enumerate(embeddings):
             EMBEDDINGS_COLLECTION.insert_one({
                 "article": articles[i],
-                "embedding": embedding
+                "embedding": embedding.tolist()
             })
     except Exception as e:
         logging.error(f"Failed to process and embed articles: {e}")
 
-async def truncate_all_collections():
+async def truncate_rotated_collections():
+    """Remove all the chunks and article metadata, used when rotating the collections"""
+    await wrap_blocking_io(ASTRA_DB.truncate_collection, _ARTICLE_EMBEDDINGS_NAME)
+    await wrap_blocking_io(ASTRA_DB.truncate_collection, _ARTICLE_METADATA_NAME)
+    logging.info(f"Truncated collections {_ARTICLE_EMBEDDINGS_NAME} and {_ARTICLE_METADATA_NAME}")
+
+def iter_embedding_ids():
+    """Page through the ids of every chunk in the embeddings collection, makes blocking calls"""
+    for doc in EMBEDDINGS_COLLECTION.paginated_find(projection={"_id": 1}):
+        yield doc["_id"]
+
+def iter_embedding_chunks():
+    """Page through the (id, url, content) of every chunk in the embeddings collection, makes blocking calls"""
+    for doc in EMBEDDINGS_COLLECTION.paginated_find(projection={"_id": 1, "url": 1, "content": 1}):
+        yield doc["_id"], doc.get("url", ""), doc.get("content", "")
+
+async def truncate_all_collections(dimension: int = 1024):
     delete_collection_if_exists(_ARTICLE_EMBEDDINGS_NAME)
     delete_collection_if_exists(_ARTICLE_METADATA_NAME)
     delete_collection_if_exists(_ARTICLE_SUGGESTIONS_NAME)
-    create_collection(_ARTICLE_EMBEDDINGS_NAME, dimension=1024)
+    create_collection(_ARTICLE_EMBEDDINGS_NAME, dimension=dimension)
     create_collection(_ARTICLE_METADATA_NAME)
     create_collection(_ARTICLE_SUGGESTIONS_NAME)
 
@@ -2,6 +2,8 @@
 The processing steps for ingesting wikipedia articles are in this module.
 """
 import asyncio
+import dataclasses
+import json
 import logging
 from typing import Any
 
@@ -10,9 +12,16 @@ from wikichat import database
 from wikichat.database import SUGGESTIONS_COLLECTION
 from wikichat.processing.articles import load_article, chunk_article, calc_chunk_diff, vectorize_diff, \
     store_article_diff
-from wikichat.processing.model import RECENT_ARTICLES
+from wikichat.processing import embeddings
+from wikichat.processing.embeddings import EMBEDDING_SCHEDULER
+from wikichat.processing.model import RECENT_ARTICLES, ArticleMetadata
+from wikichat.processing.near_duplicates import NEAR_DUPLICATES
+from wikichat.processing.stored_chunks import STORED_CHUNKS
 from wikichat.utils.metrics import METRICS
-from wikichat.utils.pipeline import AsyncPipeline, AsyncStep
+from wikichat.utils.checkpoint import CheckpointStore
+from wikichat.utils.pipeline import AsyncPipeline, AsyncStep, LoadShedding, Priority, SpillStore, RetryScheduler
+from wikichat.utils.retry import RetryPolicy, RetryRule, DeadLetterStore
+from wikichat.utils.tracing import TRACER
 
 """
 Creates the processing pipeline for ingesting wikipedia articles, configuing how many async tasks to run for 
@@ -20,15 +29,136 @@ each step.
 """
 
 
-def create_pipeline(max_items: int = 100, rotate_collection_every: int = 0) -> AsyncPipeline:
-    return AsyncPipeline(max_items=max_items, error_listener=METRICS.listen_to_step_error) \
-        .add_step(AsyncStep(load_article, 10)) \
-        .add_step(AsyncStep(chunk_article, 2)) \
-        .add_step(AsyncStep(calc_chunk_diff, 5)) \
-        .add_step(AsyncStep(vectorize_diff, 5)) \
+def create_pipeline(max_items: int = 100, rotate_collection_every: int = 0, near_duplicates: str = "off",
+                    near_duplicate_threshold: float = 0.95, near_duplicate_min_chars: int = 200,
+                    near_duplicate_max_chunks: int = 100000, embedding_batch_size: int = 96,
+                    embedding_linger_ms: int = 20, embedding_max_requests: int = 8,
+                    embedding_provider: str = "cohere", embedding_provider_options: dict[str, Any] = None,
+                    live_weight: int = 4, bulk_weight: int = 1, shed_queue_depth: int = 1000, shed_lag_secs: float = 30,
+                    spill_file: str = "", checkpoint_file: str = "", checkpoint_steps: list[str] = None,
+                    retry_max_retries: int = 3, retry_base_delay_secs: float = 1.0,
+                    retry_max_delay_secs: float = 60.0, retry_rules_json: str = "", dead_letter_file: str = "",
+                    trace_file: str = "", trace_sample_rate: float = 0.01) -> AsyncPipeline:
+    embeddings.use_provider(embedding_provider, **(embedding_provider_options or {}))
+    NEAR_DUPLICATES.configure(mode=near_duplicates, threshold=near_duplicate_threshold,
+                              min_chars=near_duplicate_min_chars, max_chunks=near_duplicate_max_chunks)
+    EMBEDDING_SCHEDULER.configure(max_batch_size=embedding_batch_size, linger_secs=embedding_linger_ms / 1000,
+                                  max_concurrent_requests=embedding_max_requests)
+    TRACER.configure(path=trace_file, sample_rate=trace_sample_rate)
+
+    lane_weights = {Priority.LIVE: live_weight, Priority.BULK: bulk_weight}
+    # bulk loaded articles are set aside when live edits are backing up, see AsyncPipeline.put_to_first_step
+    load_shedding = LoadShedding(
+        spill_store=SpillStore(path=spill_file,
+                               encode=lambda x: json.dumps(dataclasses.asdict(x)),
+                               decode=lambda x: ArticleMetadata(**json.loads(x))),
+        max_queue_depth=shed_queue_depth,
+        max_live_wait_secs=shed_lag_secs)
+
+    # the items waiting for these steps are kept in the checkpoint file until their results reach the next of these
+    # steps, so they are not lost if we are stopped
+    checkpoint = CheckpointStore(checkpoint_file) if checkpoint_file else None
+    checkpoint_steps = set(checkpoint_steps or [])
+    unknown_steps = checkpoint_steps - {func.__name__ for func in _STEP_FUNCS}
+    if unknown_steps:
+        raise ValueError(f"Unknown checkpoint steps {sorted(unknown_steps)}, "
+                         f"expected some of {[func.__name__ for func in _STEP_FUNCS]}")
+
+    def _durable(func) -> bool:
+        return func.__name__ in checkpoint_steps
+
+    # failed items are retried later without holding a worker, see wikichat.utils.retry
+    retry_scheduler = RetryScheduler(
+        policy=RetryPolicy.from_json(RetryRule(max_retries=retry_max_retries, base_delay_secs=retry_base_delay_secs,
+                                               max_delay_secs=retry_max_delay_secs),
+                                     retry_rules_json),
+        dead_letters=DeadLetterStore(dead_letter_file) if dead_letter_file else None,
+        listener=_record_retry)
+
+    return AsyncPipeline(max_items=max_items, error_listener=METRICS.listen_to_step_error,
+                         load_shedding=load_shedding, shedding_listener=_record_shedding, checkpoint=checkpoint,
+                         retry_scheduler=retry_scheduler, latency_listener=METRICS.observe_step,
+                         trace_label=_trace_label) \
+        .add_step(AsyncStep(load_article, 10, lane_weights=lane_weights,
+                            checkpoint=checkpoint, durable=_durable(load_article))) \
+        .add_step(AsyncStep(chunk_article, 2, lane_weights=lane_weights,
+                            checkpoint=checkpoint, durable=_durable(chunk_article))) \
+        .add_step(AsyncStep(calc_chunk_diff, 5, lane_weights=lane_weights,
+                            checkpoint=checkpoint, durable=_durable(calc_chunk_diff))) \
+        .add_step(AsyncStep(vectorize_diff, 5, lane_weights=lane_weights,
+                            checkpoint=checkpoint, durable=_durable(vectorize_diff))) \
         .add_last_step(AsyncStep(store_article_diff, 5,
                                  listener=_RotationListener(
-                                     rotate_collection_every) if rotate_collection_every > 0 else None))
+                                     rotate_collection_every) if rotate_collection_every > 0 else None,
+                                 lane_weights=lane_weights,
+                                 checkpoint=checkpoint, durable=_durable(store_article_diff)))
+
+
+_STEP_FUNCS = [load_article, chunk_article, calc_chunk_diff, vectorize_diff, store_article_diff]
+
+
+async def _record_shedding(shed: int, restored: int) -> None:
+    await METRICS.update_load_shedding(shed=shed, restored=restored)
+
+
+async def _record_retry(codes: dict[str, int], retried: int, dead_lettered: int) -> None:
+    await METRICS.update_retries(codes, retried=retried, dead_lettered=dead_lettered)
+
+
+def _trace_label(item: Any) -> str:
+    # articles are put into the first step, a replayed dead letter may be put into a later step
+    return item.url if isinstance(item, ArticleMetadata) else type(item).__name__
+
+
+"""
+Sets up the filter of chunk ids already in the embeddings collection before the pipeline starts. Loads the filter
+saved by the last run if there is one, otherwise scans the collection, unless we know the collection is empty.
+"""
+
+
+async def load_stored_chunks(capacity: int = 0, error_rate: float = 0.01, file: str = "",
+                             collection_empty: bool = False) -> None:
+    STORED_CHUNKS.configure(capacity=capacity, error_rate=error_rate, path=file)
+    if not STORED_CHUNKS.enabled or collection_empty:
+        return
+
+    if await wikichat.utils.wrap_blocking_io(STORED_CHUNKS.load):
+        logging.info(f"Loaded stored chunk filter from {file} with {len(STORED_CHUNKS)} chunks")
+        return
+
+    logging.info("Building stored chunk filter by scanning the embeddings collection")
+
+    def _scan():
+        for chunk_id in database.iter_embedding_ids():
+            STORED_CHUNKS.add(chunk_id)
+
+    await wikichat.utils.wrap_blocking_io(_scan)
+    logging.info(f"Built stored chunk filter with {len(STORED_CHUNKS)} chunks")
+
+
+async def load_near_duplicates(collection_empty: bool = False) -> None:
+    """Add the chunks already in the embeddings collection to NEAR_DUPLICATES, until it has max_chunks of them.
+
+    Call after create_pipeline, which configures the index.
+    """
+    if not NEAR_DUPLICATES.enabled or collection_empty:
+        return
+
+    logging.info("Building near duplicate index by scanning the embeddings collection")
+
+    def _scan():
+        for chunk_id, url, content in database.iter_embedding_chunks():
+            if len(NEAR_DUPLICATES) >= NEAR_DUPLICATES.max_chunks:
+                break
+            NEAR_DUPLICATES.add(chunk_id, url, content)
+
+    await wikichat.utils.wrap_blocking_io(_scan)
+    logging.info(f"Built near duplicate index with {len(NEAR_DUPLICATES)} chunks")
+
+
+async def save_stored_chunks() -> None:
+    if await wikichat.utils.wrap_blocking_io(STORED_CHUNKS.save):
+        logging.info(f"Saved stored chunk filter to {STORED_CHUNKS.path} with {len(STORED_CHUNKS)} chunks")
 
 
 """
@@ -68,6 +198,10 @@ class _RotationListener:
             # if we are in the _rotate_lock all other workers are waiting for us to finish
             # so we can safely rotate the collections, which just means truncating them and clearing the recent articles
             await database.truncate_rotated_collections()
+            # the chunks we have fingerprints and ids for are gone
+            NEAR_DUPLICATES.clear()
+            STORED_CHUNKS.clear()
+            await save_stored_chunks()
 
             # Change suggested articles to point to the new collection
             # and clear the list of suggestions, they are not in the new collection.
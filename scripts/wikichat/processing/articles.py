@@ -1,110 +1,178 @@
-import hashlib
 import json
 import logging
 from datetime import datetime
 
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+import numpy as np
 
 import wikichat.utils
 from wikichat.database import EMBEDDINGS_COLLECTION, METADATA_COLLECTION, SUGGESTIONS_COLLECTION
 from wikichat.processing import embeddings, wikipedia
+from wikichat.processing.near_duplicates import NEAR_DUPLICATES, NearDuplicateMode
+from wikichat.processing.splitter import TextSplitter
+from wikichat.processing.stored_chunks import STORED_CHUNKS
 from wikichat.processing.model import ArticleMetadata, Article, ChunkedArticle, Chunk, ChunkMetadata, \
     ChunkedArticleDiff, \
     ChunkedArticleMetadataOnly, VectoredChunkedArticleDiff, VectoredChunk, EmbeddingDocument, RECENT_ARTICLES, \
     RecentArticles
 from wikichat.utils.metrics import METRICS
-from wikichat.utils.pipeline import AsyncPipeline
+from wikichat.utils.pipeline import AsyncPipeline, Priority
 import logging
 from wikichat.processing.embeddings import get_embeddings
 from wikichat.database_setup import EMBEDDINGS_COLLECTION, METADATA_COLLECTION, SUGGESTIONS_COLLECTION
 from wikichat.utils.metrics import METRICS
 
 
-TEXT_SPLITTER = RecursiveCharacterTextSplitter(chunk_size=1024, chunk_overlap=200, length_function=len)
+TEXT_SPLITTER = TextSplitter(chunk_size=1024, chunk_overlap=200)
 
 async def load_article(meta):
     return await wikipedia.scrape_article(meta)
 
 async def chunk_article(article):
-    chunks = TEXT_SPLITTER.split_text(article.content)
+    chunks = TEXT_SPLITTER.split_and_hash(article.content)
     logging.debug(f"Split article {article.metadata.url} into {len(chunks)} chunks")
-    hashes = [hashlib.sha256(chunk.encode('utf-8')).hexdigest() for chunk in chunks]
     await METRICS.update_chunks(chunks_created=len(chunks))
     return ChunkedArticle(
         article=article,
-        chunks=[Chunk(content=chunk, metadata=ChunkMetadata(index=idx, length=len(chunk), hash=chunk_hash)) for idx, (chunk, chunk_hash) in enumerate(zip(chunks, hashes))]
+        chunks=[Chunk(content=chunk, metadata=ChunkMetadata(index=idx, length=len(chunk), hash=chunk_hash)) for idx, (chunk, chunk_hash) in enumerate(chunks)]
     )
 
 async def calc_chunk_diff(chunked_article):
     new_metadata = ChunkedArticleMetadataOnly.from_chunked_article(chunked_article)
     logging.debug(f"Calculating chunk delta for article {chunked_article.article.metadata.url}")
-    resp = await wikichat.utils.wrap_blocking_io(lambda x: METADATA_COLLECTION.find_one(filter={"_id": x}), new_metadata._id)
+    with METRICS.timer("astra", "metadata.find_one"):
+        resp = await wikichat.utils.wrap_blocking_io(lambda x: METADATA_COLLECTION.find_one(filter={"_id": x}), new_metadata._id)
     prev_metadata_doc = resp["data"]["document"]
+    if prev_metadata_doc:
+        await METRICS.update_database(articles_read=1)
+    article_diff = diff_chunks(chunked_article, new_metadata, prev_metadata_doc)
+    await METRICS.update_chunks(chunk_diff_new=len(article_diff.new_chunks), chunk_diff_deleted=len(article_diff.deleted_chunks), chunk_diff_unchanged=len(article_diff.unchanged_chunks))
+    return article_diff
+
+def diff_chunks(chunked_article, new_metadata, prev_metadata_doc):
+    """Compare the chunks with the metadata document stored the last time we saw the article, if there was one.
+    This is the CPU heavy part of calc_chunk_diff."""
     if not prev_metadata_doc:
         logging.debug(f"No previous metadata, all chunks are new")
-        await METRICS.update_chunks(chunk_diff_new=len(chunked_article.chunks))
         return ChunkedArticleDiff(chunked_article=chunked_article, new_chunks=chunked_article.chunks)
-    await METRICS.update_database(articles_read=1)
     prev_metadata = ChunkedArticleMetadataOnly.from_dict(prev_metadata_doc)
     logging.debug(f"Found previous metadata with {len(prev_metadata.chunks_metadata)} chunks, comparing")
     new_chunks = [chunk for chunk in chunked_article.chunks if chunk.metadata.hash not in prev_metadata.chunks_metadata.keys()]
     deleted_chunks = [chunk_meta for chunk_meta in prev_metadata.chunks_metadata.values() if chunk_meta.hash not in new_metadata.chunks_metadata.keys()]
     unchanged_chunks = [chunk for chunk in chunked_article.chunks if chunk.metadata.hash in prev_metadata.chunks_metadata.keys()]
-    await METRICS.update_chunks(chunk_diff_new=len(new_chunks), chunk_diff_deleted=len(deleted_chunks), chunk_diff_unchanged=len(unchanged_chunks))
     logging.debug(f"Found {len(new_chunks)} new chunks, {len(deleted_chunks)} deleted chunks and {len(unchanged_chunks)} unchanged chunks")
-    return ChunkedArticleDiff(chunked_article=chunked_article, new_chunks=new_chunks, deleted_chunks=deleted_chunks, unchanged_chunks=unchanged_chunks)
+    return ChunkedArticleDiff(chunked_article=chunked_article, new_chunks=new_chunks, deleted_chunks=deleted_chunks, unchanged_chunks=unchanged_chunks,
+                              updated_at=prev_metadata.updated_at)
 
 # In wikichat/processing/articles.py
 
 async def vectorize_diff(article_diff):
-    logging.debug(f"Getting embeddings for article {article_diff.chunked_article.article.metadata.url} which has {len(article_diff.new_chunks)} new chunks")
-    vectors, embedding_dimension = await get_embeddings([chunk.content for chunk in article_diff.new_chunks])
+    url = article_diff.chunked_article.article.metadata.url
+    new_chunks = await _remove_stored_chunks(url, article_diff.new_chunks)
+    chunks_to_vectorize, aliased_vectors = await _match_near_duplicates(url, new_chunks)
+    logging.debug(f"Getting embeddings for article {url} which has {len(article_diff.new_chunks)} new chunks, {len(chunks_to_vectorize)} need vectorizing")
+    vectors = np.empty((0, 0), dtype=np.float32)
+    if chunks_to_vectorize:
+        vectors, embedding_dimension = await get_embeddings([chunk.content for chunk in chunks_to_vectorize])
     await METRICS.update_chunks(chunks_vectorized=len(vectors))
 
-    try:
-        non_zero_vectors = [vector for vector in vectors if isinstance(vector, list) and any(x != 0 for x in vector)]
-    except Exception as e:
-        logging.error(f"Error processing vectors: {e}")
-        non_zero_vectors = []
-
-    zero_vector_count = len(vectors) - len(non_zero_vectors)
-    if zero_vector_count > 0:
-        logging.debug(f"Skipping article {article_diff.chunked_article.article.metadata.url} because {zero_vector_count} zero vectors were returned")
-        for i in range(len(vectors)):
-            if isinstance(vectors[i], list) and all([x == 0 for x in vectors[i]]):
-                logging.debug(f"Zero vector for chunk in {article_diff.chunked_article.article.metadata.url} content= {article_diff.new_chunks[i].content}")
+    zero_rows = zero_vector_rows(vectors)
+    if zero_rows.size > 0:
+        logging.debug(f"Skipping article {url} because {zero_rows.size} zero vectors were returned")
+        for i in zero_rows:
+            logging.debug(f"Zero vector for chunk in {url} content= {chunks_to_vectorize[i].content}")
         await METRICS.update_article(zero_vectors=1)
         return None
+    return vectored_diff(article_diff, new_chunks, chunks_to_vectorize, vectors, aliased_vectors)
 
-    vectored_chunks = [
-        {
-            "vector": vector,
-            "chunked_article": article_diff.chunked_article,
-            "chunk": chunk
-        }
-        for vector, chunk in zip(non_zero_vectors, article_diff.new_chunks)
-    ]
-
-    try:
-        EMBEDDINGS_COLLECTION.insert_many(vectored_chunks)
-        logging.info(f"Inserted {len(vectored_chunks)} vectored chunks into the database")
-    except Exception as e:
-        logging.error(f"Failed to insert vectored chunks into the database: {e}")
+def zero_vector_rows(vectors):
+    """The rows of the vectors that are all zeros, a row of all zeros means Cohere could not vectorize the chunk"""
+    return np.flatnonzero(~vectors.any(axis=1))
 
+def vectored_diff(article_diff, new_chunks, chunks_to_vectorize, vectors, aliased_vectors):
+    """Pair the new chunks with their vectors, from the embeddings or the near duplicates they are aliased to"""
+    # keep the new chunks in article order, the first few are used for suggested questions
+    vectors_by_hash = dict(aliased_vectors)
+    vectors_by_hash.update((chunk.metadata.hash, vector) for chunk, vector in zip(chunks_to_vectorize, vectors))
     return VectoredChunkedArticleDiff(
         chunked_article=article_diff.chunked_article,
         new_chunks=[
-            VectoredChunk(vector=vector, chunked_article=article_diff.chunked_article, chunk=chunk)
-            for vector, chunk in zip(non_zero_vectors, article_diff.new_chunks)
+            VectoredChunk(vector=vectors_by_hash[chunk.metadata.hash], chunked_article=article_diff.chunked_article, chunk=chunk)
+            for chunk in new_chunks
+            if chunk.metadata.hash in vectors_by_hash
         ],
-        deleted_chunks=article_diff.deleted_chunks
+        deleted_chunks=article_diff.deleted_chunks,
+        updated_at=article_diff.updated_at
     )
 
+async def _remove_stored_chunks(url, chunks):
+    """Remove the chunks that are already in the database, so we do not vectorize them only to have the insert fail.
+    The filter can have false positives so we check the database for any chunks it thinks are stored."""
+    possible_ids = [chunk.metadata.hash for chunk in chunks if chunk.metadata.hash in STORED_CHUNKS]
+    if not possible_ids:
+        return chunks
+
+    batch_size = 20
+    stored_ids = set()
+    for batch in wikichat.utils.batch_list(possible_ids, batch_size):
+        with METRICS.timer("astra", "embeddings.find"):
+            resp = await wikichat.utils.wrap_blocking_io(lambda x: EMBEDDINGS_COLLECTION.find(filter={"_id": {"$in": x}}, projection={"_id": 1}, options={"limit": batch_size}), batch)
+        stored_ids.update(doc["_id"] for doc in resp["data"]["documents"])
+    await METRICS.update_stored_chunks(possible_duplicates=len(possible_ids), confirmed_duplicates=len(stored_ids), false_positives=len(possible_ids) - len(stored_ids))
+    if not stored_ids:
+        return chunks
+
+    # same as when the insert fails with DOCUMENT_ALREADY_EXISTS in insert_vectored_chunks
+    logging.debug(f"Found {len(stored_ids)} chunks from {url} already stored, will not vectorize them. Chunks {stored_ids}")
+    await METRICS.update_database(chunk_collision=len(stored_ids))
+    existing_chunk_logger = logging.getLogger('existing_chunks')
+    for chunk in chunks:
+        if chunk.metadata.hash in stored_ids:
+            existing_chunk_logger.warning({"_id": chunk.metadata.hash, "url": url, "chunk_index": chunk.metadata.index, "content": chunk.content})
+    return [chunk for chunk in chunks if chunk.metadata.hash not in stored_ids]
+
+async def _match_near_duplicates(url, chunks):
+    """Split the chunks into the chunks we need to vectorize, and the vectors we can reuse from stored chunks
+    they are near duplicates of. Chunks skipped because they are near duplicates are in neither."""
+    if not NEAR_DUPLICATES.enabled:
+        return chunks, {}
+
+    matches = {}
+    for chunk in chunks:
+        match = NEAR_DUPLICATES.find(chunk.content, exclude_url=url)
+        if match:
+            logging.debug(f"Chunk {chunk.metadata.hash} in {url} is a near duplicate of {match.chunk_hash} in {match.url} similarity {match.similarity}")
+            matches[chunk.metadata.hash] = match
+    await METRICS.update_near_duplicates(chunks_checked=len(chunks), chunks_matched=len(matches))
+    if not matches:
+        return chunks, {}
+
+    if NEAR_DUPLICATES.mode == NearDuplicateMode.SKIP:
+        await METRICS.update_near_duplicates(chunks_skipped=len(matches))
+        return [chunk for chunk in chunks if chunk.metadata.hash not in matches], {}
+
+    # The stored chunk may have been deleted since we indexed it, if so we have to vectorize the new chunk
+    stored_vectors = await _read_stored_vectors({match.chunk_hash for match in matches.values()})
+    aliased_vectors = {chunk_hash: stored_vectors[match.chunk_hash] for chunk_hash, match in matches.items() if match.chunk_hash in stored_vectors}
+    await METRICS.update_near_duplicates(chunks_aliased=len(aliased_vectors), alias_misses=len(matches) - len(aliased_vectors))
+    return [chunk for chunk in chunks if chunk.metadata.hash not in aliased_vectors], aliased_vectors
+
+async def _read_stored_vectors(chunk_hashes):
+    batch_size = 20
+    vectors = {}
+    for batch in wikichat.utils.batch_list(list(chunk_hashes), batch_size):
+        with METRICS.timer("astra", "embeddings.find"):
+            resp = await wikichat.utils.wrap_blocking_io(lambda x: EMBEDDINGS_COLLECTION.find(filter={"_id": {"$in": x}}, projection={"$vector": 1}, options={"limit": batch_size}), batch)
+        for doc in resp["data"]["documents"]:
+            vectors[doc["_id"]] = np.asarray(doc["$vector"], dtype=np.float32)
+    return vectors
+
 
 async def store_article_diff(article_diff):
-    await update_article_metadata(article_diff)
+    # the metadata is written last, so its updated_at only changes once the chunks have, and a search cached in
+    # between is seen to be out of date
     await insert_vectored_chunks(article_diff.new_chunks)
     await delete_vectored_chunks(article_diff.deleted_chunks)
+    await update_article_metadata(article_diff)
     return article_diff
 
 async def insert_vectored_chunks(vectored_chunks):
@@ -116,7 +184,8 @@ async def insert_vectored_chunks(vectored_chunks):
         start_batch = datetime.now()
         article_embeddings = list(map(EmbeddingDocument.from_vectored_chunk, batch))
         logging.debug(f"Inserting batch number {batch_count} with size {len(batch)}")
-        resp = await wikichat.utils.wrap_blocking_io(lambda x: EMBEDDINGS_COLLECTION.insert_many(documents=x, options={"ordered": False}, partial_failures_allowed=True), [article_embedding.to_dict() for article_embedding in article_embeddings])
+        with METRICS.timer("astra", "embeddings.insert_many"):
+            resp = await wikichat.utils.wrap_blocking_io(lambda x: EMBEDDINGS_COLLECTION.insert_many(documents=x, options={"ordered": False}, partial_failures_allowed=True), [article_embedding.to_dict() for article_embedding in article_embeddings])
         errors = resp.get("errors", [])
         exists_errors = [error for error in errors if error.get("errorCode") == "DOCUMENT_ALREADY_EXISTS"]
         if exists_errors:
@@ -131,6 +200,11 @@ async def insert_vectored_chunks(vectored_chunks):
         if len(errors) != len(exists_errors):
             logging.error(f"Got non DOCUMENT_ALREADY_EXISTS errors, stopping: {errors}")
             raise ValueError(json.dumps(errors))
+        for doc_id in resp["status"]["insertedIds"]:
+            STORED_CHUNKS.add(doc_id)
+        evictions = sum(NEAR_DUPLICATES.add(article_embedding._id, article_embedding.url, article_embedding.content) for article_embedding in article_embeddings)
+        if evictions:
+            await METRICS.update_near_duplicates(index_evictions=evictions)
         logging.debug(f"Finished inserting batch number {batch_count} duration {datetime.now() - start_batch}")
     await METRICS.update_database(chunks_inserted=len(vectored_chunks))
     logging.debug(f"Finished inserting {len(vectored_chunks)} article embeddings, total duration {datetime.now() - start_all}")
@@ -142,7 +216,11 @@ async def delete_vectored_chunks(chunks):
     for batch_count, batch in wikichat.utils.batch_list(chunks, batch_size, enumerate_batches=True):
         start_batch = datetime.now()
         logging.debug(f"Deleting batch number {batch_count} with size {len(batch)}")
-        resp = await wikichat.utils.wrap_blocking_io(lambda x: EMBEDDINGS_COLLECTION.delete_many(filter={"_id": {"$in": x}}), [chunk.hash for chunk in batch])
+        with METRICS.timer("astra", "embeddings.delete_many"):
+            resp = await wikichat.utils.wrap_blocking_io(lambda x: EMBEDDINGS_COLLECTION.delete_many(filter={"_id": {"$in": x}}), [chunk.hash for chunk in batch])
+        for chunk in batch:
+            NEAR_DUPLICATES.remove(chunk.hash)
+            STORED_CHUNKS.remove(chunk.hash)
         logging.debug(f"Finished deleting batch number {batch_count} duration {datetime.now() - start_batch}")
     await METRICS.update_database(chunks_deleted=len(chunks))
     logging.debug(f"Finished deleting {len(chunks)} article embeddings total duration {datetime.now() - start_all}")
@@ -150,15 +228,17 @@ async def delete_vectored_chunks(chunks):
 async def update_article_metadata(vectored_diff):
     new_metadata = ChunkedArticleMetadataOnly.from_vectored_diff(vectored_diff)
     logging.debug(f"Updating article metadata for article url {new_metadata.article_metadata.url}")
-    await wikichat.utils.wrap_blocking_io(lambda x: METADATA_COLLECTION.find_one_and_replace(filter={"_id": x._id}, replacement=x.to_dict(), options={"upsert": True}), new_metadata)
+    with METRICS.timer("astra", "metadata.find_one_and_replace"):
+        await wikichat.utils.wrap_blocking_io(lambda x: METADATA_COLLECTION.find_one_and_replace(filter={"_id": x._id}, replacement=x.to_dict(), options={"upsert": True}), new_metadata)
     recent_articles = await RECENT_ARTICLES.update_and_clone(new_metadata)
-    await wikichat.utils.wrap_blocking_io(lambda x: SUGGESTIONS_COLLECTION.find_one_and_replace(filter={"_id": x._id}, replacement=x.to_dict(), options={"upsert": True}), recent_articles)
+    with METRICS.timer("astra", "suggestions.find_one_and_replace"):
+        await wikichat.utils.wrap_blocking_io(lambda x: SUGGESTIONS_COLLECTION.find_one_and_replace(filter={"_id": x._id}, replacement=x.to_dict(), options={"upsert": True}), recent_articles)
     await METRICS.update_database(articles_inserted=1)
     await METRICS.update_article(recent_url=new_metadata.article_metadata.url)
 
-async def process_article_metadata(pipeline, article_metadata):
+async def process_article_metadata(pipeline, article_metadata, priority: Priority = Priority.LIVE):
     for metadata in article_metadata:
-        if not await pipeline.put_to_first_step(metadata):
+        if not await pipeline.put_to_first_step(metadata, priority):
             logging.info(f"Reached max number of items to process ({pipeline.max_items}), stopping.")
             return False
     return True
@@ -0,0 +1,156 @@
+"""
+Services that turn texts into embedding vectors, see :func:`wikichat.processing.embeddings.get_embeddings`.
+
+* ``cohere``: the Cohere API, this is what the wikichat application uses.
+* ``local``: hashes the words of each text into a vector on the CPU, no network or API key needed. It can simulate
+  the latency, errors and rate limits of a remote service so we can load test and tune the pipeline offline.
+
+The local vectors are not semantic, texts are similar when they share words, but they are deterministic so the same
+text always gets the same vector and searches give repeatable results.
+
+This module should not import other parts of the wikichat application.
+"""
+import asyncio
+import functools
+import hashlib
+import logging
+import os
+import random
+from enum import Enum
+
+import numpy as np
+from aiohttp import ClientResponseError, RequestInfo
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+
+COHERE_EMBEDDING_MODEL = 'embed-english-v3.0'
+# Same dimension as the Cohere model so the local vectors fit the collections
+LOCAL_DIMENSION = 1024
+
+
+class EmbeddingProviderName(str, Enum):
+    COHERE = "cohere"
+    LOCAL = "local"
+
+
+class SimulatedEmbeddingError(RuntimeError):
+    """Raised by the local provider to simulate a request that fails and should not be retried"""
+    pass
+
+
+class EmbeddingProvider:
+    """Makes one embedding request for a batch of texts."""
+
+    name: str = ""
+
+    async def embed(self, texts: list[str], input_type: str) -> np.ndarray:
+        """The vectors for the texts as a float32 matrix with a row per text"""
+        raise NotImplementedError()
+
+    async def close(self) -> None:
+        """Release any connections, the provider can be used again after closing"""
+        pass
+
+
+class CohereProvider(EmbeddingProvider):
+    """Embeds using the Cohere API, the client is created when first used so the key is only needed then."""
+
+    name = EmbeddingProviderName.COHERE.value
+
+    def __init__(self, api_key: str = None, model: str = COHERE_EMBEDDING_MODEL):
+        self.model: str = model
+        self._api_key: str | None = api_key
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import cohere
+
+            api_key = self._api_key or os.getenv("COHERE_API_KEY")
+            if not api_key:
+                raise ValueError("COHERE_API_KEY is not set in the environment variables")
+            self._client = cohere.AsyncClient(api_key)
+        return self._client
+
+    async def embed(self, texts: list[str], input_type: str) -> np.ndarray:
+        logging.info(f"Requesting embeddings for {len(texts)} texts using model {self.model}")
+        response = await self.client.embed(texts=texts, model=self.model, input_type=input_type)
+        # one contiguous block rather than a python float object per dimension
+        return np.asarray(response.embeddings, dtype=np.float32)
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.close()
+
+
+class LocalProvider(EmbeddingProvider):
+    """Feature hashing of the words in each text, with optional simulated latency, errors and rate limits.
+
+    Each request waits latency_ms plus a random amount up to latency_jitter_ms, then fails with a 429 at
+    rate_limit_rate, which is retried like a real rate limit, or fails with SimulatedEmbeddingError at error_rate.
+    """
+
+    name = EmbeddingProviderName.LOCAL.value
+
+    def __init__(self, dimension: int = LOCAL_DIMENSION, latency_ms: float = 0, latency_jitter_ms: float = 0,
+                 error_rate: float = 0, rate_limit_rate: float = 0, seed: int = 0):
+        if dimension <= 0:
+            raise ValueError(f"Local embedding dimension must be greater than 0, got {dimension}")
+        if not 0 <= error_rate <= 1 or not 0 <= rate_limit_rate <= 1:
+            raise ValueError(f"Local error_rate {error_rate} and rate_limit_rate {rate_limit_rate} must be "
+                             f"between 0 and 1")
+        self.dimension: int = dimension
+        self.latency_ms: float = latency_ms
+        self.latency_jitter_ms: float = latency_jitter_ms
+        self.error_rate: float = error_rate
+        self.rate_limit_rate: float = rate_limit_rate
+        self._random = random.Random(seed)
+
+    async def embed(self, texts: list[str], input_type: str) -> np.ndarray:
+        delay_ms = self.latency_ms + self._random.uniform(0, self.latency_jitter_ms)
+        if delay_ms > 0:
+            await asyncio.sleep(delay_ms / 1000)
+
+        draw = self._random.random()
+        if draw < self.rate_limit_rate:
+            raise _rate_limit_error()
+        if draw < self.rate_limit_rate + self.error_rate:
+            raise SimulatedEmbeddingError(f"Simulated error embedding {len(texts)} texts")
+
+        # queries and documents use the same vectors so they can be compared
+        return hash_embeddings(texts, self.dimension)
+
+
+def hash_embeddings(texts: list[str], dimension: int = LOCAL_DIMENSION) -> np.ndarray:
+    """Unit vectors with a row per text, each word adds +1 or -1 to the dimension it hashes to."""
+    vectors = np.zeros((len(texts), dimension), dtype=np.float32)
+    for row, text in enumerate(texts):
+        # an empty text still gets a vector, a zero vector is treated as an error by the pipeline
+        for word in text.lower().split() or [""]:
+            position, sign = _word_feature(word, dimension)
+            vectors[row, position] += sign
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def create_provider(name: EmbeddingProviderName | str = EmbeddingProviderName.COHERE,
+                    **local_options) -> EmbeddingProvider:
+    """Create the named provider, local_options are passed to LocalProvider and ignored for Cohere"""
+    match EmbeddingProviderName(name):
+        case EmbeddingProviderName.LOCAL:
+            return LocalProvider(**local_options)
+        case _:
+            return CohereProvider()
+
+
+@functools.lru_cache(maxsize=1_000_000)
+def _word_feature(word: str, dimension: int) -> tuple[int, float]:
+    value = int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'big')
+    return (value >> 1) % dimension, 1.0 if value & 1 else -1.0
+
+
+def _rate_limit_error() -> ClientResponseError:
+    url = URL("http://localhost/embed")
+    request_info = RequestInfo(url=url, method="POST", headers=CIMultiDictProxy(CIMultiDict()), real_url=url)
+    return ClientResponseError(request_info, (), status=429, message="Too Many Requests (simulated)")
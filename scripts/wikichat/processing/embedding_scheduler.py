@@ -0,0 +1,126 @@
+"""
+Packs the texts from every concurrent caller of :func:`wikichat.processing.embeddings.get_embeddings` into
+embedding requests.
+
+Without this each call to vectorize an article is its own request, a one chunk edit from the listener costs a
+round trip and an article with hundreds of chunks goes over the number of texts the provider accepts in a request.
+The scheduler keeps one open batch per input type. A caller's texts are added to the open batch, which is sent
+when it reaches max_batch_size texts or when it has waited linger_secs for more texts. Callers with more texts than
+fit are split over several batches, which are sent in parallel. Each caller gets back its own vectors, in order,
+once all the batches holding its texts have returned.
+"""
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+import numpy as np
+
+from wikichat.utils.metrics import METRICS
+
+
+@dataclass
+class _Caller:
+    """A call to embed(), its vectors are assembled from the parts sent in each batch"""
+    future: asyncio.Future
+    parts: list[np.ndarray | None] = field(default_factory=list)
+    remaining: int = 0
+
+
+@dataclass
+class _Batch:
+    """Texts to send in one request, and which part of which caller each range of texts is for"""
+    input_type: str
+    texts: list[str] = field(default_factory=list)
+    # (caller, part index, start, end) with start and end the range of texts in the batch
+    slots: list[tuple[_Caller, int, int, int]] = field(default_factory=list)
+    linger_handle: asyncio.TimerHandle | None = None
+
+
+class EmbeddingScheduler:
+
+    def __init__(self, embed_func: Callable[[list[str], str], Awaitable[np.ndarray]], max_batch_size: int = 96,
+                 linger_secs: float = 0.02, max_concurrent_requests: int = 8):
+        """embed_func makes one request and returns a float32 matrix with a row per text"""
+        self._embed_func = embed_func
+        self.configure(max_batch_size=max_batch_size, linger_secs=linger_secs,
+                       max_concurrent_requests=max_concurrent_requests)
+
+    def configure(self, max_batch_size: int = 96, linger_secs: float = 0.02,
+                  max_concurrent_requests: int = 8) -> 'EmbeddingScheduler':
+        if max_batch_size <= 0 or max_concurrent_requests <= 0:
+            raise ValueError(f"max_batch_size {max_batch_size} and max_concurrent_requests "
+                             f"{max_concurrent_requests} must be greater than 0")
+        self.max_batch_size: int = max_batch_size
+        self.linger_secs: float = linger_secs
+        self.max_concurrent_requests: int = max_concurrent_requests
+
+        self._open_batches: dict[str, _Batch] = {}
+        self._send_tasks: set[asyncio.Task] = set()
+        # created when first used so it belongs to the running event loop
+        self._request_semaphore: asyncio.Semaphore | None = None
+        return self
+
+    async def embed(self, texts: list[str], input_type: str) -> np.ndarray:
+        """Vectors for the texts as a float32 matrix with a row per text, in the same order as the texts."""
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+
+        caller = _Caller(future=asyncio.get_running_loop().create_future())
+        offset = 0
+        while offset < len(texts):
+            batch = self._open_batches.get(input_type)
+            if batch is None:
+                batch = self._open_batches[input_type] = _Batch(input_type=input_type)
+
+            take = min(self.max_batch_size - len(batch.texts), len(texts) - offset)
+            batch.slots.append((caller, len(caller.parts), len(batch.texts), len(batch.texts) + take))
+            batch.texts.extend(texts[offset:offset + take])
+            caller.parts.append(None)
+            offset += take
+
+            if len(batch.texts) >= self.max_batch_size:
+                self._send(batch)
+            elif batch.linger_handle is None:
+                batch.linger_handle = asyncio.get_running_loop().call_later(self.linger_secs, self._send, batch)
+
+        caller.remaining = len(caller.parts)
+        await METRICS.update_embeddings(callers=1, split_callers=1 if len(caller.parts) > 1 else 0)
+        return await caller.future
+
+    def _send(self, batch: _Batch) -> None:
+        if batch.linger_handle is not None:
+            batch.linger_handle.cancel()
+            batch.linger_handle = None
+        if self._open_batches.get(batch.input_type) is batch:
+            del self._open_batches[batch.input_type]
+
+        task = asyncio.create_task(self._send_batch(batch))
+        # keep a reference until it is done, see https://docs.python.org/3/library/asyncio-task.html#creating-tasks
+        self._send_tasks.add(task)
+        task.add_done_callback(self._send_tasks.discard)
+
+    async def _send_batch(self, batch: _Batch) -> None:
+        if self._request_semaphore is None:
+            self._request_semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+
+        try:
+            async with self._request_semaphore:
+                logging.debug(f"Sending embedding batch of {len(batch.texts)} texts for {len(batch.slots)} callers")
+                vectors = await self._embed_func(batch.texts, batch.input_type)
+            await METRICS.update_embeddings(requests=1, texts=len(batch.texts), batch_capacity=self.max_batch_size)
+        except Exception as e:
+            await METRICS.update_embeddings(requests=1, failed_requests=1)
+            for caller, _, _, _ in batch.slots:
+                if not caller.future.done():
+                    caller.future.set_exception(e)
+            return
+
+        for caller, part, start, end in batch.slots:
+            if caller.future.done():
+                # cancelled, or another of its batches failed
+                continue
+            caller.parts[part] = vectors[start:end]
+            caller.remaining -= 1
+            if caller.remaining == 0:
+                caller.future.set_result(caller.parts[0] if len(caller.parts) == 1 else np.concatenate(caller.parts))
@@ -1,73 +1,128 @@
 # In wikichat/processing/embeddings.py
 
 import logging
-import os
 import cohere
-from cohere.responses import Embeddings
+import numpy as np
 from dotenv import load_dotenv
 import asyncio
 from aiohttp.client_exceptions import ClientResponseError
 from backoff import on_exception, expo
 
+from wikichat.processing.embedding_providers import EmbeddingProvider, CohereProvider, create_provider
+from wikichat.processing.embedding_scheduler import EmbeddingScheduler
+from wikichat.processing.query_cache import QUERY_CACHE, normalize_query
+from wikichat.utils.metrics import METRICS
+from wikichat.utils.tracing import TRACER
+
 load_dotenv()
 
-# Directly set the environment variable in the script for testing purposes
-os.environ["COHERE_API_KEY"] = "tJ6U31DiRGEa9eQ7BKqwfBhP8pOmx6BU18zFWiUN"  # Replace with your actual API key
+# The Cohere key is read from COHERE_API_KEY when the first request is made, see use_provider() to change provider
+_PROVIDER: EmbeddingProvider = CohereProvider()
 
-# Retrieve the API key from the environment variables
-COHERE_API_KEY = os.getenv("COHERE_API_KEY")
-if not COHERE_API_KEY:
-    raise ValueError("COHERE_API_KEY is not set in the environment variables")
 
+def use_provider(name: str = "cohere", **local_options) -> EmbeddingProvider:
+    """Use the named provider for all embeddings, see wikichat.processing.embedding_providers.create_provider"""
+    global _PROVIDER
+    _PROVIDER = create_provider(name, **local_options)
+    logging.info(f"Using embedding provider {_PROVIDER.name}")
+    return _PROVIDER
 
-# Log the API key for debugging purposes
-logging.basicConfig(level=logging.INFO)
-logging.info(f"Using API Key: {COHERE_API_KEY}")
 
-# Initialize the Cohere client
-COHERE_CLIENT = cohere.AsyncClient(COHERE_API_KEY)
-EMBEDDING_MODEL = 'embed-english-v3.0'
+async def _record_retry(details):
+    await METRICS.update_embeddings(retries=1)
 
-@on_exception(expo, ClientResponseError, max_tries=5, jitter=None)
-async def get_embeddings(texts, input_type='search_document'):
-    try:
-        logging.info(f"Requesting embeddings for {len(texts)} texts using model {EMBEDDING_MODEL}")
-        response = await COHERE_CLIENT.embed(texts=texts, model=EMBEDDING_MODEL, input_type=input_type)
-        embeddings = response.embeddings
-        logging.info(f"Received {len(embeddings)} embeddings with dimension {len(embeddings[0]) if embeddings else 'unknown'}")
 
-        # Verify dimensions
-        embedding_dimension = len(embeddings[0]) if embeddings else 0
+@on_exception(expo, ClientResponseError, max_tries=5, jitter=None, on_backoff=_record_retry)
+async def _embed_batch(texts: list[str], input_type: str) -> np.ndarray:
+    """Makes one embedding request, called by EMBEDDING_SCHEDULER with a batch of texts from one or more callers.
+
+    The client session is shared by all the requests in flight, so it is not closed here.
+    """
+    try:
+        # the batch has texts from several callers, the time each of them waited is traced in get_embeddings
+        with TRACER.detached(), METRICS.timer(_PROVIDER.name, "embed"):
+            embeddings = await _PROVIDER.embed(texts, input_type)
+        if embeddings.ndim != 2 or len(embeddings) != len(texts):
+            raise ValueError(f"Expected {len(texts)} embeddings, got shape {embeddings.shape}")
+        logging.debug(f"Received {embeddings.shape[0]} embeddings with dimension {embeddings.shape[1]}")
+        return embeddings
 
     except cohere.CohereAPIError as e:
         logging.error(f"Cohere API error: {e}")
         raise
+    except ClientResponseError as e:
+        logging.warning(f"Embedding request failed with status {e.status}: {e.message}")
+        raise
     except AssertionError as e:
         logging.error(f"Assertion error: {e}")
         raise
     except Exception as e:
         logging.error("Unexpected error vectorizing texts", exc_info=True)
         raise
-    finally:
-        await COHERE_CLIENT.close()  # Ensure the client session is properly closed
-    
-    return embeddings, embedding_dimension
+
+
+# Configured by wikichat.processing.create_pipeline
+EMBEDDING_SCHEDULER = EmbeddingScheduler(_embed_batch)
+
+
+async def get_embeddings(texts, input_type='search_document'):
+    """Returns the embeddings as one float32 matrix with a row per text, and the embedding dimension
+
+    The texts are sent with the texts from other concurrent callers, see EmbeddingScheduler.
+    """
+    with TRACER.span("embeddings.get_embeddings", texts=len(texts)):
+        embeddings = await EMBEDDING_SCHEDULER.embed(list(texts), input_type)
+    return embeddings, embeddings.shape[1]
+
+
+async def embed_queries(texts: list[str], input_type: str = 'search_query') -> np.ndarray:
+    """Returns the embeddings for the search queries as one float32 matrix with a row per text.
+
+    Queries in QUERY_CACHE are not embedded again, the others are de-duplicated and embedded in one call to
+    get_embeddings. The query is embedded as it was given, the normalised text is only the cache key, so queries
+    that share a cache entry get the vector of the first of them. Use this rather than get_embeddings for queries.
+    """
+    lookup = QUERY_CACHE.reserve(texts, input_type)
+    if lookup.to_embed:
+        try:
+            embedded, _ = await get_embeddings(lookup.texts_to_embed, input_type=input_type)
+        except BaseException as e:
+            QUERY_CACHE.discard(lookup.to_embed, input_type, e)
+            raise
+        evicted = QUERY_CACHE.put(lookup.to_embed, input_type, embedded)
+    else:
+        embedded, evicted = None, 0
+
+    waited = dict(zip(lookup.waiting.keys(), await asyncio.gather(*lookup.waiting.values())))
+    await METRICS.update_query_cache(hits=lookup.hits, misses=len(lookup.to_embed), waits=len(lookup.waiting),
+                                     expired=lookup.expired, evictions=evicted)
+
+    new_vectors = dict(zip(lookup.to_embed, embedded)) if embedded is not None else {}
+    return np.stack([
+        vector if vector is not None else new_vectors.get(key, waited.get(key))
+        for vector, key in zip(lookup.vectors, (normalize_query(text) for text in texts))
+    ]) if texts else np.empty((0, 0), dtype=np.float32)
+
+
+async def close_client():
+    """Close the provider when we have finished embedding, it is opened again if it is used again"""
+    await _PROVIDER.close()
+
 
 # Test function to ensure the API key is valid
 async def test_api_key():
     try:
         logging.info("Testing API key...")
-        response = await COHERE_CLIENT.embed(texts=["test"], model=EMBEDDING_MODEL, input_type='search_document')
-        if response and response.embeddings:
+        embeddings = await _PROVIDER.embed(["test"], input_type='search_document')
+        if embeddings.size:
             logging.info("API key is valid.")
         else:
             logging.error("API key validation failed: No embeddings returned.")
     except cohere.CohereError as e:
         logging.error(f"API key validation failed: {e}")
     finally:
-        await COHERE_CLIENT.close()  # Ensure the client session is properly closed
+        await close_client()  # Ensure the client session is properly closed
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
-    print(f"Using API Key: {COHERE_API_KEY}")  # Print the API key being used
     asyncio.run(test_api_key())
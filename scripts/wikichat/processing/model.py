@@ -4,8 +4,10 @@ This file contains the dataclasses used to process the articles and the classes
 These should be plain data classes, and should not import other parts of the wikichat application.
 """
 import asyncio
+import time
 from dataclasses import dataclass, field, replace
 
+import numpy as np
 from dataclasses_json import config, dataclass_json
 
 
@@ -56,12 +58,15 @@ class ChunkedArticleDiff:
     new_chunks: list[Chunk] = field(default_factory=list)
     deleted_chunks: list[ChunkMetadata] = field(default_factory=list)
     unchanged_chunks: list[Chunk] = field(default_factory=list)
+    # updated_at of the stored metadata, kept if the chunks have not changed
+    updated_at: float = 0.0
 
 
 @dataclass
 class VectoredChunk:
-    """A chunk that has been vectorized"""
-    vector: list[float]
+    """A chunk that has been vectorized, the vector is a float32 array and may be a row of the matrix for all the
+    chunks vectorized with it"""
+    vector: np.ndarray
     chunked_article: ChunkedArticle
     chunk: Chunk
 
@@ -72,6 +77,7 @@ class VectoredChunkedArticleDiff:
     chunked_article: ChunkedArticle
     new_chunks: list[VectoredChunk] = field(default_factory=list)
     deleted_chunks: list[ChunkMetadata] = field(default_factory=list)
+    updated_at: float = 0.0
 
 
 # ======================================================================================================================
@@ -89,6 +95,8 @@ class ChunkedArticleMetadataOnly:
     chunks_metadata: dict[str, ChunkMetadata] = field(default_factory=dict)
     # the recent chunks we can use to build a suggested question for the user
     suggested_question_chunks: list[Chunk] = field(default_factory=list)
+    # time.time() the chunks of the article last changed, the search cache compares it to find out of date results
+    updated_at: float = 0.0
 
     @classmethod
     def from_chunked_article(cls, chunked_article: ChunkedArticle) -> 'ChunkedArticleMetadataOnly':
@@ -109,7 +117,8 @@ class ChunkedArticleMetadataOnly:
             _id=diff.chunked_article.article.metadata.url,
             article_metadata=diff.chunked_article.article.metadata,
             chunks_metadata={chunk.metadata.hash: chunk.metadata for chunk in diff.chunked_article.chunks},
-            suggested_question_chunks=suggested_chunks
+            suggested_question_chunks=suggested_chunks,
+            updated_at=time.time() if diff.new_chunks or diff.deleted_chunks else diff.updated_at
         )
 
 
@@ -127,7 +136,9 @@ class EmbeddingDocument:
     content: str
     # vector needs to be $vector when sent to the DB
     # see https://lidatong.github.io/dataclasses-json/#encode-or-decode-using-a-different-name
-    vector: list[float] = field(metadata=config(field_name="$vector"))
+    # it is only converted to a list of floats when we serialise the document
+    vector: np.ndarray = field(metadata=config(field_name="$vector", encoder=lambda v: v.tolist(),
+                                               decoder=lambda v: np.asarray(v, dtype=np.float32)))
 
     @classmethod
     def from_vectored_chunk(cls, vectored_chunk: VectoredChunk) -> 'EmbeddingDocument':
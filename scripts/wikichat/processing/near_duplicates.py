@@ -0,0 +1,166 @@
+"""
+Finds chunks that are near duplicates of chunks we have already stored, before we pay to vectorize them.
+
+Many articles share almost the same text, such as stub notices and mirrored list articles. The chunk hash only
+catches exact copies, and only after we have vectorized them, see insert_vectored_chunks. Here we keep a 64 bit
+SimHash fingerprint of word shingles for the chunks we store, two chunks are near duplicates when only a few bits
+of their fingerprints differ.
+
+Fingerprints are indexed by splitting them into bands, if two fingerprints differ by at most N bits then at least
+one of N + 1 bands must be the same in both. The index holds at most max_chunks fingerprints and forgets the least
+recently used ones.
+
+This module should not import other parts of the wikichat application.
+"""
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from enum import Enum
+
+FINGERPRINT_BITS = 64
+# Number of words in each shingle we hash into the fingerprint
+_SHINGLE_WORDS = 3
+
+
+class NearDuplicateMode(str, Enum):
+    """What to do with a new chunk that is a near duplicate of a stored chunk"""
+    # Do not look for near duplicates
+    OFF = "off"
+    # Do not vectorize or store the chunk
+    SKIP = "skip"
+    # Store the chunk using the vector of the stored chunk rather than vectorizing it
+    ALIAS = "alias"
+
+
+@dataclass
+class NearDuplicateMatch:
+    """A stored chunk that a new chunk is a near duplicate of"""
+    chunk_hash: str
+    url: str
+    similarity: float
+
+
+def simhash(text: str) -> int:
+    """SimHash fingerprint of the text, using shingles of words so that word order matters"""
+    words = text.split()
+    shingles = [" ".join(words[i:i + _SHINGLE_WORDS]) for i in range(max(len(words) - _SHINGLE_WORDS + 1, 1))]
+    bit_strings = [
+        format(int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big'),
+               f"0{FINGERPRINT_BITS}b")
+        for shingle in shingles
+    ]
+
+    # Each bit of the fingerprint is set if it is set in more than half of the shingle hashes,
+    # zip gives us each bit position, most significant first, across all the hashes
+    half = len(bit_strings) / 2
+    fingerprint = 0
+    for bit_column in zip(*bit_strings):
+        fingerprint = (fingerprint << 1) | (bit_column.count('1') > half)
+    return fingerprint
+
+
+class NearDuplicateIndex:
+    """Index of the fingerprints of stored chunks, keyed on the chunk hash."""
+
+    def __init__(self, mode: NearDuplicateMode = NearDuplicateMode.OFF, threshold: float = 0.95,
+                 min_chars: int = 200, max_chunks: int = 100000):
+        self.configure(mode=mode, threshold=threshold, min_chars=min_chars, max_chunks=max_chunks)
+
+    def configure(self, mode: NearDuplicateMode | str = NearDuplicateMode.OFF, threshold: float = 0.95,
+                  min_chars: int = 200, max_chunks: int = 100000) -> 'NearDuplicateIndex':
+        """Change the settings, this clears the index."""
+        if not 0.75 <= threshold <= 1:
+            raise ValueError(f"Near duplicate threshold must be between 0.75 and 1, got {threshold}")
+        if max_chunks <= 0:
+            raise ValueError(f"Near duplicate max_chunks must be greater than 0, got {max_chunks}")
+
+        self.mode: NearDuplicateMode = NearDuplicateMode(mode)
+        self.threshold: float = threshold
+        self.min_chars: int = min_chars
+        self.max_chunks: int = max_chunks
+
+        self._max_distance: int = int((1 - threshold) * FINGERPRINT_BITS)
+        # rounding the band size down can give us more bands than we need, which is fine
+        self._band_bits: int = FINGERPRINT_BITS // (self._max_distance + 1)
+        self._band_shifts: list[int] = list(range(0, FINGERPRINT_BITS, self._band_bits))
+        self.clear()
+        return self
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != NearDuplicateMode.OFF
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self) -> None:
+        # chunk hash -> (fingerprint, url), ordered from least to most recently used
+        self._entries: OrderedDict[str, tuple[int, str]] = OrderedDict()
+        # one table per band, band value -> chunk hashes
+        self._bands: list[dict[int, set[str]]] = [dict() for _ in self._band_shifts]
+
+    def find(self, text: str, exclude_url: str = None) -> NearDuplicateMatch | None:
+        """Find the most similar stored chunk to the text that is at least as similar as the threshold.
+
+        Chunks from exclude_url are ignored, an edited chunk is always similar to the version it replaces.
+        """
+        if not self.enabled or len(text) < self.min_chars or not self._entries:
+            return None
+
+        fingerprint = simhash(text)
+        best_hash, best_distance = None, self._max_distance + 1
+        for chunk_hash in self._candidates(fingerprint):
+            other, url = self._entries[chunk_hash]
+            distance = (fingerprint ^ other).bit_count()
+            if distance < best_distance and url != exclude_url:
+                best_hash, best_distance = chunk_hash, distance
+
+        if best_hash is None:
+            return None
+        self._entries.move_to_end(best_hash)
+        return NearDuplicateMatch(chunk_hash=best_hash, url=self._entries[best_hash][1],
+                                  similarity=1 - best_distance / FINGERPRINT_BITS)
+
+    def add(self, chunk_hash: str, url: str, text: str) -> int:
+        """Add a stored chunk to the index, returns the number of chunks evicted to make room."""
+        if not self.enabled or len(text) < self.min_chars:
+            return 0
+
+        self.remove(chunk_hash)
+        fingerprint = simhash(text)
+        self._entries[chunk_hash] = (fingerprint, url)
+        for table, band in zip(self._bands, self._band_values(fingerprint)):
+            table.setdefault(band, set()).add(chunk_hash)
+
+        evicted = 0
+        while len(self._entries) > self.max_chunks:
+            self.remove(next(iter(self._entries)))
+            evicted += 1
+        return evicted
+
+    def remove(self, chunk_hash: str) -> bool:
+        """Remove a chunk that was deleted from the database, returns True if it was in the index."""
+        entry = self._entries.pop(chunk_hash, None)
+        if entry is None:
+            return False
+        for table, band in zip(self._bands, self._band_values(entry[0])):
+            hashes = table.get(band)
+            if hashes is not None:
+                hashes.discard(chunk_hash)
+                if not hashes:
+                    del table[band]
+        return True
+
+    def _band_values(self, fingerprint: int) -> list[int]:
+        mask = (1 << self._band_bits) - 1
+        return [(fingerprint >> shift) & mask for shift in self._band_shifts]
+
+    def _candidates(self, fingerprint: int) -> set[str]:
+        candidates: set[str] = set()
+        for table, band in zip(self._bands, self._band_values(fingerprint)):
+            candidates.update(table.get(band, ()))
+        return candidates
+
+
+# Configured by wikichat.processing.create_pipeline, off by default
+NEAR_DUPLICATES = NearDuplicateIndex()
@@ -0,0 +1,191 @@
+"""
+Quantized storage and search of embedding vectors we keep locally, rather than in Astra.
+
+Every copy of a vector we hold in memory or on disk, such as a cache or snapshot, can be stored as:
+
+* ``none``: float32, 4 bytes per dimension, the same as the vectors we get from Cohere.
+* ``int8``: scalar quantized, one signed byte per dimension plus a float32 scale per vector, about 4x smaller.
+* ``binary``: the sign of each dimension packed into bits, 32x smaller. Searching compares bits and then rescores
+  the best candidates using the float query against the signs, see ``rescore_factor``.
+
+Scores are dot products, Cohere embed v3 vectors are normalised so this is the same order as cosine similarity.
+
+This module should not import other parts of the wikichat application.
+"""
+from enum import Enum
+
+import numpy as np
+
+# number of bits set in each byte value, used to count differing bits between binary vectors
+_POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint16)
+# rows of codes converted to float at a time when scoring, bounds the temporary memory used
+_SCORE_BLOCK_ROWS = 16384
+
+
+class Quantization(str, Enum):
+    NONE = "none"
+    INT8 = "int8"
+    BINARY = "binary"
+
+
+class Quantizer:
+    """Converts float32 vectors to and from their stored codes, and scores a query against codes."""
+
+    quantization: Quantization = Quantization.NONE
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        return np.asarray(vectors, dtype=np.float32)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return np.asarray(codes, dtype=np.float32)
+
+    def score(self, query: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        """Approximate dot product of the float query with each row of codes, higher is more similar."""
+        return codes @ query
+
+    def search(self, query: np.ndarray, codes: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """Row numbers and scores of the top k rows of codes for the query, best first."""
+        return _top_k(self.score(query, codes), k)
+
+
+class Int8Quantizer(Quantizer):
+    """Symmetric scalar quantization, each vector is scaled so its largest absolute value is 127.
+
+    The scale is stored as the last 4 bytes of each row of codes, so no calibration is needed and vectors can be
+    added one at a time.
+    """
+
+    quantization = Quantization.INT8
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        max_abs = np.abs(vectors).max(axis=1, keepdims=True)
+        # an all zero vector would give a zero scale, any scale will do
+        scale = np.where(max_abs > 0, max_abs / 127, 1.0).astype(np.float32)
+        quantized = np.clip(np.rint(vectors / scale), -127, 127).astype(np.int8)
+        return np.hstack([quantized, scale.view(np.int8)])
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return codes[:, :-4].astype(np.float32) * _row_scales(codes)[:, None]
+
+    def score(self, query: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        # convert a block of codes at a time so we do not make a float copy of all of them
+        query = np.asarray(query, dtype=np.float32)
+        scores = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), _SCORE_BLOCK_ROWS):
+            block = codes[start:start + _SCORE_BLOCK_ROWS]
+            scores[start:start + len(block)] = (block[:, :-4].astype(np.float32) @ query) * _row_scales(block)
+        return scores
+
+
+class BinaryQuantizer(Quantizer):
+    """Sign quantization, candidates are found by the number of differing sign bits and then rescored."""
+
+    quantization = Quantization.BINARY
+
+    def __init__(self, rescore_factor: int = 4):
+        # how many candidates per result to rescore using the float query
+        self.rescore_factor: int = rescore_factor
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        return np.packbits(np.asarray(vectors) > 0, axis=-1)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        # the signs as +1 / -1, the magnitude is lost
+        return np.unpackbits(codes, axis=-1).astype(np.float32) * 2 - 1
+
+    def score(self, query: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        """Negative number of differing sign bits, so higher is more similar like the other quantizers."""
+        query_bits = self.encode(query)
+        return -_POPCOUNT[np.bitwise_xor(codes, query_bits)].sum(axis=-1, dtype=np.int32)
+
+    def search(self, query: np.ndarray, codes: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        candidates, _ = _top_k(self.score(query, codes), k * max(self.rescore_factor, 1))
+        rescored = self.decode(codes[candidates]) @ np.asarray(query, dtype=np.float32)
+        order, scores = _top_k(rescored, k)
+        return candidates[order], scores
+
+
+def create_quantizer(quantization: Quantization | str, rescore_factor: int = 4) -> Quantizer:
+    match Quantization(quantization):
+        case Quantization.INT8:
+            return Int8Quantizer()
+        case Quantization.BINARY:
+            return BinaryQuantizer(rescore_factor=rescore_factor)
+        case _:
+            return Quantizer()
+
+
+class LocalVectorIndex:
+    """Vectors we keep locally, stored quantized, with exact search over the stored codes.
+
+    Vectors are added in batches and kept as a list of code blocks so adding does not copy what we already have,
+    the blocks are joined the first time we search after adding.
+    """
+
+    def __init__(self, quantization: Quantization | str = Quantization.NONE, rescore_factor: int = 4):
+        self.quantizer: Quantizer = create_quantizer(quantization, rescore_factor=rescore_factor)
+        self.ids: list[str] = []
+        self._blocks: list[np.ndarray] = []
+        self._codes: np.ndarray | None = None
+        self.dimension: int = 0
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(block.nbytes for block in self._blocks)
+
+    def add(self, ids: list[str], vectors: np.ndarray) -> None:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(ids) != len(vectors):
+            raise ValueError(f"Got {len(ids)} ids for {len(vectors)} vectors")
+        if not len(ids):
+            return
+        self.dimension = vectors.shape[1]
+        self.ids.extend(ids)
+        self._blocks.append(self.quantizer.encode(vectors))
+        self._codes = None
+
+    def vectors(self) -> np.ndarray:
+        """The stored vectors decoded back to float32, approximate unless quantization is none."""
+        return self.quantizer.decode(self._all_codes())
+
+    def search(self, query: np.ndarray, k: int) -> list[tuple[str, float]]:
+        """The ids and scores of the k stored vectors most similar to the query, best first."""
+        if not self.ids:
+            return []
+        rows, scores = self.quantizer.search(np.asarray(query, dtype=np.float32), self._all_codes(), k)
+        return [(self.ids[row], float(score)) for row, score in zip(rows, scores)]
+
+    def _all_codes(self) -> np.ndarray:
+        if self._codes is None:
+            if len(self._blocks) > 1:
+                self._blocks = [np.concatenate(self._blocks)]
+            self._codes = self._blocks[0] if self._blocks else np.empty((0, 0))
+        return self._codes
+
+
+def recall_at_k(expected: list[list[str]], actual: list[list[str]], k: int) -> float:
+    """Mean fraction of the expected top k ids for each query that are in the actual top k."""
+    if not expected:
+        return 0.0
+    return sum(
+        len(set(exp[:k]) & set(act[:k])) / max(min(k, len(exp)), 1)
+        for exp, act in zip(expected, actual)
+    ) / len(expected)
+
+
+def _row_scales(codes: np.ndarray) -> np.ndarray:
+    """The float32 scale stored in the last 4 bytes of each row of int8 codes"""
+    return np.ascontiguousarray(codes[:, -4:]).view(np.float32)[:, 0]
+
+
+def _top_k(scores: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=scores.dtype)
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top], kind='stable')]
+    return top, scores[top]
@@ -0,0 +1,144 @@
+"""
+Cache of the vectors for search queries, so a question we have already embedded does not need another request.
+
+Chat traffic repeats itself, and the search commands build questions from a template so the same text comes up
+again and again. Entries are keyed on the input type and the normalised text, and are forgotten when they are
+older than ttl_secs or are the least recently used entry when the cache is full. The TTL means a change of embedding
+model or provider is picked up without a restart.
+
+Queries that are already being embedded by another caller are not sent again, the second caller waits for the
+first, see :meth:`QueryEmbeddingCache.reserve`.
+
+This module should not import other parts of the wikichat application.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+
+
+def normalize_query(text: str) -> str:
+    """Queries that only differ by case or whitespace get the same cache entry"""
+    return " ".join(text.split()).casefold()
+
+
+@dataclass
+class _Entry:
+    vector: np.ndarray
+    expires_at: float
+
+
+@dataclass
+class CacheLookup:
+    """The result of looking up a batch of queries"""
+    # vector for each query, None if it needs to be embedded or we are waiting for another caller to embed it
+    vectors: list[np.ndarray | None]
+    # normalised keys of the queries this caller must embed and then put() or discard()
+    to_embed: list[str]
+    # the text to embed for each key in to_embed, the first query with that key as it was given
+    texts_to_embed: list[str]
+    # futures for queries another caller is embedding, by normalised key
+    waiting: dict[str, asyncio.Future]
+    hits: int = 0
+    expired: int = 0
+
+
+class QueryEmbeddingCache:
+    """LRU cache of query vectors with a time to live, keyed on (input_type, normalised text)."""
+
+    def __init__(self, max_entries: int = 10000, ttl_secs: float = 3600):
+        self.configure(max_entries=max_entries, ttl_secs=ttl_secs)
+
+    def configure(self, max_entries: int = 10000, ttl_secs: float = 3600) -> 'QueryEmbeddingCache':
+        """Change the size and TTL, 0 max_entries disables the cache. This clears the cache."""
+        if max_entries < 0 or ttl_secs <= 0:
+            raise ValueError(f"Query cache max_entries {max_entries} must not be negative and ttl_secs {ttl_secs} "
+                             f"must be greater than 0")
+        self.max_entries: int = max_entries
+        self.ttl_secs: float = ttl_secs
+        self.clear()
+        return self
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self) -> None:
+        self._entries: OrderedDict[tuple[str, str], _Entry] = OrderedDict()
+        self._in_flight: dict[tuple[str, str], asyncio.Future] = {}
+
+    def reserve(self, texts: list[str], input_type: str) -> CacheLookup:
+        """Look up the texts, and reserve the ones that are not cached so other callers wait for us to embed them.
+
+        The caller must put() or discard() every key in to_embed.
+        """
+        lookup = CacheLookup(vectors=[None] * len(texts), to_embed=[], texts_to_embed=[], waiting={})
+        now = time.monotonic()
+        seen: set[str] = set()
+        for i, text in enumerate(texts):
+            key = normalize_query(text)
+            cache_key = (input_type, key)
+            entry = self._entries.get(cache_key) if self.enabled else None
+            if entry is not None and entry.expires_at <= now:
+                del self._entries[cache_key]
+                lookup.expired += 1
+                entry = None
+
+            if entry is not None:
+                self._entries.move_to_end(cache_key)
+                lookup.vectors[i] = entry.vector
+                lookup.hits += 1
+            elif key in seen:
+                # repeated in this batch
+                continue
+            elif cache_key in self._in_flight:
+                lookup.waiting[key] = self._in_flight[cache_key]
+            else:
+                lookup.to_embed.append(key)
+                lookup.texts_to_embed.append(text)
+                if self.enabled:
+                    future = asyncio.get_running_loop().create_future()
+                    # no one may be waiting, retrieve the error so it is not logged as never retrieved
+                    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+                    self._in_flight[cache_key] = future
+            seen.add(key)
+        return lookup
+
+    def put(self, keys: list[str], input_type: str, vectors: np.ndarray) -> int:
+        """Add the vectors for the reserved keys, returns the number of entries evicted to make room."""
+        evicted = 0
+        expires_at = time.monotonic() + self.ttl_secs
+        for key, vector in zip(keys, vectors):
+            cache_key = (input_type, key)
+            future = self._in_flight.pop(cache_key, None)
+            if future is not None and not future.done():
+                future.set_result(vector)
+            if not self.enabled:
+                continue
+
+            self._entries[cache_key] = _Entry(vector=vector, expires_at=expires_at)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                evicted += 1
+        return evicted
+
+    def discard(self, keys: list[str], input_type: str, error: BaseException) -> None:
+        """Release the reserved keys when embedding them failed, callers waiting for them get the error"""
+        for key in keys:
+            future = self._in_flight.pop((input_type, key), None)
+            if future is None or future.done():
+                continue
+            if isinstance(error, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(error)
+
+
+# Configured by the search commands, see wikichat.processing.embeddings.embed_queries
+QUERY_CACHE = QueryEmbeddingCache()
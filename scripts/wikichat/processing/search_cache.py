@@ -0,0 +1,168 @@
+"""
+Cache of recent ANN search results, so near identical questions do not each need a search of the collection.
+
+Chat users ask about the same trending articles again and again, with slightly different words. Each entry keeps the
+query vector int8 quantized, see :class:`wikichat.processing.quantization.Int8Quantizer`, and a new query reuses the
+results of the most similar cached query if their cosine similarity is at least the threshold and the search used
+the same limit, filter and projection.
+
+Entries are removed when they are older than ttl_secs, when an article in their results has changed since they were
+cached, or when they are the least recently used entry and the cache is full. The cache is in the process running the
+searches, not the pipeline, so each entry keeps the version of the articles in its results, the updated_at of their
+metadata, and the search commands compare them with the versions in the database on a hit. A change to an article
+that is not in the results, which might now rank higher, is not seen until the entry expires, so the search commands
+can check a sample of hits against the database to measure how often results are stale.
+
+This module should not import other parts of the wikichat application, other than the quantization it uses.
+"""
+import json
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any
+
+import numpy as np
+
+from wikichat.processing.quantization import Int8Quantizer
+
+
+@dataclass
+class _Entry:
+    params_id: int
+    docs: list[dict[str, Any]]
+    # version of each article url in the results
+    versions: dict[str, float]
+    created_at: float
+
+
+@dataclass
+class SearchCacheHit:
+    """Cached results for a query"""
+    slot: int
+    docs: list[dict[str, Any]]
+    versions: dict[str, float]
+    similarity: float
+    age_secs: float
+
+
+@dataclass
+class SearchCacheLookup:
+    """The result of looking up a query, hit is None on a miss"""
+    hit: SearchCacheHit | None = None
+    expired: int = 0
+
+
+class SearchResultCache:
+    """Fixed number of slots, each with the int8 codes of a query vector and the results of searching with it."""
+
+    def __init__(self, max_entries: int = 0, ttl_secs: float = 60, threshold: float = 0.98):
+        self.configure(max_entries=max_entries, ttl_secs=ttl_secs, threshold=threshold)
+
+    def configure(self, max_entries: int = 0, ttl_secs: float = 60, threshold: float = 0.98) -> 'SearchResultCache':
+        """Change the settings, 0 max_entries disables the cache. This clears the cache."""
+        if max_entries < 0 or ttl_secs <= 0:
+            raise ValueError(f"Search cache max_entries {max_entries} must not be negative and ttl_secs {ttl_secs} "
+                             f"must be greater than 0")
+        if not 0 < threshold <= 1:
+            raise ValueError(f"Search cache threshold must be greater than 0 and at most 1, got {threshold}")
+        self.max_entries: int = max_entries
+        self.ttl_secs: float = ttl_secs
+        self.threshold: float = threshold
+        self._quantizer = Int8Quantizer()
+        self.clear()
+        return self
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def __len__(self) -> int:
+        return len(self._lru)
+
+    def clear(self) -> None:
+        # allocated on the first put() when we know the dimension
+        self._codes: np.ndarray | None = None
+        # params id of the search in each slot, -1 for a free slot so it never matches
+        self._slot_params: np.ndarray = np.full(self.max_entries, -1, dtype=np.int32)
+        self._entries: list[_Entry | None] = [None] * self.max_entries
+        self._free_slots: list[int] = list(range(self.max_entries - 1, -1, -1))
+        # used slots, ordered from least to most recently used
+        self._lru: OrderedDict[int, None] = OrderedDict()
+        self._params_ids: dict[str, int] = {}
+
+    @staticmethod
+    def params_key(limit: int, search_filter: dict[str, Any], projection: dict[str, Any]) -> str:
+        """Results can only be reused for a search with the same limit, filter and projection"""
+        return json.dumps([limit, search_filter, projection], sort_keys=True)
+
+    def lookup(self, vector: np.ndarray, params_key: str) -> SearchCacheLookup:
+        lookup = SearchCacheLookup()
+        params_id = self._params_ids.get(params_key)
+        if not self.enabled or params_id is None or self._codes is None:
+            return lookup
+
+        query = _normalize(vector)
+        if len(query) != self._codes.shape[1] - 4:
+            return lookup
+        scores = np.where(self._slot_params == params_id, self._quantizer.score(query, self._codes), -np.inf)
+        slot = int(np.argmax(scores))
+        if scores[slot] < self.threshold:
+            return lookup
+
+        entry = self._entries[slot]
+        age_secs = time.monotonic() - entry.created_at
+        if age_secs > self.ttl_secs:
+            self.remove(slot)
+            lookup.expired = 1
+            return lookup
+
+        self._lru.move_to_end(slot)
+        lookup.hit = SearchCacheHit(slot=slot, docs=entry.docs, versions=entry.versions,
+                                    similarity=float(scores[slot]), age_secs=age_secs)
+        return lookup
+
+    def put(self, vector: np.ndarray, params_key: str, docs: list[dict[str, Any]],
+            versions: dict[str, float] = None) -> int:
+        """Cache the results of a search and the versions of the articles in them, returns the number of entries
+        evicted to make room."""
+        if not self.enabled:
+            return 0
+        query = _normalize(vector)
+        if self._codes is None or self._codes.shape[1] != len(query) + 4:
+            # first entry, or the dimension changed because we changed embedding provider
+            self.clear()
+            self._codes = np.zeros((self.max_entries, len(query) + 4), dtype=np.int8)
+
+        evicted = 0
+        if not self._free_slots:
+            self.remove(next(iter(self._lru)))
+            evicted = 1
+        slot = self._free_slots.pop()
+
+        params_id = self._params_ids.setdefault(params_key, len(self._params_ids))
+        self._codes[slot] = self._quantizer.encode(query)[0]
+        self._slot_params[slot] = params_id
+        self._entries[slot] = _Entry(params_id=params_id, docs=docs, versions=versions or {},
+                                    created_at=time.monotonic())
+        self._lru[slot] = None
+        return evicted
+
+    def remove(self, slot: int) -> bool:
+        entry = self._entries[slot]
+        if entry is None:
+            return False
+        self._entries[slot] = None
+        self._slot_params[slot] = -1
+        del self._lru[slot]
+        self._free_slots.append(slot)
+        return True
+
+
+def _normalize(vector: np.ndarray) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+# Configured by the search commands, see wikichat.commands.database.search_chunks
+SEARCH_CACHE = SearchResultCache()
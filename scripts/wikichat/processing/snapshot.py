@@ -0,0 +1,231 @@
+"""
+Local snapshot format for the chunks and article metadata in the database, see the snapshot and restore commands.
+
+A snapshot is a directory of column files, written a page of documents at a time and read back without loading it
+all into memory:
+
+* ``vectors.f32``: the chunk vectors as one float32 block with a row per chunk, memory mapped when reading.
+* ``chunks.<column>.*``: the other fields of the chunks, a row per chunk in the same order as the vectors.
+  Text is stored as utf-8 bytes with an int64 offset per row. Columns that repeat per article, such as the url,
+  are stored as an int32 code per row into a dictionary of their values, the code is -1 for a missing value.
+* ``metadata.jsonl`` and ``suggestions.jsonl``: the article metadata and suggestion documents, one JSON per line.
+* ``manifest.json``: the number of rows, dimension, and columns. It is written last, so a snapshot without one was
+  not finished.
+
+This module should not import other parts of the wikichat application.
+"""
+import json
+import os
+import time
+from array import array
+from dataclasses import dataclass, field
+from typing import Any, Iterator, TextIO
+
+import numpy as np
+from dataclasses_json import dataclass_json
+
+SNAPSHOT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+VECTORS_FILE = "vectors.f32"
+METADATA_FILE = "metadata.jsonl"
+SUGGESTIONS_FILE = "suggestions.jsonl"
+
+# Fields of the chunk documents, see wikichat.processing.model.EmbeddingDocument
+TEXT_COLUMNS = ["_id", "content"]
+DICTIONARY_COLUMNS = ["url", "title", "document_id"]
+INT_COLUMNS = ["chunk_index"]
+CHUNK_FIELDS = TEXT_COLUMNS + DICTIONARY_COLUMNS + INT_COLUMNS
+# code in a dictionary column for a document without the field, such as an article without a title
+_MISSING_CODE = -1
+
+
+@dataclass_json
+@dataclass
+class SnapshotManifest:
+    version: int = SNAPSHOT_VERSION
+    created_at: float = 0.0
+    chunks: int = 0
+    dimension: int = 0
+    metadata: int = 0
+    suggestions: int = 0
+    chunk_fields: list[str] = field(default_factory=lambda: list(CHUNK_FIELDS))
+
+
+class _TextColumnWriter:
+    def __init__(self, path: str):
+        self._path = path
+        self._blob = open(f"{path}.utf8", mode='wb')
+        self._offsets = array('q', [0])
+
+    def append(self, value: str) -> None:
+        self._offsets.append(self._offsets[-1] + self._blob.write((value or "").encode('utf-8')))
+
+    def close(self) -> None:
+        self._blob.close()
+        with open(f"{self._path}.offsets", mode='wb') as file:
+            self._offsets.tofile(file)
+
+
+class _DictionaryColumnWriter:
+    def __init__(self, path: str):
+        self._path = path
+        self._codes = array('i')
+        self._values: dict[str, int] = {}
+
+    def append(self, value: str | None) -> None:
+        self._codes.append(_MISSING_CODE if value is None else self._values.setdefault(value, len(self._values)))
+
+    def close(self) -> None:
+        with open(f"{self._path}.codes", mode='wb') as file:
+            self._codes.tofile(file)
+        dictionary = _TextColumnWriter(f"{self._path}.dict")
+        for value in self._values:
+            dictionary.append(value)
+        dictionary.close()
+
+
+class _IntColumnWriter:
+    def __init__(self, path: str):
+        self._path = path
+        self._values = array('i')
+
+    def append(self, value: int) -> None:
+        self._values.append(int(value or 0))
+
+    def close(self) -> None:
+        with open(f"{self._path}.i32", mode='wb') as file:
+            self._values.tofile(file)
+
+
+class SnapshotWriter:
+    """Writes a snapshot to a new directory, call close() to write the manifest once everything has been added."""
+
+    def __init__(self, path: str):
+        if os.path.exists(os.path.join(path, MANIFEST_FILE)):
+            raise ValueError(f"Snapshot {path} already exists")
+        os.makedirs(path, exist_ok=True)
+        self.path: str = path
+        self.manifest = SnapshotManifest(created_at=time.time())
+
+        self._vectors = open(os.path.join(path, VECTORS_FILE), mode='wb')
+        column_path = lambda name: os.path.join(path, f"chunks.{name}")
+        self._columns: dict[str, Any] = {
+            **{name: _TextColumnWriter(column_path(name)) for name in TEXT_COLUMNS},
+            **{name: _DictionaryColumnWriter(column_path(name)) for name in DICTIONARY_COLUMNS},
+            **{name: _IntColumnWriter(column_path(name)) for name in INT_COLUMNS},
+        }
+        self._metadata: TextIO = open(os.path.join(path, METADATA_FILE), mode='w')
+        self._suggestions: TextIO = open(os.path.join(path, SUGGESTIONS_FILE), mode='w')
+
+    def add_chunks(self, docs: list[dict[str, Any]]) -> None:
+        """Add chunk documents as read from the database, including their $vector"""
+        if not docs:
+            return
+        vectors = np.asarray([doc["$vector"] for doc in docs], dtype=np.float32)
+        if not self.manifest.dimension:
+            self.manifest.dimension = vectors.shape[1]
+        if vectors.shape[1] != self.manifest.dimension:
+            raise ValueError(f"Chunk vectors have dimension {vectors.shape[1]}, expected {self.manifest.dimension}")
+
+        self._vectors.write(vectors.tobytes())
+        for doc in docs:
+            for name, column in self._columns.items():
+                column.append(doc.get(name))
+        self.manifest.chunks += len(docs)
+
+    def add_metadata(self, doc: dict[str, Any]) -> None:
+        self._metadata.write(json.dumps(doc) + "\n")
+        self.manifest.metadata += 1
+
+    def add_suggestions(self, doc: dict[str, Any]) -> None:
+        self._suggestions.write(json.dumps(doc) + "\n")
+        self.manifest.suggestions += 1
+
+    def close(self) -> SnapshotManifest:
+        self._vectors.close()
+        for column in self._columns.values():
+            column.close()
+        self._metadata.close()
+        self._suggestions.close()
+        with open(os.path.join(self.path, MANIFEST_FILE), mode='w') as file:
+            file.write(self.manifest.to_json(indent=2))
+        return self.manifest
+
+
+class _TextColumn:
+    def __init__(self, path: str):
+        self._offsets = np.fromfile(f"{path}.offsets", dtype=np.int64)
+        self._blob = _memmap_or_empty(f"{path}.utf8", np.uint8)
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, row: int) -> str:
+        return self._blob[self._offsets[row]:self._offsets[row + 1]].tobytes().decode('utf-8')
+
+
+class SnapshotReader:
+    """Reads a finished snapshot, the vectors and text are memory mapped rather than loaded."""
+
+    def __init__(self, path: str):
+        manifest_path = os.path.join(path, MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            raise ValueError(f"No snapshot at {path}, or it was not finished")
+        with open(manifest_path, mode='r') as file:
+            self.manifest: SnapshotManifest = SnapshotManifest.from_json(file.read())
+        if self.manifest.version != SNAPSHOT_VERSION:
+            raise ValueError(f"Snapshot {path} is version {self.manifest.version}, expected {SNAPSHOT_VERSION}")
+        self.path: str = path
+
+        column_path = lambda name: os.path.join(path, f"chunks.{name}")
+        self.vectors: np.ndarray = _memmap_or_empty(os.path.join(path, VECTORS_FILE), np.float32,
+                                                    shape=(self.manifest.chunks, self.manifest.dimension))
+        self._text = {name: _TextColumn(column_path(name)) for name in TEXT_COLUMNS}
+        self._dictionary_codes = {name: np.fromfile(f"{column_path(name)}.codes", dtype=np.int32)
+                                  for name in DICTIONARY_COLUMNS}
+        # there is one value per article, so these are small enough to load
+        self._dictionaries = {name: [value for value in _iter_text(_TextColumn(f"{column_path(name)}.dict"))]
+                              for name in DICTIONARY_COLUMNS}
+        self._ints = {name: np.fromfile(f"{column_path(name)}.i32", dtype=np.int32) for name in INT_COLUMNS}
+
+    def __len__(self) -> int:
+        return self.manifest.chunks
+
+    def chunk(self, row: int, with_vector: bool = True) -> dict[str, Any]:
+        """The chunk document in the same form as it is stored in the database"""
+        doc: dict[str, Any] = {name: column[row] for name, column in self._text.items()}
+        doc.update({name: None if codes[row] == _MISSING_CODE else self._dictionaries[name][codes[row]]
+                    for name, codes in self._dictionary_codes.items()})
+        doc.update({name: int(values[row]) for name, values in self._ints.items()})
+        if with_vector:
+            doc["$vector"] = self.vectors[row].tolist()
+        return doc
+
+    def iter_chunk_batches(self, batch_size: int) -> Iterator[list[dict[str, Any]]]:
+        for start in range(0, len(self), batch_size):
+            yield [self.chunk(row) for row in range(start, min(start + batch_size, len(self)))]
+
+    def iter_metadata(self) -> Iterator[dict[str, Any]]:
+        yield from _iter_jsonl(os.path.join(self.path, METADATA_FILE))
+
+    def iter_suggestions(self) -> Iterator[dict[str, Any]]:
+        yield from _iter_jsonl(os.path.join(self.path, SUGGESTIONS_FILE))
+
+
+def _iter_text(column: _TextColumn) -> Iterator[str]:
+    for row in range(len(column)):
+        yield column[row]
+
+
+def _iter_jsonl(path: str) -> Iterator[dict[str, Any]]:
+    with open(path, mode='r') as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _memmap_or_empty(path: str, dtype, shape: tuple[int, ...] = None) -> np.ndarray:
+    # numpy cannot memory map an empty file
+    if os.path.getsize(path) == 0:
+        return np.empty(shape or (0,), dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=shape)
@@ -0,0 +1,149 @@
+"""
+Splits article text into overlapping chunks for vectorizing.
+
+This is a purpose-built replacement for the langchain ``RecursiveCharacterTextSplitter`` we used to configure with
+``chunk_size=1024, chunk_overlap=200, length_function=len``. It produces exactly the same chunks as that
+configuration, but works on ``(start, end)`` offsets into the article text rather than building lists of
+intermediate strings at every level of the recursion. The only strings created are the final chunks, which are
+hashed as they are produced.
+
+This module should not import other parts of the wikichat application.
+"""
+import hashlib
+import re
+from bisect import bisect_left, bisect_right
+from itertools import islice
+from operator import sub
+from typing import Generator, Iterable, Sequence
+
+DEFAULT_SEPARATORS: tuple[str, ...] = ("\n\n", "\n", " ", "")
+
+# (start, end) offsets into the text, end is exclusive like a slice
+Span = tuple[int, int]
+
+
+class TextSplitter:
+    """Recursively split text on the first separator that appears in it, then merge the pieces into chunks.
+
+    Behaves like langchain's ``RecursiveCharacterTextSplitter`` with ``keep_separator=True``,
+    ``strip_whitespace=True`` and ``length_function=len``: the separator stays at the start of the piece that
+    follows it, pieces too long to fit in a chunk are split again with the next separator, and each chunk
+    overlaps the previous one by up to ``chunk_overlap`` characters.
+    """
+
+    def __init__(self, chunk_size: int = 1024, chunk_overlap: int = 200,
+                 separators: Iterable[str] = DEFAULT_SEPARATORS):
+        if chunk_overlap > chunk_size:
+            raise ValueError(f"chunk_overlap {chunk_overlap} is larger than chunk_size {chunk_size}")
+        self.chunk_size: int = chunk_size
+        self.chunk_overlap: int = chunk_overlap
+        self.separators: tuple[str, ...] = tuple(separators)
+        self._patterns: dict[str, re.Pattern] = {sep: re.compile(re.escape(sep)) for sep in self.separators if sep}
+
+    def iter_spans(self, text: str) -> Generator[Span, None, None]:
+        """Yield the (start, end) offsets of each chunk in the text, in order."""
+        yield from self._split_span(text, 0, len(text), self.separators)
+
+    def split_text(self, text: str) -> list[str]:
+        """Split the text into chunks, same result as ``RecursiveCharacterTextSplitter.split_text``."""
+        return [text[start:end] for start, end in self.iter_spans(text)]
+
+    def split_and_hash(self, text: str) -> list[tuple[str, str]]:
+        """Split the text into chunks and return each chunk with the hex sha256 of its utf-8 encoding."""
+        chunks: list[tuple[str, str]] = []
+        for start, end in self.iter_spans(text):
+            chunk = text[start:end]
+            chunks.append((chunk, hashlib.sha256(chunk.encode('utf-8')).hexdigest()))
+        return chunks
+
+    def _split_span(self, text: str, start: int, end: int,
+                    separators: tuple[str, ...]) -> Generator[Span, None, None]:
+        # Use the first separator that is in this span, the empty separator always matches
+        separator: str = separators[-1]
+        next_separators: tuple[str, ...] = ()
+        for i, candidate in enumerate(separators):
+            if candidate == "":
+                separator = candidate
+                break
+            if text.find(candidate, start, end) != -1:
+                separator = candidate
+                next_separators = separators[i + 1:]
+                break
+
+        # Piece i is bounds[i] to bounds[i + 1]. Pieces that fit in a chunk are merged together,
+        # a run of them is ended by a piece that does not fit.
+        bounds: Sequence[int] = self._piece_bounds(text, start, end, separator)
+        last = len(bounds) - 1
+        if max(map(sub, islice(bounds, 1, None), bounds), default=0) < self.chunk_size:
+            # usual case, every piece fits so skip looking at them one at a time
+            if last > 0:
+                yield from self._merge_pieces(text, bounds, 0, last)
+            return
+
+        run_start = 0
+        for i in range(last):
+            if bounds[i + 1] - bounds[i] < self.chunk_size:
+                continue
+
+            if i > run_start:
+                yield from self._merge_pieces(text, bounds, run_start, i)
+            if next_separators:
+                yield from self._split_span(text, bounds[i], bounds[i + 1], next_separators)
+            else:
+                # nothing left to split on, the piece is used as is, langchain does not strip these
+                yield bounds[i], bounds[i + 1]
+            run_start = i + 1
+        if last > run_start:
+            yield from self._merge_pieces(text, bounds, run_start, last)
+
+    def _piece_bounds(self, text: str, start: int, end: int, separator: str) -> Sequence[int]:
+        """Offsets where the non-empty pieces of the span start, followed by the end of the span.
+
+        Each piece after the first starts with the separator, the empty separator makes every character a piece.
+        """
+        if not separator:
+            return range(start, end + 1)
+        if start == end:
+            return [start]
+
+        bounds: list[int] = [start]
+        bounds.extend(match.start() for match in self._patterns[separator].finditer(text, start, end))
+        if len(bounds) > 1 and bounds[1] == start:
+            # span starts with the separator, the empty piece before it is dropped
+            del bounds[1]
+        bounds.append(end)
+        return bounds
+
+    def _merge_pieces(self, text: str, bounds: Sequence[int], first: int, last: int) -> Generator[Span, None, None]:
+        """Merge pieces ``first`` up to but not including ``last`` into chunks.
+
+        The pieces are contiguous and keep their separator, so the length of a run of pieces is the difference
+        between two bounds and chunks can be found with a binary search rather than adding up pieces one at a time.
+        """
+        current = first
+        while True:
+            # Pieces are added to the chunk until the end of one goes past chunk_size from the start of the chunk
+            overflow = bisect_right(bounds, bounds[current] + self.chunk_size, current, last + 1) - 1
+            if overflow >= last:
+                break
+            chunk = _strip_span(text, bounds[current], bounds[overflow])
+            if chunk:
+                yield chunk
+
+            # Drop pieces from the front until we are within the overlap and the overflowing piece will fit
+            within_overlap = bisect_left(bounds, bounds[overflow] - self.chunk_overlap, current, overflow + 1)
+            piece_fits = bisect_left(bounds, bounds[overflow + 1] - self.chunk_size, current, overflow + 1)
+            current = max(within_overlap, min(piece_fits, overflow))
+
+        chunk = _strip_span(text, bounds[current], bounds[last])
+        if chunk:
+            yield chunk
+
+
+def _strip_span(text: str, start: int, end: int) -> Span | None:
+    """Offsets of the span with leading and trailing whitespace removed, None if nothing is left."""
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return (start, end) if end > start else None
@@ -0,0 +1,134 @@
+"""
+A compact in memory set of the chunk ids stored in the embeddings collection.
+
+Without this we only find out a chunk is already stored when the insert fails with DOCUMENT_ALREADY_EXISTS, after
+we have paid to vectorize it. The set is a counting Bloom filter so chunks can be removed when they are deleted.
+It can say a chunk is stored when it is not, at about the configured error rate, so a match is only a reason to
+check the database. It should not say a chunk is missing when it is stored, though this can happen if we remove a
+chunk that was never added, and then we just vectorize the chunk as we would without the filter.
+
+The filter can be saved to and loaded from a file so a restart does not have to scan the collection.
+
+This module should not import other parts of the wikichat application.
+"""
+import hashlib
+import math
+import os
+import struct
+
+_FILE_MAGIC = b"WCBF"
+_FILE_VERSION = 1
+# magic, version, number of counters, number of hashes, number of items
+_FILE_HEADER = struct.Struct(">4sBQBQ")
+_MAX_COUNT = 255
+
+
+class StoredChunkFilter:
+    """Counting Bloom filter of chunk ids, one byte per counter."""
+
+    def __init__(self, capacity: int = 0, error_rate: float = 0.01, path: str = ""):
+        self.configure(capacity=capacity, error_rate=error_rate, path=path)
+
+    def configure(self, capacity: int = 0, error_rate: float = 0.01, path: str = "") -> 'StoredChunkFilter':
+        """Size the filter for capacity chunk ids at the error rate, 0 capacity disables it. This clears the filter.
+
+        The filter is saved to and loaded from path, empty to not save it.
+        """
+        if capacity < 0:
+            raise ValueError(f"Stored chunk filter capacity must not be negative, got {capacity}")
+        if not 0 < error_rate < 1:
+            raise ValueError(f"Stored chunk filter error rate must be between 0 and 1, got {error_rate}")
+
+        self.capacity: int = capacity
+        self.error_rate: float = error_rate
+        self.path: str = path
+        # standard sizing, see https://en.wikipedia.org/wiki/Bloom_filter#Optimal_number_of_hash_functions
+        num_counters = math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)) if capacity else 0
+        num_hashes = max(1, round(num_counters / capacity * math.log(2))) if capacity else 0
+        self._reset(num_counters, num_hashes)
+        return self
+
+    @property
+    def enabled(self) -> bool:
+        return self._num_counters > 0
+
+    def __len__(self) -> int:
+        """Approximate number of chunk ids in the filter"""
+        return self._count
+
+    def __contains__(self, chunk_id: str) -> bool:
+        return self.enabled and all(self._counters[pos] for pos in self._positions(chunk_id))
+
+    def clear(self) -> None:
+        self._reset(self._num_counters, self._num_hashes)
+
+    def add(self, chunk_id: str) -> None:
+        if not self.enabled:
+            return
+        for pos in self._positions(chunk_id):
+            if self._counters[pos] < _MAX_COUNT:
+                self._counters[pos] += 1
+        self._count += 1
+
+    def remove(self, chunk_id: str) -> bool:
+        """Remove a chunk id that was deleted, returns False if it was not in the filter."""
+        if chunk_id not in self:
+            return False
+        for pos in self._positions(chunk_id):
+            # a counter that reached the max may be counting more items than it shows, so leave it there
+            if self._counters[pos] < _MAX_COUNT:
+                self._counters[pos] -= 1
+        self._count = max(0, self._count - 1)
+        return True
+
+    def save(self) -> bool:
+        """Write the filter to the file, replacing the file once it has been written. Returns False if there is
+        no file to save to."""
+        if not self.enabled or not self.path:
+            return False
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, mode='wb') as file:
+            file.write(_FILE_HEADER.pack(_FILE_MAGIC, _FILE_VERSION, self._num_counters, self._num_hashes,
+                                         self._count))
+            file.write(self._counters)
+        os.replace(tmp_path, self.path)
+        return True
+
+    def load(self) -> bool:
+        """Replace the contents of the filter with the saved file.
+
+        Returns False and leaves the filter empty if there is no file, or it was saved with a different size.
+        """
+        self.clear()
+        if not self.enabled or not self.path or not os.path.exists(self.path):
+            return False
+
+        with open(self.path, mode='rb') as file:
+            magic, version, num_counters, num_hashes, count = _FILE_HEADER.unpack(file.read(_FILE_HEADER.size))
+            if magic != _FILE_MAGIC or version != _FILE_VERSION:
+                raise ValueError(f"File {self.path} is not a stored chunk filter")
+            if num_counters != self._num_counters or num_hashes != self._num_hashes:
+                return False
+            counters = bytearray(file.read())
+        if len(counters) != num_counters:
+            raise ValueError(f"File {self.path} is truncated, expected {num_counters} counters got {len(counters)}")
+        self._counters = counters
+        self._count = count
+        return True
+
+    def _reset(self, num_counters: int, num_hashes: int) -> None:
+        self._num_counters: int = num_counters
+        self._num_hashes: int = num_hashes
+        self._counters: bytearray = bytearray(num_counters)
+        self._count: int = 0
+
+    def _positions(self, chunk_id: str) -> list[int]:
+        # double hashing, see https://www.eecs.harvard.edu/~michaelm/postscripts/rsa2008.pdf
+        digest = hashlib.blake2b(chunk_id.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:], 'big') | 1
+        return [(h1 + i * h2) % self._num_counters for i in range(self._num_hashes)]
+
+
+# Configured by wikichat.processing.load_stored_chunks, disabled by default
+STORED_CHUNKS = StoredChunkFilter()
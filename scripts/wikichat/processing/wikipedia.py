@@ -27,18 +27,30 @@ async def scrape_article(meta: ArticleMetadata) -> Article | None:
     logging.debug(f"Scraping article {meta.url}")
     async with aiohttp.ClientSession() as session:
         try:
-            async with session.get(meta.url, allow_redirects=True) as response:
-                if response.status == 200:
-                    html: str = await response.text()
-                else:
-                    logging.error(
-                        f"Continuing after error fetching {meta.url}, unexpected status code {response.status}")
-                    return None
+            with METRICS.timer("wikipedia", "get_article"):
+                async with session.get(meta.url, allow_redirects=True) as response:
+                    if response.status == 200:
+                        html: str = await response.text()
+                    else:
+                        logging.error(
+                            f"Continuing after error fetching {meta.url}, unexpected status code {response.status}")
+                        return None
         except aiohttp.ClientError as e:
             logging.error(f"Continuing after error fetching {meta.url} - {e}")
             logging.debug(f"Continuing after error fetching {meta.url}", exc_info=True)
             return None
 
+    article, redirects_to = parse_article(meta, html)
+    if redirects_to:
+        await METRICS.update_article(redirects=1)
+    return article
+
+
+def parse_article(meta: ArticleMetadata, html: str) -> tuple[Article | None, str | None]:
+    """The cleaned up article from the HTML of the page, and the URL the page redirects to if it does.
+
+    The article is None if the page redirects or has no content. This is the CPU heavy part of scrape_article.
+    """
     # lxml is faster but html5lib is more lenient with broken HTML.
     # install the libraries with pip install  html5lib
     soup: BeautifulSoup = BeautifulSoup(html, 'lxml')
@@ -48,14 +60,13 @@ async def scrape_article(meta: ArticleMetadata) -> Article | None:
         # Do not process pages that direct to another,
         # because different articles with diff URLs have the same content and we get a bunch of chunk collisions
         logging.debug(f"Skipping article {meta.url} because it redirects to {redirects_to}")
-        await METRICS.update_article(redirects=1)
-        return None
+        return None, redirects_to
 
     content = soup.find(id=CONTENT_ELEMENT_ID)
     if not content:
         logging.error(
             f"Continuing after error fetching {meta.url}, could not find content element {CONTENT_ELEMENT_ID}")
-        return None
+        return None, None
 
     # Remove images
     for img in content.find_all('img'):
@@ -72,7 +83,7 @@ async def scrape_article(meta: ArticleMetadata) -> Article | None:
     return Article(
         metadata=_maybe_update_metadata(meta, soup),
         content=cleaned_content
-    )
+    ), None
 
 
 def _redirects_to(meta: ArticleMetadata, soup: BeautifulSoup) -> str | None:
@@ -0,0 +1,103 @@
+"""
+SQLite file that keeps the items waiting in the pipeline steps, so they are not lost if the process is stopped.
+
+A step whose source queue is checkpointed, see :class:`wikichat.utils.pipeline.CheckpointedLaneQueue`, adds each item
+to the file when it is put into the queue. The item stays in the file while its results go through the steps that
+are not checkpointed, and is removed when a result has been added to the file by the next checkpointed step, or the
+last step has finished with it. When the pipeline is created again the items still in the file are put back into the
+steps they were waiting for, so only the work done since the last checkpointed step is done again. An item that was
+being processed when the process stopped is processed again.
+
+The file also keeps counters, such as the number of articles put into the pipeline for the max_articles limit.
+
+The database is in WAL mode with synchronous=NORMAL, so it survives the process being killed but a power failure may
+lose the most recent changes. The pipeline adds, removes, and sets counters from a single thread so the event loop
+is not blocked while they are written, and they are written in the order they were made.
+
+This module should not import other parts of the wikichat application.
+"""
+import asyncio
+import logging
+import pickle
+import sqlite3
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Iterator
+
+
+def _log_write_error(future: Future) -> None:
+    if not future.cancelled() and future.exception() is not None:
+        logging.error("Error writing to the checkpoint file", exc_info=future.exception())
+
+
+class CheckpointStore:
+    """Items waiting in each step, and named counters, in a SQLite file."""
+
+    def __init__(self, path: str, encode: Callable[[Any], bytes] = pickle.dumps,
+                 decode: Callable[[bytes], Any] = pickle.loads):
+        self.path: str = path
+        self._encode = encode
+        self._decode = decode
+        # used from the writer thread as well as the thread that created it
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint")
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS step_items ("
+                           "id INTEGER PRIMARY KEY AUTOINCREMENT, step TEXT NOT NULL, priority INTEGER NOT NULL, "
+                           "payload BLOB NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS step_items_step ON step_items (step, id)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    def add(self, step: str, priority: int, item: Any) -> int:
+        """Add an item waiting for the step, returns the id to remove() it with"""
+        return self._conn.execute("INSERT INTO step_items (step, priority, payload) VALUES (?, ?, ?)",
+                                  (step, int(priority), self._encode(item))).lastrowid
+
+    async def add_async(self, step: str, priority: int, item: Any) -> int:
+        """add() on the writer thread"""
+        return await asyncio.get_running_loop().run_in_executor(self._writer, self.add, step, priority, item)
+
+    def remove(self, item_id: int) -> None:
+        self._conn.execute("DELETE FROM step_items WHERE id = ?", (item_id,))
+
+    def remove_later(self, item_id: int) -> None:
+        """remove() on the writer thread, without waiting for it"""
+        self._writer.submit(self.remove, item_id).add_done_callback(_log_write_error)
+
+    def items(self, step: str) -> Iterator[tuple[int, int, Any]]:
+        """The (id, priority, item) waiting for the step, oldest first.
+
+        Items that cannot be decoded, for example because the code has changed since they were added, are removed.
+        """
+        rows = self._conn.execute("SELECT id, priority, payload FROM step_items WHERE step = ? ORDER BY id",
+                                  (step,)).fetchall()
+        for item_id, priority, payload in rows:
+            try:
+                item = self._decode(payload)
+            except Exception:
+                logging.exception(f"Dropping checkpointed item {item_id} for step {step} that could not be decoded")
+                self.remove(item_id)
+                continue
+            yield item_id, priority, item
+
+    def count(self, step: str = None) -> int:
+        if step is None:
+            return self._conn.execute("SELECT COUNT(*) FROM step_items").fetchone()[0]
+        return self._conn.execute("SELECT COUNT(*) FROM step_items WHERE step = ?", (step,)).fetchone()[0]
+
+    def get_counter(self, name: str) -> int:
+        row = self._conn.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def set_counter(self, name: str, value: int) -> None:
+        self._conn.execute("INSERT INTO counters (name, value) VALUES (?, ?) "
+                           "ON CONFLICT (name) DO UPDATE SET value = excluded.value", (name, value))
+
+    def set_counter_later(self, name: str, value: int) -> None:
+        """set_counter() on the writer thread, without waiting for it"""
+        self._writer.submit(self.set_counter, name, value).add_done_callback(_log_write_error)
+
+    def close(self) -> None:
+        # finish the writes that are waiting first
+        self._writer.shutdown(wait=True)
+        self._conn.close()
@@ -0,0 +1,102 @@
+"""
+Latency histograms with log sized buckets, and their OpenMetrics text format.
+
+Each bucket's upper bound is a constant factor larger than the one before, so a fixed number of buckets covers
+milliseconds to minutes with the same relative error, and quantiles such as p99 can be estimated from the counts.
+Observing a value is a binary search and an addition.
+
+This module should not import other parts of the wikichat application.
+"""
+import math
+from bisect import bisect_left
+from typing import Any
+
+
+class LogHistogram:
+    """Counts of observations in buckets with upper bounds min_bound * factor ** i, plus one for larger values"""
+
+    def __init__(self, min_bound: float = 0.001, factor: float = 2.0, num_buckets: int = 21):
+        self.bounds: list[float] = [min_bound * factor ** i for i in range(num_buckets)]
+        self.counts: list[int] = [0] * (num_buckets + 1)
+        self.count: int = 0
+        self.sum: float = 0.0
+        self.max: float = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        """Estimate of the q quantile, interpolated geometrically within the bucket it falls in"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            if bucket_count and seen + bucket_count >= rank:
+                upper = self.bounds[i] if i < len(self.bounds) else self.max
+                lower = self.bounds[i - 1] if i > 0 else min(upper, self.bounds[0] / 2)
+                fraction = (rank - seen) / bucket_count
+                estimate = lower * math.pow(upper / lower, fraction) if lower > 0 else upper * fraction
+                return min(estimate, self.max)
+            seen += bucket_count
+        return self.max
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "max": round(self.max, 6),
+            "p50": round(self.quantile(0.5), 6),
+            "p90": round(self.quantile(0.9), 6),
+            "p99": round(self.quantile(0.99), 6),
+        }
+
+
+class HistogramFamily:
+    """Histograms of one metric, one for each combination of label values"""
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...]):
+        self.name: str = name
+        self.help: str = help
+        self.label_names: tuple[str, ...] = label_names
+        self.histograms: dict[tuple[str, ...], LogHistogram] = {}
+
+    def observe(self, label_values: tuple[str, ...], value: float) -> None:
+        histogram = self.histograms.get(label_values)
+        if histogram is None:
+            histogram = self.histograms[label_values] = LogHistogram()
+        histogram.observe(value)
+
+    def snapshot(self) -> list[dict[str, Any]]:
+        return [
+            {**dict(zip(self.label_names, label_values)), **histogram.snapshot()}
+            for label_values, histogram in sorted(self.histograms.items())
+        ]
+
+    def openmetrics(self) -> list[str]:
+        lines = [f"# TYPE {self.name} histogram", f"# HELP {self.name} {self.help}"]
+        for label_values, histogram in sorted(self.histograms.items()):
+            labels = dict(zip(self.label_names, label_values))
+            bounds = [repr(bound) for bound in histogram.bounds] + ["+Inf"]
+            cumulative = 0
+            for bound, bucket_count in zip(bounds, histogram.counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{format_labels(labels | {'le': bound})} {cumulative}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {histogram.count}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {histogram.sum}")
+        return lines
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels: dict[str, Any]) -> str:
+    """Labels as {name="value",...} for the OpenMetrics text format, or an empty string if there are none"""
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label_value(str(value))}"' for name, value in labels.items()) + "}"
@@ -3,17 +3,32 @@ Metrics to track the progress of loading and listening to Wikipedia articles.
 
 Metrics should only be updated via the single METRICS object, which is a singleton.
 
+The counters are only updated on the event loop, and the updates do not await, so they need no lock. Rates over the
+last 1, 5 and 15 minutes are calculated from snapshots of the counters taken each time the metrics are reported,
+see :class:`RateWindows`, so counting an event is only an addition.
+
+The queue wait and processing time of each pipeline step, and the latency of the calls to Astra, Wikipedia and the
+embedding provider, are kept in log bucketed histograms, see :mod:`wikichat.utils.histogram`. All the metrics can be
+taken as a JSON :meth:`~_Metrics.snapshot` or in the OpenMetrics text format, which
+:mod:`wikichat.utils.metrics_server` serves over HTTP.
+
 The pipeline will create an async tak to call :meth:`~Metrics.metrics_reporter_task` to report the metrics every N seconds.
 """
 import asyncio
-import json
 import logging
+import math
+import re
 import time
-from dataclasses import dataclass, field
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field, fields, is_dataclass
 from datetime import timedelta
-from typing import Any
+from typing import Any, Iterator
 
-from wikichat.utils.pipeline import AsyncPipeline
+from wikichat.utils.histogram import HistogramFamily, format_labels
+from wikichat.utils.pipeline import AsyncPipeline, STEP_NAME_CONTEXT_VAR
+from wikichat.utils.retry import error_codes
+from wikichat.utils.tracing import TRACER, SPAN_KIND_CLIENT
 
 
 @dataclass
@@ -23,13 +38,17 @@ class ListenerMetrics:
     bot_events: int = 0
     skipped_events: int = 0
     enwiki_edits: int = 0
+    # events sent again by the stream after resuming, that were skipped
+    duplicate_events: int = 0
+    reconnects: int = 0
 
 
 @dataclass
 class ArticleMetrics:
     redirects: int = 0
     zero_vectors: int = 0
-    recent_urls: list[str] = field(default_factory=list)
+    # only the most recent urls are kept between reports
+    recent_urls: deque[str] = field(default_factory=lambda: deque(maxlen=20))
 
 
 @dataclass
@@ -51,11 +70,117 @@ class Chunks:
     chunks_vectorized: int = 0
 
 
+@dataclass
+class NearDuplicateMetrics:
+    chunks_checked: int = 0
+    chunks_matched: int = 0
+    chunks_skipped: int = 0
+    chunks_aliased: int = 0
+    alias_misses: int = 0
+    index_evictions: int = 0
+
+
+@dataclass
+class StoredChunkMetrics:
+    possible_duplicates: int = 0
+    confirmed_duplicates: int = 0
+    false_positives: int = 0
+
+
+@dataclass
+class EmbeddingMetrics:
+    callers: int = 0
+    split_callers: int = 0
+    requests: int = 0
+    retries: int = 0
+    failed_requests: int = 0
+    texts: int = 0
+    batch_capacity: int = 0
+
+
+@dataclass
+class QueryCacheMetrics:
+    hits: int = 0
+    misses: int = 0
+    waits: int = 0
+    expired: int = 0
+    evictions: int = 0
+
+
+@dataclass
+class SearchCacheMetrics:
+    hits: int = 0
+    misses: int = 0
+    expired: int = 0
+    evictions: int = 0
+    invalidations: int = 0
+    verified: int = 0
+    stale: int = 0
+    hit_age_secs: float = 0.0
+
+
+@dataclass
+class LoadSheddingMetrics:
+    shed: int = 0
+    restored: int = 0
+
+
+@dataclass
+class EventLoopMetrics:
+    slow_callbacks: int = 0
+
+
 @dataclass
 class RotatingCollections:
     rotations: int = 0
 
 
+class RateWindows:
+    """Rates of the counters over sliding windows, and an exponentially weighted moving average.
+
+    Calculated from snapshots of the counter totals, the rate over a window is the change in the total since the
+    oldest snapshot in the window. Until the process has run for the length of a window, the rate is over the time
+    it has been running.
+    """
+    WINDOWS_SECS: tuple[int, ...] = (60, 300, 900)
+
+    def __init__(self, ewma_secs: float = 60):
+        self.ewma_secs: float = ewma_secs
+        # (monotonic time, counter totals), oldest first
+        self._samples: deque[tuple[float, dict[str, float]]] = deque()
+        self._ewma: dict[str, float] = {}
+
+    def sample(self, totals: dict[str, float], now: float = None) -> None:
+        now = time.monotonic() if now is None else now
+        if self._samples:
+            last_secs, last_totals = self._samples[-1]
+            elapsed = now - last_secs
+            if elapsed <= 0:
+                return
+            alpha = 1 - math.exp(-elapsed / self.ewma_secs)
+            for key, total in totals.items():
+                rate = (total - last_totals.get(key, 0)) / elapsed
+                self._ewma[key] = self._ewma.get(key, rate) + alpha * (rate - self._ewma.get(key, rate))
+        self._samples.append((now, totals))
+        # keep one sample at least as old as the longest window
+        while len(self._samples) > 2 and now - self._samples[1][0] >= self.WINDOWS_SECS[-1]:
+            self._samples.popleft()
+
+    def rate(self, key: str, window_secs: float) -> float:
+        if len(self._samples) < 2:
+            return 0.0
+        now, totals = self._samples[-1]
+        start, start_totals = next((sample for sample in self._samples if now - sample[0] <= window_secs),
+                                   self._samples[-1])
+        if start == now:
+            # the reports are further apart than the window
+            start, start_totals = self._samples[-2]
+        return (totals.get(key, 0) - start_totals.get(key, 0)) / (now - start)
+
+    def ewma(self, key: str) -> float:
+        return self._ewma.get(key, 0.0)
+
+
 @dataclass
 class _Metrics:
     _listener: ListenerMetrics = field(default_factory=ListenerMetrics)
@@ -63,95 +188,273 @@ class _Metrics:
     _chunks: Chunks = field(default_factory=Chunks)
     _rotating_collections: RotatingCollections = field(default_factory=RotatingCollections)
     _article: ArticleMetrics = field(default_factory=ArticleMetrics)
+    _near_duplicates: NearDuplicateMetrics = field(default_factory=NearDuplicateMetrics)
+    _stored_chunks: StoredChunkMetrics = field(default_factory=StoredChunkMetrics)
+    _embeddings: EmbeddingMetrics = field(default_factory=EmbeddingMetrics)
+    _query_cache: QueryCacheMetrics = field(default_factory=QueryCacheMetrics)
+    _search_cache: SearchCacheMetrics = field(default_factory=SearchCacheMetrics)
+    _load_shedding: LoadSheddingMetrics = field(default_factory=LoadSheddingMetrics)
+    _event_loop: EventLoopMetrics = field(default_factory=EventLoopMetrics)
     _error_by_code: dict[str, int] = field(default_factory=dict)
+    _retries_by_code: dict[str, int] = field(default_factory=dict)
+    _dead_letters_by_code: dict[str, int] = field(default_factory=dict)
+    _slow_callbacks_by_site: dict[str, int] = field(default_factory=dict)
+    _step_wait: HistogramFamily = field(default_factory=lambda: HistogramFamily(
+        "wikichat_step_queue_wait_seconds", "Time items waited in the source queue of the step", ("step",)))
+    _step_processing: HistogramFamily = field(default_factory=lambda: HistogramFamily(
+        "wikichat_step_processing_seconds", "Time the step took to process an item", ("step",)))
+    _client_latency: HistogramFamily = field(default_factory=lambda: HistogramFamily(
+        "wikichat_client_latency_seconds", "Latency of calls to external services", ("client", "operation", "step")))
+    _loop_lag: HistogramFamily = field(default_factory=lambda: HistogramFamily(
+        "wikichat_event_loop_lag_seconds", "How late the event loop woke a task that was sleeping", ()))
+    _reconnect_gap: HistogramFamily = field(default_factory=lambda: HistogramFamily(
+        "wikichat_listener_reconnect_gap_seconds", "Time from losing the changes stream to the next event", ()))
     report_interval_secs: int = 10
 
     def __post_init__(self):
         self._start_secs = time.time()
-        self._async_lock = asyncio.Lock()
+        self._rates = RateWindows()
+        # the first report has the rates since we started
+        self._rates.sample(self._counter_totals())
 
     async def update_listener(self, total_events: int = 0, canary_events: int = 0, bot_events: int = 0,
-                              skipped_events: int = 0, enwiki_edits: int = 0):
-        async with self._async_lock:
-            self._listener.total_events += total_events
-            self._listener.canary_events += canary_events
-            self._listener.bot_events += bot_events
-            self._listener.skipped_events += skipped_events
-            self._listener.enwiki_edits += enwiki_edits
-            return None
-            # return self._maybe_describe(pipeline=pipeline) if describe else None
+                              skipped_events: int = 0, enwiki_edits: int = 0, duplicate_events: int = 0,
+                              reconnect_gap_secs: float = None):
+        self._listener.total_events += total_events
+        self._listener.canary_events += canary_events
+        self._listener.bot_events += bot_events
+        self._listener.skipped_events += skipped_events
+        self._listener.enwiki_edits += enwiki_edits
+        self._listener.duplicate_events += duplicate_events
+        if reconnect_gap_secs is not None:
+            self._listener.reconnects += 1
+            self._reconnect_gap.observe((), reconnect_gap_secs)
+        return None
+        # return self._maybe_describe(pipeline=pipeline) if describe else None
 
     async def update_database(self, chunks_inserted: int = 0, chunks_deleted: int = 0, chunks_unchanged: int = 0,
                               chunk_collision: int = 0,
                               articles_inserted: int = 0, articles_read: int = 0):
-        async with self._async_lock:
-            self._database.chunks_inserted += chunks_inserted
-            self._database.chunks_deleted += chunks_deleted
-            self._database.chunk_collision += chunk_collision
-            self._database.articles_inserted += articles_inserted
-            self._database.articles_read += articles_read
+        self._database.chunks_inserted += chunks_inserted
+        self._database.chunks_deleted += chunks_deleted
+        self._database.chunk_collision += chunk_collision
+        self._database.articles_inserted += articles_inserted
+        self._database.articles_read += articles_read
 
     async def get_rotation_stats(self) -> (int, int):
-        async with self._async_lock:
-            return self._rotating_collections.rotations, self._database.chunks_inserted
+        return self._rotating_collections.rotations, self._database.chunks_inserted
 
     async def update_rotation_stats(self, rotations: int = 0):
-        async with self._async_lock:
-            self._rotating_collections.rotations += rotations
+        self._rotating_collections.rotations += rotations
 
     async def update_chunks(self, chunks_created: int = 0, chunk_diff_new: int = 0, chunk_diff_deleted: int = 0,
                             chunk_diff_unchanged: int = 0, chunks_vectorized: int = 0):
-        async with self._async_lock:
-            self._chunks.chunks_created += chunks_created
-            self._chunks.chunk_diff_new += chunk_diff_new
-            self._chunks.chunk_diff_deleted += chunk_diff_deleted
-            self._chunks.chunk_diff_unchanged += chunk_diff_unchanged
-            self._chunks.chunks_vectorized += chunks_vectorized
+        self._chunks.chunks_created += chunks_created
+        self._chunks.chunk_diff_new += chunk_diff_new
+        self._chunks.chunk_diff_deleted += chunk_diff_deleted
+        self._chunks.chunk_diff_unchanged += chunk_diff_unchanged
+        self._chunks.chunks_vectorized += chunks_vectorized
+
+    async def update_near_duplicates(self, chunks_checked: int = 0, chunks_matched: int = 0, chunks_skipped: int = 0,
+                                     chunks_aliased: int = 0, alias_misses: int = 0, index_evictions: int = 0):
+        self._near_duplicates.chunks_checked += chunks_checked
+        self._near_duplicates.chunks_matched += chunks_matched
+        self._near_duplicates.chunks_skipped += chunks_skipped
+        self._near_duplicates.chunks_aliased += chunks_aliased
+        self._near_duplicates.alias_misses += alias_misses
+        self._near_duplicates.index_evictions += index_evictions
+
+    async def update_stored_chunks(self, possible_duplicates: int = 0, confirmed_duplicates: int = 0,
+                                   false_positives: int = 0):
+        self._stored_chunks.possible_duplicates += possible_duplicates
+        self._stored_chunks.confirmed_duplicates += confirmed_duplicates
+        self._stored_chunks.false_positives += false_positives
+
+    async def update_embeddings(self, callers: int = 0, split_callers: int = 0, requests: int = 0, retries: int = 0,
+                                failed_requests: int = 0, texts: int = 0, batch_capacity: int = 0):
+        self._embeddings.callers += callers
+        self._embeddings.split_callers += split_callers
+        self._embeddings.requests += requests
+        self._embeddings.retries += retries
+        self._embeddings.failed_requests += failed_requests
+        self._embeddings.texts += texts
+        self._embeddings.batch_capacity += batch_capacity
+
+    async def update_query_cache(self, hits: int = 0, misses: int = 0, waits: int = 0, expired: int = 0,
+                                 evictions: int = 0):
+        self._query_cache.hits += hits
+        self._query_cache.misses += misses
+        self._query_cache.waits += waits
+        self._query_cache.expired += expired
+        self._query_cache.evictions += evictions
+
+    async def update_search_cache(self, hits: int = 0, misses: int = 0, expired: int = 0, evictions: int = 0,
+                                  invalidations: int = 0, verified: int = 0, stale: int = 0,
+                                  hit_age_secs: float = 0.0):
+        self._search_cache.hits += hits
+        self._search_cache.misses += misses
+        self._search_cache.expired += expired
+        self._search_cache.evictions += evictions
+        self._search_cache.invalidations += invalidations
+        self._search_cache.verified += verified
+        self._search_cache.stale += stale
+        self._search_cache.hit_age_secs += hit_age_secs
+
+    def query_cache_summary(self) -> dict[str, float]:
+        """Totals for the query cache, for the search commands to report when they finish"""
+        cache = self._query_cache
+        found = cache.hits + cache.waits
+        return {
+            "hits": cache.hits,
+            "misses": cache.misses,
+            "waits": cache.waits,
+            "hit_ratio": round(found / (found + cache.misses), 4) if found + cache.misses else 0.0,
+            "expired": cache.expired,
+            "evictions": cache.evictions
+        }
+
+    def search_cache_summary(self) -> dict[str, float]:
+        """Totals for the search cache, for the search commands to report when they finish"""
+        cache = self._search_cache
+        return {
+            "hits": cache.hits,
+            "misses": cache.misses,
+            "hit_ratio": round(cache.hits / (cache.hits + cache.misses), 4) if cache.hits + cache.misses else 0.0,
+            "mean_hit_age_secs": round(cache.hit_age_secs / cache.hits, 3) if cache.hits else 0.0,
+            "expired": cache.expired,
+            "evictions": cache.evictions,
+            "invalidations": cache.invalidations,
+            "verified": cache.verified,
+            "stale": cache.stale,
+            "stale_ratio": round(cache.stale / cache.verified, 4) if cache.verified else 0.0
+        }
+
+    async def update_load_shedding(self, shed: int = 0, restored: int = 0):
+        self._load_shedding.shed += shed
+        self._load_shedding.restored += restored
 
     async def update_article(self, redirects: int = 0, zero_vectors: int = 0, recent_url: str = None):
-        async with self._async_lock:
-            self._article.redirects += redirects
-            self._article.zero_vectors += zero_vectors
-            if recent_url:
-                self._article.recent_urls.append(recent_url)
+        self._article.redirects += redirects
+        self._article.zero_vectors += zero_vectors
+        if recent_url:
+            self._article.recent_urls.append(recent_url)
 
     async def listen_to_step_error(self, error: Exception):
-        # see if we can track the error counts
-        # API errors will be
-        # ValueError: [{"message": "Failed to update documents with _id ["recent_articles"]: Unable to complete transaction due to concurrent transactions", "errorCode": "CONCURRENCY_FAILURE"}]
-        # ValueError: [{"message": "Query timed out after PT30S"}]
-        these_errors: dict[str, int] = dict()
-
-        if isinstance(error, ValueError):
-            api_errors: list[Any] = []
-            try:
-                api_errors = json.loads(error.args[0])
-            except:
-                pass
-            for api_error in api_errors:
-                match api_error:
-                    case {"errorCode": code}:
-                        these_errors[code] = these_errors.get(code, 0) + 1
-                    case {"message": message}:
-                        these_errors[message] = these_errors.get(message, 0) + 1
-                    case _:
-                        these_errors["Unknown API ERROR"] = these_errors.get("Unknown API ERROR", 0) + 1
-        if not these_errors:
-            # just collection by the error type
-            name: str = error.__class__.__name__
-            these_errors[name] = 1
+        # see if we can track the error counts, see wikichat.utils.retry.error_codes
+        these_errors: dict[str, int] = error_codes(error)
 
         if these_errors:
-            async with self._async_lock:
-                for code, count in these_errors.items():
-                    self._error_by_code[code] = self._error_by_code.get(code, 0) + count
+            for code, count in these_errors.items():
+                self._error_by_code[code] = self._error_by_code.get(code, 0) + count
+
+    async def update_retries(self, codes: dict[str, int], retried: int = 0, dead_lettered: int = 0):
+        """Called by the pipeline when a failed item is scheduled to retry, or has run out of retries"""
+        for code in codes:
+            self._retries_by_code[code] = self._retries_by_code.get(code, 0) + retried
+            self._dead_letters_by_code[code] = self._dead_letters_by_code.get(code, 0) + dead_lettered
+
+    async def observe_step(self, step: str, wait_secs: float, processing_secs: float):
+        """Called by the pipeline after each item a step has processed"""
+        self._step_wait.observe((step,), wait_secs)
+        self._step_processing.observe((step,), processing_secs)
+
+    async def observe_loop_lag(self, lag_secs: float):
+        """Called by wikichat.utils.profiling.PROFILER every time it measures the event loop lag"""
+        self._loop_lag.observe((), lag_secs)
+
+    async def update_slow_callbacks(self, site: str):
+        """Called when the event loop was blocked by the code at site, see wikichat.utils.profiling"""
+        self._event_loop.slow_callbacks += 1
+        self._slow_callbacks_by_site[site] = self._slow_callbacks_by_site.get(site, 0) + 1
+
+    @contextmanager
+    def timer(self, client: str, operation: str) -> Iterator[None]:
+        """Record the latency of a call to an external service, labelled with the pipeline step making it.
+
+        The call is also a span in the trace of the item being processed, if it is being traced.
+        """
+        start = time.monotonic()
+        try:
+            with TRACER.span(f"{client}.{operation}", SPAN_KIND_CLIENT):
+                yield
+        finally:
+            self._client_latency.observe((client, operation, STEP_NAME_CONTEXT_VAR.get()), time.monotonic() - start)
+
+    def snapshot(self, pipeline: AsyncPipeline = None) -> dict[str, Any]:
+        """All the metrics, for the JSON endpoint"""
+        totals = self._counter_totals()
+        return {
+            "uptime_secs": round(time.time() - self._start_secs, 3),
+            "counters": totals,
+            "rates": {
+                key: {
+                    **{f"{window}s": round(self._rates.rate(key, window), 4) for window in RateWindows.WINDOWS_SECS},
+                    "ewma": round(self._rates.ewma(key), 4)
+                }
+                for key in totals
+            },
+            "errors": dict(self._error_by_code),
+            "retries": dict(self._retries_by_code),
+            "dead_letters": dict(self._dead_letters_by_code),
+            "slow_callbacks": dict(self._slow_callbacks_by_site),
+            "queue_depths": pipeline.queue_depths() if pipeline else {},
+            "lane_depths": pipeline.lane_depths() if pipeline else {},
+            "step_queue_wait_secs": self._step_wait.snapshot(),
+            "step_processing_secs": self._step_processing.snapshot(),
+            "client_latency_secs": self._client_latency.snapshot(),
+            "event_loop_lag_secs": self._loop_lag.snapshot(),
+            "listener_reconnect_gap_secs": self._reconnect_gap.snapshot(),
+        }
+
+    def openmetrics(self, pipeline: AsyncPipeline = None) -> str:
+        """All the metrics in the OpenMetrics text format"""
+        lines = []
+        for key, total in self._counter_totals().items():
+            metric = _metric_name(key)
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}_total {total}")
+
+        for metric, by_code, help in (("wikichat_step_errors", self._error_by_code, "Errors in pipeline steps"),
+                                      ("wikichat_step_retries", self._retries_by_code, "Items scheduled to retry"),
+                                      ("wikichat_dead_letters", self._dead_letters_by_code,
+                                       "Items that ran out of retries")):
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"# HELP {metric} {help}")
+            lines.extend(f"{metric}_total{format_labels({'code': code})} {count}" for code, count in by_code.items())
+        lines.append("# TYPE wikichat_slow_callbacks_by_site counter")
+        lines.append("# HELP wikichat_slow_callbacks_by_site Times the event loop was blocked, by where in our code")
+        lines.extend(f"wikichat_slow_callbacks_by_site_total{format_labels({'site': site})} {count}"
+                     for site, count in self._slow_callbacks_by_site.items())
+
+        if pipeline:
+            lines.append("# TYPE wikichat_step_queue_depth gauge")
+            lines.extend(f"wikichat_step_queue_depth{format_labels({'step': step})} {depth}"
+                         for step, depth in pipeline.queue_depths().items())
+            lines.append("# TYPE wikichat_lane_depth gauge")
+            lines.extend(f"wikichat_lane_depth{format_labels({'lane': lane})} {depth}"
+                         for lane, depth in pipeline.lane_depths().items())
+
+        for family in (self._step_wait, self._step_processing, self._client_latency, self._loop_lag,
+                       self._reconnect_gap):
+            lines.extend(family.openmetrics())
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
 
     async def describe(self, pipeline: AsyncPipeline) -> str:
         now = time.time()
 
-        def _pprint(x):
+        def _pprint_total(x):
             return f"{x:>8} (total) {round(x / processing_time.total_seconds(), 2):>8} (op/s)"
 
+        def _pprint(section, name):
+            key = _counter_key(section, name)
+            windows = " ".join(f"{round(self._rates.rate(key, window), 2):>8}" for window in RateWindows.WINDOWS_SECS)
+            return f"{_pprint_total(getattr(section, name))} {windows} (1m/5m/15m op/s) " \
+                   f"{round(self._rates.ewma(key), 2):>8} (ewma op/s)"
+
+        def _pprint_ratio(numerator, denominator):
+            return f"{round(numerator / denominator, 2) if denominator else 0:>8}"
+
         def _pprint_urls(urls):
             if not urls:
                 return "None"
@@ -164,47 +467,133 @@ class _Metrics:
             if not errors:
                 return "None"
             return "\n    ".join([
-                f"{code:24}: {_pprint(count)}"
+                f"{code:24}: {_pprint_total(count)} {self._retries_by_code.get(code, 0):>8} (retried) "
+                f"{self._dead_letters_by_code.get(code, 0):>8} (dead letters)"
                 for code, count in errors.items()
             ])
 
-        async with self._async_lock:
-            processing_time: timedelta = timedelta(seconds=now - self._start_secs)
+        def _pplabels(labels):
+            return f"{'/'.join(label for label in labels if label):40}: " if labels else ""
+
+        def _pplatency(family):
+            if not family.histograms:
+                return "None"
+            return "\n    ".join([
+                f"{_pplabels(labels)}{histogram.count:>8} (count) "
+                f"{round(histogram.quantile(0.5), 3):>8} (p50 s) {round(histogram.quantile(0.99), 3):>8} (p99 s) "
+                f"{round(histogram.max, 3):>8} (max s)"
+                for labels, histogram in sorted(family.histograms.items())
+            ])
+
+        def _ppsites(sites):
+            if not sites:
+                return ""
+            return "\n    ".join([
+                f"{site:60}: {count:>8} (total)"
+                for site, count in sorted(sites.items(), key=lambda x: x[1], reverse=True)[:10]
+            ])
+
+        processing_time: timedelta = timedelta(seconds=now - self._start_secs)
+        self._rates.sample(self._counter_totals())
 
-            desc = f"""
+        desc = f"""
 Processing:
     Total Time (h:mm:s):    {processing_time}
     Report interval (s):    {self.report_interval_secs}
 Wikipedia Listener:      
-    Total events:           {_pprint(self._listener.total_events)}
-    Canary events:          {_pprint(self._listener.canary_events)}
-    Bot events:             {_pprint(self._listener.bot_events)}
-    Skipped events:         {_pprint(self._listener.skipped_events)}
-    enwiki edits:           {_pprint(self._listener.enwiki_edits)}
+    Total events:           {_pprint(self._listener, "total_events")}
+    Canary events:          {_pprint(self._listener, "canary_events")}
+    Bot events:             {_pprint(self._listener, "bot_events")}
+    Skipped events:         {_pprint(self._listener, "skipped_events")}
+    enwiki edits:           {_pprint(self._listener, "enwiki_edits")}
+    Duplicate events:       {_pprint(self._listener, "duplicate_events")}
+    Reconnects:             {_pprint(self._listener, "reconnects")}
+    Reconnect gap:          {_pplatency(self._reconnect_gap)}
 Chunks: 
-    Chunks created:         {_pprint(self._chunks.chunks_created)}
-    Chunk diff new:         {_pprint(self._chunks.chunk_diff_new)}
-    Chunk diff deleted:     {_pprint(self._chunks.chunk_diff_deleted)}
-    Chunk diff unchanged:   {_pprint(self._chunks.chunk_diff_unchanged)}
-    Chunks vectorized:      {_pprint(self._chunks.chunks_vectorized)}
+    Chunks created:         {_pprint(self._chunks, "chunks_created")}
+    Chunk diff new:         {_pprint(self._chunks, "chunk_diff_new")}
+    Chunk diff deleted:     {_pprint(self._chunks, "chunk_diff_deleted")}
+    Chunk diff unchanged:   {_pprint(self._chunks, "chunk_diff_unchanged")}
+    Chunks vectorized:      {_pprint(self._chunks, "chunks_vectorized")}
+Stored Chunk Filter:
+    Possible duplicates:    {_pprint(self._stored_chunks, "possible_duplicates")}
+    Confirmed duplicates:   {_pprint(self._stored_chunks, "confirmed_duplicates")}
+    False positives:        {_pprint(self._stored_chunks, "false_positives")}
+Near Duplicates:
+    Chunks checked:         {_pprint(self._near_duplicates, "chunks_checked")}
+    Chunks matched:         {_pprint(self._near_duplicates, "chunks_matched")}
+    Chunks skipped:         {_pprint(self._near_duplicates, "chunks_skipped")}
+    Chunks aliased:         {_pprint(self._near_duplicates, "chunks_aliased")}
+    Alias misses:           {_pprint(self._near_duplicates, "alias_misses")}
+    Index evictions:        {_pprint(self._near_duplicates, "index_evictions")}
+Embeddings:
+    Callers:                {_pprint(self._embeddings, "callers")}
+    Split callers:          {_pprint(self._embeddings, "split_callers")}
+    Requests:               {_pprint(self._embeddings, "requests")}
+    Retries:                {_pprint(self._embeddings, "retries")}
+    Failed requests:        {_pprint(self._embeddings, "failed_requests")}
+    Texts embedded:         {_pprint(self._embeddings, "texts")}
+    Texts per request:      {_pprint_ratio(self._embeddings.texts, self._embeddings.requests - self._embeddings.failed_requests)}
+    Batch fill ratio:       {_pprint_ratio(self._embeddings.texts, self._embeddings.batch_capacity)}
+Query Cache:
+    Hits:                   {_pprint(self._query_cache, "hits")}
+    Misses:                 {_pprint(self._query_cache, "misses")}
+    Waits:                  {_pprint(self._query_cache, "waits")}
+    Hit ratio:              {_pprint_ratio(self._query_cache.hits + self._query_cache.waits, self._query_cache.hits + self._query_cache.waits + self._query_cache.misses)}
+    Expired:                {_pprint(self._query_cache, "expired")}
+    Evictions:              {_pprint(self._query_cache, "evictions")}
+Search Cache:
+    Hits:                   {_pprint(self._search_cache, "hits")}
+    Misses:                 {_pprint(self._search_cache, "misses")}
+    Hit ratio:              {_pprint_ratio(self._search_cache.hits, self._search_cache.hits + self._search_cache.misses)}
+    Mean hit age (s):       {_pprint_ratio(self._search_cache.hit_age_secs, self._search_cache.hits)}
+    Expired:                {_pprint(self._search_cache, "expired")}
+    Evictions:              {_pprint(self._search_cache, "evictions")}
+    Invalidations:          {_pprint(self._search_cache, "invalidations")}
+    Verified hits:          {_pprint(self._search_cache, "verified")}
+    Stale hits:             {_pprint(self._search_cache, "stale")}
+    Stale ratio:            {_pprint_ratio(self._search_cache.stale, self._search_cache.verified)}
 Database:
-    Rotations:              {_pprint(self._rotating_collections.rotations)}
-    Chunks inserted:        {_pprint(self._database.chunks_inserted)}
-    Chunks deleted:         {_pprint(self._database.chunks_deleted)}
-    Chunk collisions:       {_pprint(self._database.chunk_collision)}
-    Articles read:          {_pprint(self._database.articles_read)}
-    Articles inserted:      {_pprint(self._database.articles_inserted)}
+    Rotations:              {_pprint(self._rotating_collections, "rotations")}
+    Chunks inserted:        {_pprint(self._database, "chunks_inserted")}
+    Chunks deleted:         {_pprint(self._database, "chunks_deleted")}
+    Chunk collisions:       {_pprint(self._database, "chunk_collision")}
+    Articles read:          {_pprint(self._database, "articles_read")}
+    Articles inserted:      {_pprint(self._database, "articles_inserted")}
 Pipeline:
     {pipeline.queue_depths() if pipeline else ""}
+    Lane depths:            {pipeline.lane_depths() if pipeline else ""}
+    Live wait (s):          {_pprint_ratio(pipeline.live_wait_secs() if pipeline else 0, 1)}
+    Bulk shed:              {_pprint(self._load_shedding, "shed")}
+    Bulk restored:          {_pprint(self._load_shedding, "restored")}
+Step Queue Wait:
+    {_pplatency(self._step_wait)}
+Step Processing:
+    {_pplatency(self._step_processing)}
+Client Latency:
+    {_pplatency(self._client_latency)}
+Event Loop:
+    Lag:                    {_pplatency(self._loop_lag)}
+    Slow callbacks:         {_pprint(self._event_loop, "slow_callbacks")}
+    {_ppsites(self._slow_callbacks_by_site)}
 Errors:
     {_pperrors(self._error_by_code)}
 Articles:
-    Skipped - redirect:     {_pprint(self._article.redirects)}  
-    Skipped - zero vector:  {_pprint(self._article.zero_vectors)}
+    Skipped - redirect:     {_pprint(self._article, "redirects")}  
+    Skipped - zero vector:  {_pprint(self._article, "zero_vectors")}
     Recent URLs:            {_pprint_urls(self._article.recent_urls)}  
             """
-            self._article.recent_urls.clear()
-            return desc
+        self._article.recent_urls.clear()
+        return desc
+
+    def _counter_totals(self) -> dict[str, float]:
+        return {
+            _counter_key(section, counter.name): getattr(section, counter.name)
+            for section in (getattr(self, section_field.name) for section_field in fields(self))
+            if is_dataclass(section)
+            for counter in fields(section)
+            if isinstance(getattr(section, counter.name), (int, float))
+        }
 
     async def metrics_reporter_task(self, pipeline: AsyncPipeline, interval_seconds: int = 10):
         try:
@@ -219,4 +608,16 @@ Articles:
             raise
 
 
+def _counter_key(section: Any, name: str) -> str:
+    # each section is a different dataclass
+    return f"{type(section).__name__}.{name}"
+
+
+def _metric_name(key: str) -> str:
+    """OpenMetrics name for the counter key, e.g. DBMetrics.chunks_inserted is wikichat_db_chunks_inserted"""
+    section, name = key.split(".")
+    section = re.sub(r"(?<=[a-z0-9])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])", "_", section.removesuffix("Metrics"))
+    return f"wikichat_{section.lower()}_{name}"
+
+
 METRICS = _Metrics()
@@ -0,0 +1,52 @@
+"""
+Small HTTP server for the metrics, so they can be scraped rather than read from the logs.
+
+Serves :data:`wikichat.utils.metrics.METRICS` on two paths:
+
+* /metrics - in the OpenMetrics text format, for Prometheus and compatible scrapers
+* /metrics.json - a JSON snapshot, see :meth:`wikichat.utils.metrics._Metrics.snapshot`
+
+The server runs on the event loop of the pipeline, the metrics are read without waiting so it does not slow the
+pipeline down.
+"""
+import logging
+
+from aiohttp import web
+
+from wikichat.utils.metrics import METRICS
+from wikichat.utils.pipeline import AsyncPipeline
+
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+class MetricsServer:
+    """Serves the metrics of the pipeline until stopped, pipeline may be None if this process has no pipeline"""
+
+    def __init__(self, pipeline: AsyncPipeline | None, host: str = "127.0.0.1", port: int = 0):
+        self.pipeline: AsyncPipeline | None = pipeline
+        self.host: str = host
+        self.port: int = port
+        self._runner: web.AppRunner | None = None
+
+    async def start(self) -> 'MetricsServer':
+        app = web.Application()
+        app.router.add_get("/metrics", self._openmetrics)
+        app.router.add_get("/metrics.json", self._json)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logging.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+        return self
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _openmetrics(self, request: web.Request) -> web.Response:
+        # set the header directly, aiohttp does not allow parameters other than charset in content_type
+        return web.Response(text=METRICS.openmetrics(self.pipeline),
+                            headers={"Content-Type": OPENMETRICS_CONTENT_TYPE})
+
+    async def _json(self, request: web.Request) -> web.Response:
+        return web.json_response(METRICS.snapshot(self.pipeline))
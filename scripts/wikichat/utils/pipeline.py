@@ -6,26 +6,257 @@ This is used by :mod:`wikichat.processing` to build a pipeline of commands defin
 """
 import asyncio
 import contextvars
+import heapq
+import itertools
 import logging
+import os
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from enum import IntEnum
 from typing import Callable, Any, Union
 
+from wikichat.utils.checkpoint import CheckpointStore
+from wikichat.utils.retry import RetryPolicy, DeadLetterStore, error_codes
+from wikichat.utils.tracing import TRACER, TRACE_CONTEXT_VAR, SpanContext, TraceContext, SPAN_KIND_QUEUE, \
+    SPAN_KIND_STEP
+
 # used by the pipeline and the log filter to get the worker name
 WORKER_NAME_CONTEXT_VAR = contextvars.ContextVar('worker_name', default="unknown_worker")
+# name of the step the current worker is running, so the latency of client calls can be labelled with it
+STEP_NAME_CONTEXT_VAR = contextvars.ContextVar('step_name', default="")
+
+
+class Priority(IntEnum):
+    """Priority lane of an item in the pipeline, the item keeps its priority through all the steps"""
+    # edits from the listener, users expect to be able to search for these soon after
+    LIVE = 0
+    # bulk loading articles, can wait and can be shed when the pipeline is busy
+    BULK = 1
+
+
+DEFAULT_LANE_WEIGHTS: dict[Priority, int] = {Priority.LIVE: 4, Priority.BULK: 1}
+
+
+@dataclass
+class QueuedItem:
+    """An item waiting in the source queue of a step"""
+    item: Any
+    priority: Priority
+    # id in the CheckpointStore if the queue is checkpointed
+    checkpoint_id: Any = None
+    # number of times the item has failed in this step
+    attempt: int = 0
+    enqueued_at: float = field(default_factory=time.monotonic)
+    # set if the item is being traced, see wikichat.utils.tracing
+    trace: TraceContext | None = None
+
+
+class WeightedLaneQueue:
+    """Queue with a FIFO lane for each priority, used as the source of an :class:`AsyncStep`.
+
+    When more than one lane has items, get() takes from them in proportion to their weights using smooth weighted
+    round robin, so a busy lane cannot starve the others. Supports task_done() and join() like asyncio.Queue.
+    """
+
+    def __init__(self, weights: dict[Priority, int] = None):
+        weights = weights or DEFAULT_LANE_WEIGHTS
+        self._weights: dict[Priority, int] = {priority: max(weights.get(priority, 1), 1) for priority in Priority}
+        self._current: dict[Priority, int] = {priority: 0 for priority in Priority}
+        self._lanes: dict[Priority, deque[QueuedItem]] = {priority: deque() for priority in Priority}
+        self._items = asyncio.Semaphore(0)
+        self._unfinished: int = 0
+        self._finished = asyncio.Event()
+        self._finished.set()
+
+    def qsize(self) -> int:
+        return sum(len(lane) for lane in self._lanes.values())
+
+    def lane_size(self, priority: Priority) -> int:
+        return len(self._lanes[priority])
+
+    def oldest_wait_secs(self, priority: Priority) -> float:
+        """How long the oldest item in the lane has been waiting, 0 if it is empty"""
+        lane = self._lanes[priority]
+        return time.monotonic() - lane[0].enqueued_at if lane else 0.0
+
+    async def put(self, item: Any, priority: Priority = Priority.LIVE, trace: TraceContext = None,
+                  checkpoint_id: Any = None) -> None:
+        self.requeue(QueuedItem(item=item, priority=priority, trace=trace, checkpoint_id=checkpoint_id))
+
+    def requeue(self, queued: QueuedItem) -> None:
+        """Put back an item that was taken with get(), such as a failed item that is being retried"""
+        queued.enqueued_at = time.monotonic()
+        self._lanes[queued.priority].append(queued)
+        self._unfinished += 1
+        self._finished.clear()
+        self._items.release()
+
+    async def get(self) -> QueuedItem:
+        """Returns the next item, pass it to task_done() when finished with it"""
+        await self._items.acquire()
+        ready = [priority for priority, lane in self._lanes.items() if lane]
+        for priority in ready:
+            self._current[priority] += self._weights[priority]
+        chosen = max(ready, key=lambda priority: self._current[priority])
+        self._current[chosen] -= sum(self._weights[priority] for priority in ready)
+        return self._lanes[chosen].popleft()
+
+    def task_done(self, queued: QueuedItem = None) -> None:
+        """Call when finished with an item from get(), pass None if it will be requeued later"""
+        if self._unfinished <= 0:
+            raise ValueError('task_done() called too many times')
+        self._unfinished -= 1
+        if self._unfinished == 0:
+            self._finished.set()
+
+    async def join(self) -> None:
+        await self._finished.wait()
+
+
+class CheckpointedLaneQueue(WeightedLaneQueue):
+    """Lane queue that also keeps its items in a :class:`~wikichat.utils.checkpoint.CheckpointStore`.
+
+    A durable queue adds each item put into it to the store, and then removes the item it came from in the earlier
+    step, passed as the checkpoint_id. A queue that is not durable keeps that checkpoint_id with the item instead, so
+    the item it came from stays in the store until the result reaches the next durable queue. The item in the store
+    is removed when task_done() is called for an item that still has its checkpoint_id, because it was dropped or
+    this is the last step. Items left in the store by an earlier run are put back into the durable queue for their
+    step when it is created.
+    """
+
+    def __init__(self, store: CheckpointStore, step_name: str, weights: dict[Priority, int] = None,
+                 durable: bool = True):
+        super().__init__(weights)
+        self._store = store
+        self._step_name = step_name
+        self.durable: bool = durable
+        self.recovered: int = 0
+        if not durable:
+            return
+        for checkpoint_id, priority, item in store.items(step_name):
+            self.requeue(QueuedItem(item=item, priority=Priority(priority), checkpoint_id=checkpoint_id))
+            self.recovered += 1
+        if self.recovered:
+            logging.info(f"Recovered {self.recovered} checkpointed items for step {step_name}")
+
+    async def put(self, item: Any, priority: Priority = Priority.LIVE, trace: TraceContext = None,
+                  checkpoint_id: Any = None) -> None:
+        if self.durable:
+            # added before the earlier item is removed, so a crash in between processes it twice rather than never
+            new_id = await self._store.add_async(self._step_name, priority, item)
+            if checkpoint_id is not None:
+                self._store.remove_later(checkpoint_id)
+            checkpoint_id = new_id
+        await super().put(item, priority, trace, checkpoint_id)
+
+    def task_done(self, queued: QueuedItem = None) -> None:
+        if queued is not None and queued.checkpoint_id is not None:
+            self._store.remove_later(queued.checkpoint_id)
+        super().task_done(queued)
+
+
+class SpillStore:
+    """Holds items shed from the pipeline until it has room for them, oldest first.
+
+    Items are kept in memory, or appended to a file when there is a path so they do not use memory and are not
+    lost if the process stops. encode and decode convert an item to and from a single line of text.
+    """
+
+    def __init__(self, path: str = "", encode: Callable[[Any], str] = None, decode: Callable[[str], Any] = None):
+        if path and (encode is None or decode is None):
+            raise ValueError("A spill store file needs functions to encode and decode the items")
+        self.path: str = path
+        self._encode = encode
+        self._decode = decode
+        self._memory: deque[Any] = deque()
+        self._count: int = 0
+        # offset of the next line to read in the file
+        self._read_offset: int = 0
+        if path and os.path.exists(path):
+            with open(path, mode='r') as file:
+                self._count = sum(1 for line in file if line.strip())
+            logging.info(f"Spill store {path} has {self._count} items from a previous run")
+
+    def __len__(self) -> int:
+        return self._count
+
+    def put(self, item: Any) -> None:
+        if self.path:
+            with open(self.path, mode='a') as file:
+                file.write(self._encode(item).replace("\n", " ") + "\n")
+        else:
+            self._memory.append(item)
+        self._count += 1
+
+    def take(self, max_items: int) -> list[Any]:
+        """Remove and return up to max_items of the oldest items"""
+        items: list[Any] = []
+        if not self.path:
+            items = [self._memory.popleft() for _ in range(min(max_items, len(self._memory)))]
+            self._count -= len(items)
+            return items
+
+        if not self._count:
+            return items
+        with open(self.path, mode='r') as file:
+            file.seek(self._read_offset)
+            while len(items) < max_items:
+                line = file.readline()
+                if not line:
+                    break
+                if line.strip():
+                    items.append(self._decode(line))
+            self._read_offset = file.tell()
+        self._count -= len(items)
+        if not self._count:
+            # everything has been read, start the file again
+            os.remove(self.path)
+            self._read_offset = 0
+        return items
+
+
+class LoadShedding:
+    """When to shed bulk items from the pipeline to a spill store, and when to take them back.
+
+    Bulk items put to the pipeline are spilled when the total number of items waiting in the step queues is over
+    max_queue_depth, or a live item has been waiting longer than max_live_wait_secs. They are taken back when the
+    queues are below resume_queue_depth and no live item is waiting too long. 0 disables a limit.
+    """
+
+    def __init__(self, spill_store: SpillStore = None, max_queue_depth: int = 0, max_live_wait_secs: float = 0,
+                 resume_queue_depth: int = None, check_interval_secs: float = 0.5):
+        self.spill_store: SpillStore = spill_store if spill_store is not None else SpillStore()
+        self.max_queue_depth: int = max_queue_depth
+        self.max_live_wait_secs: float = max_live_wait_secs
+        self.resume_queue_depth: int = max_queue_depth // 2 if resume_queue_depth is None else resume_queue_depth
+        self.check_interval_secs: float = check_interval_secs
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.max_queue_depth or self.max_live_wait_secs)
 
 
 class AsyncStep:
     """A step in the pipeline that will call the func for each object added to it's source queue"""
 
     def __init__(self, func: Callable[[Any], Any], num_tasks: int,
-                 listener: Callable[['AsyncStep', Any], bool] = None):
+                 listener: Callable[['AsyncStep', Any], bool] = None, lane_weights: dict[Priority, int] = None,
+                 checkpoint: CheckpointStore = None, durable: bool = True):
         self.func: Callable[[Any], Any] = func
         self.name: str = self.func.__name__
         self.num_tasks: int = num_tasks
 
         self._listener = listener
         self._error_listener: Callable[[Exception], None] = None
+        # called with the step name, secs the item waited in the queue, and secs to process it
+        self._latency_listener: Callable[[str, float, float], Any] = None
+        self._retry_scheduler: Union['RetryScheduler', None] = None
 
-        self._source: asyncio.Queue = asyncio.Queue()
+        # items waiting for a durable step survive the process stopping, and the steps that are not durable keep
+        # the item from the durable step before them, see wikichat.utils.checkpoint
+        self._source: WeightedLaneQueue = CheckpointedLaneQueue(checkpoint, self.name, lane_weights, durable) \
+            if checkpoint else WeightedLaneQueue(lane_weights)
         self._next_step: Union['AsyncStep', None] = None
 
         # see start_tasks
@@ -42,19 +273,36 @@ class AsyncStep:
         self.tasks = [asyncio.create_task(self._worker(f"{self.name}-{i}"), name=f"{self.name}-{i}") for i in
                       range(self.num_tasks)]
 
-    async def add_item(self, item: Any) -> bool:
-        await self._source.put(item)
+    async def add_item(self, item: Any, priority: Priority = Priority.LIVE, trace: TraceContext = None,
+                       checkpoint_id: Any = None) -> bool:
+        await self._source.put(item, priority, trace, checkpoint_id)
         return True
 
+    def _start_step_span(self, queued: QueuedItem, started_at: float) -> SpanContext | None:
+        """Record the time a traced item waited in the queue, returns the context for the spans processing it"""
+        if queued.trace is None:
+            return None
+        wait_secs = started_at - queued.enqueued_at
+        TRACER.record(queued.trace, self.name, SPAN_KIND_QUEUE, start=time.time() - wait_secs,
+                      duration_secs=wait_secs, attempt=queued.attempt)
+        return SpanContext(queued.trace, queued.trace.root_span_id)
+
     async def _worker(self, worker_name: str):
         while True:
 
-            item = await self._source.get()
+            queued: QueuedItem = await self._source.get()
+            started_at = time.monotonic()
+            item = queued.item
+            retrying = False
             # We call the listener here before passing to the worker.
             # The listener can decide to not pass the item to the worker, or if somethign should be done
             # before the worker starts. The listener can use a lock to step all other workers starting until it is done.
             # listener need to handle async
             context_token = WORKER_NAME_CONTEXT_VAR.set(worker_name)
+            step_token = STEP_NAME_CONTEXT_VAR.set(self.name)
+            trace_token = TRACE_CONTEXT_VAR.set(self._start_step_span(queued, started_at))
+            trace_finished = True
+            trace_error = ""
             try:
                 if self._listener is None:
                     process_item = True
@@ -62,13 +310,25 @@ class AsyncStep:
                     process_item: bool = await self._listener(self, item)
                 if not process_item:
                     continue
-                result = await self.func(item)
+                with TRACER.span(self.name, SPAN_KIND_STEP, attempt=queued.attempt):
+                    result = await self.func(item)
 
                 if result is not None and self._next_step:
                     # there is no dest when this is the last step
-                    await self._next_step.add_item(result)
+                    await self._next_step.add_item(result, queued.priority, queued.trace, queued.checkpoint_id)
+                    # the next step has the checkpoint now
+                    queued.checkpoint_id = None
+                    trace_finished = False
             except Exception as e:
-                logging.exception(f"Error in worker, item will be dropped - {e}", exc_info=True)
+                if self._retry_scheduler is not None:
+                    # the scheduler puts the item back into our queue when it is due, or dead letters it
+                    retrying = await self._retry_scheduler.schedule(self, queued, e)
+                trace_finished = not retrying
+                trace_error = type(e).__name__
+                if retrying:
+                    logging.warning(f"Error in worker, item will be retried - {e}")
+                else:
+                    logging.exception(f"Error in worker, item will be dropped - {e}", exc_info=True)
                 # Second log is to get the details into the debug so we can fix, first is to get it into
                 # heroku or other log aggregators
                 logging.debug(f"Error in worker {worker_name}", exc_info=True)
@@ -78,25 +338,142 @@ class AsyncStep:
                     except Exception as e2:
                         logging.exception(f"Error in error listener - {e2}", exc_info=False)
             finally:
+                TRACE_CONTEXT_VAR.reset(trace_token)
+                STEP_NAME_CONTEXT_VAR.reset(step_token)
                 WORKER_NAME_CONTEXT_VAR.reset(context_token)
+                if queued.trace is not None and trace_finished:
+                    TRACER.end_trace(queued.trace, last_step=self.name, error=trace_error)
+                if self._latency_listener:
+                    try:
+                        await self._latency_listener(self.name, started_at - queued.enqueued_at,
+                                                     time.monotonic() - started_at)
+                    except Exception as e3:
+                        logging.exception(f"Error in latency listener - {e3}", exc_info=False)
+
+            # a retried item is still waiting, keep its checkpoint
+            self._source.task_done(None if retrying else queued)
+
+
+class RetryScheduler:
+    """Holds items that failed in a step until their retry is due, then puts them back into the step.
+
+    The delay and number of retries come from the :class:`~wikichat.utils.retry.RetryPolicy` rule for the error. A
+    single task waits for the next item that is due, so the workers carry on with other items in the meantime. Items
+    that run out of retries are added to the dead letter store if there is one, otherwise they are dropped.
+    """
+
+    def __init__(self, policy: RetryPolicy = None, dead_letters: DeadLetterStore = None,
+                 listener: Callable[[dict[str, int], int, int], Any] = None):
+        self.policy: RetryPolicy = policy if policy is not None else RetryPolicy()
+        self.dead_letters: DeadLetterStore | None = dead_letters
+        # called with the error codes, and the number of items retried and dead lettered
+        self._listener = listener
+        # (due at, sequence to keep the order of items due at the same time, step, queued item)
+        self._delayed: list[tuple[float, int, AsyncStep, QueuedItem]] = []
+        self._sequence = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._empty = asyncio.Event()
+        self._empty.set()
+        self._task: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self._delayed)
+
+    async def schedule(self, step: AsyncStep, queued: QueuedItem, error: Exception) -> bool:
+        """Schedule a retry of the failed item, returns False if it has run out of retries"""
+        codes = error_codes(error)
+        rule = self.policy.rule_for(codes)
+        if queued.attempt >= rule.max_retries:
+            if self.dead_letters:
+                self.dead_letters.add(step.name, queued.priority, queued.item, error, next(iter(codes)),
+                                      queued.attempt + 1)
+                logging.warning(f"Item failed in step {step.name} after {queued.attempt + 1} attempts, "
+                                f"added to the dead letters in {self.dead_letters.path}")
+            await self._notify(codes, dead_lettered=1)
+            return False
+
+        delay = rule.delay_secs(queued.attempt)
+        queued.attempt += 1
+        heapq.heappush(self._delayed, (time.monotonic() + delay, next(self._sequence), step, queued))
+        self._empty.clear()
+        self._wakeup.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._requeue_when_due(), name="retry_scheduler")
+        await self._notify(codes, retried=1)
+        return True
+
+    async def join(self) -> None:
+        """Wait until all the delayed items have been put back into their steps"""
+        await self._empty.wait()
+
+    def cancel(self) -> asyncio.Task | None:
+        if self._task:
+            self._task.cancel()
+        return self._task
+
+    async def _requeue_when_due(self) -> None:
+        while True:
+            self._wakeup.clear()
+            if not self._delayed:
+                await self._wakeup.wait()
+                continue
+
+            wait_secs = self._delayed[0][0] - time.monotonic()
+            if wait_secs > 0:
+                try:
+                    # woken early if an item is scheduled that is due sooner
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait_secs)
+                except asyncio.TimeoutError:
+                    pass
+                continue
 
-            self._source.task_done()
+            _, _, step, queued = heapq.heappop(self._delayed)
+            step._source.requeue(queued)
+            if not self._delayed:
+                self._empty.set()
+
+    async def _notify(self, codes: dict[str, int], retried: int = 0, dead_lettered: int = 0) -> None:
+        if self._listener:
+            await self._listener(codes, retried, dead_lettered)
+
+
+_PUT_COUNT = "pipeline_put_count"
 
 
 class AsyncPipeline:
     """The pipeline of :class:`AsyncStep` that will process items through the steps"""
 
-    def __init__(self, max_items: int = 0, error_listener: Callable[[Exception], None] = None):
+    def __init__(self, max_items: int = 0, error_listener: Callable[[Exception], None] = None,
+                 load_shedding: LoadShedding = None, shedding_listener: Callable[[int, int], Any] = None,
+                 checkpoint: CheckpointStore = None, retry_scheduler: RetryScheduler = None,
+                 latency_listener: Callable[[str, float, float], Any] = None,
+                 trace_label: Callable[[Any], str] = repr):
         self.steps: list[AsyncStep] = []
-        self._put_count: int = 0
+        # failed items are retried when this is set, otherwise they are dropped
+        self.retry_scheduler: RetryScheduler | None = retry_scheduler
+        # keeps the count of items put until the pipeline finishes, so a restart does not go past max_items
+        self.checkpoint: CheckpointStore | None = checkpoint
+        self._put_count: int = checkpoint.get_counter(_PUT_COUNT) if checkpoint else 0
         self.max_items: int = max_items
         self._error_listener = error_listener
+        self._latency_listener = latency_listener
+        # identifies the item in the traces, see wikichat.utils.tracing
+        self._trace_label = trace_label
         self._async_lock = asyncio.Lock()
 
+        self.load_shedding: LoadShedding = load_shedding if load_shedding is not None else LoadShedding()
+        # called with the number of items shed and restored
+        self._shedding_listener = shedding_listener
+        self._restore_task: asyncio.Task | None = None
+        if self.load_shedding.enabled:
+            self._restore_task = asyncio.create_task(self._restore_shed_items(), name="restore_shed_items")
+
     def add_step(self, step: AsyncStep) -> 'AsyncPipeline':
         if self.steps:
             self.steps[-1]._next_step = step
         step._error_listener = self._error_listener
+        step._latency_listener = self._latency_listener
+        step._retry_scheduler = self.retry_scheduler
         self.steps.append(step)
         # start now because we may have changed the source queue
         step.start_tasks()
@@ -108,24 +485,69 @@ class AsyncPipeline:
         self.add_step(step)
         return self
 
-    async def put_to_first_step(self, item: Any) -> bool:
+    async def put_to_first_step(self, item: Any, priority: Priority = Priority.LIVE) -> bool:
         async with self._async_lock:
             if not self.max_items or self._put_count < self.max_items:
-                await self.steps[0].add_item(item)
+                if priority == Priority.BULK and self.load_shedding.enabled and (
+                        self.load_shedding.spill_store or self._should_shed()):
+                    # keep bulk items in order, once we have started shedding they all go to the spill store
+                    # until it has been emptied
+                    self.load_shedding.spill_store.put(item)
+                    await self._notify_shedding(shed=1)
+                else:
+                    await self.steps[0].add_item(item, priority, self._start_trace(item, priority))
                 self._put_count += 1
+                if self.checkpoint:
+                    self.checkpoint.set_counter_later(_PUT_COUNT, self._put_count)
                 return True
             else:
                 return False
 
+    async def put_to_step(self, step_name: str, item: Any, priority: Priority = Priority.LIVE) -> None:
+        """Put an item straight into a step, such as a dead letter being replayed. Does not count towards max_items"""
+        step = next((step for step in self.steps if step.name == step_name), None)
+        if step is None:
+            raise ValueError(f"Unknown step {step_name}, expected one of {[step.name for step in self.steps]}")
+        await step.add_item(item, priority, self._start_trace(item, priority, first_step=step_name))
+
+    def _start_trace(self, item: Any, priority: Priority, **attributes) -> TraceContext | None:
+        return TRACER.start_trace(self._trace_label(item), priority=priority.name.lower(), **attributes) \
+            if TRACER.enabled else None
+
     def queue_depths(self) -> dict[str, int]:
         return {step.name: step._source.qsize() for step in self.steps}
 
+    def lane_depths(self) -> dict[str, int]:
+        """Number of items waiting in each priority lane across all the steps, and in the spill store"""
+        depths = {
+            priority.name.lower(): sum(step._source.lane_size(priority) for step in self.steps)
+            for priority in Priority
+        }
+        depths["spilled"] = len(self.load_shedding.spill_store)
+        return depths
+
+    def live_wait_secs(self) -> float:
+        """How long the oldest live item waiting in any step has been waiting"""
+        return max((step._source.oldest_wait_secs(Priority.LIVE) for step in self.steps), default=0.0)
+
     async def join_all_steps(self):
         logging.info("Waiting for all step source queues to be empty")
-        for step in self.steps:
-            # the steps dest is the source for the next step
-            logging.info(f"Waiting for step {step.name} source queue to be empty")
-            await step._source.join()
+        while True:
+            for step in self.steps:
+                # the steps dest is the source for the next step
+                logging.info(f"Waiting for step {step.name} source queue to be empty")
+                await step._source.join()
+            if self.retry_scheduler is not None and len(self.retry_scheduler):
+                logging.info(f"Waiting for {len(self.retry_scheduler)} items to be retried")
+                await self.retry_scheduler.join()
+            elif self.load_shedding.spill_store:
+                logging.info(f"Restoring {len(self.load_shedding.spill_store)} shed items")
+                await self._restore(force=True)
+            else:
+                break
+        if self.checkpoint:
+            # finished, the next run starts counting again
+            self.checkpoint.set_counter_later(_PUT_COUNT, 0)
         logging.info("All step source queues are empty")
         return
 
@@ -134,16 +556,67 @@ class AsyncPipeline:
 
     async def cancel_and_gather(self):
         logging.info("Cancelling all tasks")
-        for task in self.tasks():
+        background_tasks = [self._restore_task, self.retry_scheduler.cancel() if self.retry_scheduler is not None else None]
+        background_tasks = [task for task in background_tasks if task]
+        for task in self.tasks() + background_tasks:
             logging.info(f"Cancelling task {task}")
             task.cancel()
         logging.info("Gathering all tasks")
-        await asyncio.gather(*self.tasks(), return_exceptions=True)
+        await asyncio.gather(*self.tasks(), *background_tasks, return_exceptions=True)
+        if self.checkpoint:
+            self.checkpoint.close()
+        if self.retry_scheduler is not None and self.retry_scheduler.dead_letters:
+            self.retry_scheduler.dead_letters.close()
+
+    def _should_shed(self) -> bool:
+        shedding = self.load_shedding
+        if not shedding.enabled:
+            return False
+        depth = sum(self.queue_depths().values())
+        return bool((shedding.max_queue_depth and depth >= shedding.max_queue_depth) or
+                    (shedding.max_live_wait_secs and self.live_wait_secs() >= shedding.max_live_wait_secs))
+
+    async def _restore(self, force: bool = False) -> None:
+        """Move shed items back to the first step, up to the resume depth, or all of them when forced"""
+        shedding = self.load_shedding
+        async with self._async_lock:
+            if force:
+                room = len(shedding.spill_store)
+            elif shedding.max_live_wait_secs and self.live_wait_secs() >= shedding.max_live_wait_secs:
+                return
+            elif shedding.max_queue_depth:
+                room = shedding.resume_queue_depth - sum(self.queue_depths().values())
+            else:
+                room = len(shedding.spill_store)
+            if room <= 0:
+                return
+            items = shedding.spill_store.take(room)
+            for item in items:
+                await self.steps[0].add_item(item, Priority.BULK,
+                                             self._start_trace(item, Priority.BULK, restored=True))
+        if items:
+            logging.debug(f"Restored {len(items)} shed items, {len(shedding.spill_store)} still shed")
+            await self._notify_shedding(restored=len(items))
+
+    async def _restore_shed_items(self) -> None:
+        while True:
+            await asyncio.sleep(self.load_shedding.check_interval_secs)
+            if self.steps and self.load_shedding.spill_store:
+                try:
+                    await self._restore()
+                except Exception:
+                    logging.exception("Error restoring shed items, will retry")
+
+    async def _notify_shedding(self, shed: int = 0, restored: int = 0) -> None:
+        if self._shedding_listener:
+            await self._shedding_listener(shed, restored)
 
 
 class WorkerNameLoggingFilter(logging.Filter):
     """Add the worker name to the log record"""
 
     def filter(self, record):
-        record.worker_name = WORKER_NAME_CONTEXT_VAR.get()
+        # records from the shard processes already have the name of the worker that logged them
+        if not hasattr(record, "worker_name"):
+            record.worker_name = WORKER_NAME_CONTEXT_VAR.get()
         return True
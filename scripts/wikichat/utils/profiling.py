@@ -0,0 +1,296 @@
+"""
+Profiling for a long running pipeline process, so we can see what is slowing down the event loop while it runs.
+
+Everything here is done by the single PROFILER object, configured from the command line, see
+:class:`wikichat.commands.model.CommonPipelineArgs`.
+
+* Event loop lag: a task that sleeps for a short interval records how late it wakes up in METRICS. Any CPU heavy
+  work on the loop, such as parsing a large article, shows up as lag for every other task.
+* Slow callbacks: a watchdog thread notices when the loop has not woken the lag task for longer than
+  slow_callback_ms, and takes the stack of the loop thread while it is still blocked. The code that blocked the loop
+  is logged and counted in METRICS by where it is in our code.
+* Captures: for profile_secs, either sampling the stack of the loop thread from the watchdog thread, written as
+  folded stacks for flame graph tools, or running cProfile on the loop thread, written as a pstats file and a text
+  summary. A capture is started by sending SIGUSR1 to the process, or profile_after_secs after starting.
+* Memory: when tracemalloc_frames is set, tracemalloc is started and each SIGUSR2, and each capture, writes the
+  allocations that have grown the most since the previous snapshot.
+
+The files are written to the logs directory, named with the process id so the worker processes do not overwrite each
+other.
+"""
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, deque
+from types import FrameType
+
+from wikichat.utils.metrics import METRICS
+
+# same as the log files, see wiki_data.py
+DEFAULT_OUTPUT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                  "logs")
+PROFILERS = ("sample", "cprofile")
+
+_APP_PACKAGE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Profiler:
+
+    def __init__(self):
+        self.configure()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._loop_thread_id: int | None = None
+        self._lag_task: asyncio.Task | None = None
+        self._watchdog: threading.Thread | None = None
+        self._stopping = threading.Event()
+        # monotonic time the lag task last woke up, read by the watchdog thread
+        self._last_beat: float = 0.0
+        # stacks taken by the watchdog while the loop was blocked, for the lag task to report once it wakes up
+        self._blocked_stacks: deque[tuple[str, str]] = deque(maxlen=100)
+        self._capture_task: asyncio.Task | None = None
+        self._samples: Counter[str] | None = None
+        self._last_snapshot: tracemalloc.Snapshot | None = None
+
+    def configure(self, lag_interval_secs: float = 0.5, slow_callback_ms: float = 100, profiler: str = "sample",
+                  profile_secs: float = 30, profile_after_secs: float = -1, sample_interval_ms: float = 5,
+                  tracemalloc_frames: int = 0, output_dir: str = DEFAULT_OUTPUT_DIR) -> 'Profiler':
+        """Call before start(). lag_interval_secs 0 disables the lag task and the slow callback watchdog, and
+        slow_callback_ms 0 disables the watchdog. profile_after_secs -1 to only capture when signalled."""
+        if profiler not in PROFILERS:
+            raise ValueError(f"Unknown profiler {profiler}, expected one of {PROFILERS}")
+        self.lag_interval_secs: float = lag_interval_secs
+        self.slow_callback_secs: float = slow_callback_ms / 1000
+        self.profiler: str = profiler
+        self.profile_secs: float = profile_secs
+        self.profile_after_secs: float = profile_after_secs
+        self.sample_interval_secs: float = sample_interval_ms / 1000
+        self.tracemalloc_frames: int = tracemalloc_frames
+        self.output_dir: str = output_dir
+        return self
+
+    async def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._stopping.clear()
+
+        if self.lag_interval_secs > 0:
+            self._last_beat = time.monotonic()
+            self._lag_task = asyncio.create_task(self._measure_lag(), name="loop_lag_monitor")
+            if self.slow_callback_secs > 0:
+                self._watchdog = threading.Thread(target=self._watch_loop, name="loop_watchdog", daemon=True)
+                self._watchdog.start()
+
+        if self.tracemalloc_frames > 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(self.tracemalloc_frames)
+            logging.info(f"Started tracemalloc with {self.tracemalloc_frames} frames, send SIGUSR2 to process "
+                         f"{os.getpid()} to write the allocations that have grown")
+
+        try:
+            self._loop.add_signal_handler(signal.SIGUSR1, self.start_capture)
+            if self.tracemalloc_frames > 0:
+                self._loop.add_signal_handler(signal.SIGUSR2, self._snapshot_memory_soon)
+            logging.info(f"Send SIGUSR1 to process {os.getpid()} to {self.profiler} profile the event loop for "
+                         f"{self.profile_secs}s")
+        except (NotImplementedError, AttributeError, RuntimeError):
+            # no SIGUSR signals on Windows, or we are not on the main thread
+            logging.info("Profiling signals are not available, use --profile_after_secs to profile")
+
+        if self.profile_after_secs >= 0:
+            self._loop.call_later(self.profile_after_secs, self.start_capture)
+
+    async def stop(self) -> None:
+        self._stopping.set()
+        for task in (self._lag_task, self._capture_task):
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._lag_task = self._capture_task = None
+        if self._watchdog is not None:
+            self._watchdog.join(timeout=self.lag_interval_secs * 2)
+            self._watchdog = None
+        if self._loop is not None:
+            for sig in (signal.SIGUSR1, signal.SIGUSR2):
+                try:
+                    self._loop.remove_signal_handler(sig)
+                except (NotImplementedError, AttributeError, RuntimeError, ValueError):
+                    pass
+
+    def start_capture(self) -> None:
+        """Start a capture with the configured profiler, called by the signal handler on the loop"""
+        if self._capture_task is not None and not self._capture_task.done():
+            logging.warning("A profile capture is already running, ignoring the request for another")
+            return
+        self._capture_task = asyncio.create_task(self._capture(), name="profile_capture")
+
+    # ==================================================================================================================
+    # Event loop lag and slow callbacks
+    # ==================================================================================================================
+
+    async def _measure_lag(self) -> None:
+        while True:
+            expected = time.monotonic() + self.lag_interval_secs
+            await asyncio.sleep(self.lag_interval_secs)
+            now = time.monotonic()
+            self._last_beat = now
+            lag = max(now - expected, 0.0)
+            await METRICS.observe_loop_lag(lag)
+
+            while self._blocked_stacks:
+                site, stack = self._blocked_stacks.popleft()
+                logging.warning(f"Event loop was blocked for {lag * 1000:.0f}ms at {site}, stack when it was "
+                                f"blocked:\n{stack}")
+                await METRICS.update_slow_callbacks(site)
+
+    def _watch_loop(self) -> None:
+        """Runs in the watchdog thread, takes the stack of the loop thread once each time it is blocked"""
+        reported_beat = 0.0
+        while not self._stopping.wait(min(self.slow_callback_secs, self.lag_interval_secs) / 2):
+            last_beat = self._last_beat
+            blocked_secs = time.monotonic() - last_beat - self.lag_interval_secs
+            if blocked_secs >= self.slow_callback_secs and last_beat != reported_beat:
+                reported_beat = last_beat
+                frame = sys._current_frames().get(self._loop_thread_id)
+                if frame is not None:
+                    self._blocked_stacks.append((_app_site(frame), _format_stack(frame)))
+
+    # ==================================================================================================================
+    # Captures
+    # ==================================================================================================================
+
+    async def _capture(self) -> None:
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        os.makedirs(self.output_dir, exist_ok=True)
+        logging.info(f"Starting {self.profiler} profile of the event loop for {self.profile_secs}s")
+        try:
+            if self.profiler == "cprofile":
+                await self._capture_cprofile(name)
+            else:
+                await self._capture_samples(name)
+        finally:
+            self._samples = None
+        if self.tracemalloc_frames > 0:
+            await self._snapshot_memory(name)
+
+    async def _capture_cprofile(self, name: str) -> None:
+        # cProfile only sees the thread it is enabled on, which is the loop thread as we are on the loop
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            await asyncio.sleep(self.profile_secs)
+        finally:
+            profile.disable()
+
+        path = os.path.join(self.output_dir, f"cprofile-{name}.prof")
+        profile.dump_stats(path)
+        summary = io.StringIO()
+        pstats.Stats(profile, stream=summary).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(40)
+        with open(os.path.join(self.output_dir, f"cprofile-{name}.txt"), mode='w') as file:
+            file.write(summary.getvalue())
+        logging.info(f"Wrote cProfile stats to {path}, view with python -m pstats or snakeviz")
+
+    async def _capture_samples(self, name: str) -> None:
+        self._samples = Counter()
+        sampler = threading.Thread(target=self._sample_loop, args=(time.monotonic() + self.profile_secs,),
+                                   name="loop_sampler", daemon=True)
+        sampler.start()
+        while sampler.is_alive():
+            await asyncio.sleep(min(self.profile_secs, 1.0))
+        samples = self._samples
+
+        path = os.path.join(self.output_dir, f"profile-{name}.folded")
+        with open(path, mode='w') as file:
+            for stack, count in samples.most_common():
+                file.write(f"{stack} {count}\n")
+
+        total = sum(samples.values()) or 1
+        leaves = Counter()
+        for stack, count in samples.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        top = "\n    ".join(f"{count / total:>6.1%} {leaf}" for leaf, count in leaves.most_common(15))
+        logging.info(f"Wrote {total} stack samples of the event loop to {path}, view with speedscope or "
+                     f"flamegraph.pl. Functions seen most often:\n    {top}")
+
+    def _sample_loop(self, until: float) -> None:
+        """Runs in the sampler thread, the samples include the time the loop is waiting in select"""
+        samples = self._samples
+        while time.monotonic() < until and not self._stopping.is_set():
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is not None:
+                samples[_folded_stack(frame)] += 1
+            time.sleep(self.sample_interval_secs)
+
+    # ==================================================================================================================
+    # Memory
+    # ==================================================================================================================
+
+    def _snapshot_memory_soon(self) -> None:
+        asyncio.create_task(self._snapshot_memory(f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"))
+
+    async def _snapshot_memory(self, name: str) -> None:
+        if not tracemalloc.is_tracing():
+            return
+        # taking and comparing snapshots of a large heap takes a while, keep it off the loop
+        snapshot = await asyncio.get_running_loop().run_in_executor(None, tracemalloc.take_snapshot)
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        previous, self._last_snapshot = self._last_snapshot, snapshot
+        if previous is None:
+            stats = await asyncio.get_running_loop().run_in_executor(None, snapshot.statistics, "lineno")
+            title = "Largest allocations by line, the next snapshot shows what has grown since this one"
+        else:
+            stats = await asyncio.get_running_loop().run_in_executor(None, snapshot.compare_to, previous, "lineno")
+            title = "Allocations that grew the most since the previous snapshot"
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, f"tracemalloc-{name}.txt")
+        current, peak = tracemalloc.get_traced_memory()
+        with open(path, mode='w') as file:
+            file.write(f"Traced memory {current / 1024 / 1024:.1f} MB, peak {peak / 1024 / 1024:.1f} MB\n{title}\n")
+            for stat in stats[:30]:
+                file.write(f"{stat}\n")
+        logging.info(f"Wrote tracemalloc snapshot to {path}, traced memory {current / 1024 / 1024:.1f} MB")
+
+
+def _frames(frame: FrameType) -> list[FrameType]:
+    """Frames of the stack from the outermost to the innermost"""
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    frames.reverse()
+    return frames
+
+
+def _frame_name(frame: FrameType) -> str:
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}"
+
+
+def _folded_stack(frame: FrameType) -> str:
+    return ";".join(_frame_name(f) for f in _frames(frame))
+
+
+def _app_site(frame: FrameType) -> str:
+    """Where in our code the stack is, the innermost frame in the wikichat package, or the innermost frame"""
+    frames = _frames(frame)
+    site = next((f for f in reversed(frames) if f.f_code.co_filename.startswith(_APP_PACKAGE)), frames[-1])
+    path = os.path.relpath(site.f_code.co_filename, os.path.dirname(_APP_PACKAGE)) \
+        if site.f_code.co_filename.startswith(_APP_PACKAGE) else os.path.basename(site.f_code.co_filename)
+    return f"{path}:{site.f_lineno} {site.f_code.co_name}"
+
+
+def _format_stack(frame: FrameType, limit: int = 15) -> str:
+    return "\n".join(f"    {f.f_code.co_filename}:{f.f_lineno} {f.f_code.co_name}" for f in _frames(frame)[-limit:])
+
+
+# Configured by wikichat.cli.run_pipeline
+PROFILER = Profiler()
@@ -0,0 +1,151 @@
+"""
+Recordings of a server-sent events stream, such as the Wikipedia recent changes, so they can be replayed to the
+listener later at the speed they arrived, faster, or as fast as the listener can take them.
+
+A recording is a directory of gzipped JSON lines files, one event per line::
+
+    {"received_at": 1700000000.123, "id": "[{\"topic\": ...}]", "type": "message", "data": "{\"title\": ...}"}
+
+The event data is kept as the raw text sent by the server, so replaying it goes through the same parsing as the live
+stream. :class:`RecordingWriter` starts a new file when the current one has too many events or is too old, and
+deletes the oldest files to keep a maximum number. The files are named with the time they were started so they sort
+in the order they were written.
+
+A line can also be just the JSON of an event, as in the events files made for the ingest-bench command before there
+were recordings. It is read as a message event received at time 0, so it is replayed without waiting.
+
+This module should not import other parts of the wikichat application.
+"""
+import asyncio
+import gzip
+import json
+import logging
+import os
+import time
+import zlib
+from dataclasses import dataclass, asdict
+from datetime import datetime, timezone
+from typing import AsyncIterator, Iterable, Iterator, TextIO
+
+RECORDING_PREFIX = "changes-"
+RECORDING_SUFFIX = ".jsonl.gz"
+
+
+@dataclass
+class RecordedEvent:
+    # wall clock time the event was read from the stream
+    received_at: float
+    id: str
+    type: str
+    data: str
+
+
+class RecordingWriter:
+    """Writes events to the current file of the recording, starting a new file when it is full or old"""
+
+    def __init__(self, directory: str, max_file_events: int = 100_000, max_file_secs: float = 3600,
+                 max_files: int = 0):
+        self.directory: str = directory
+        self.max_file_events: int = max_file_events
+        self.max_file_secs: float = max_file_secs
+        # 0 to keep all the files
+        self.max_files: int = max_files
+        self.events_written: int = 0
+        self._file: TextIO | None = None
+        self._file_events: int = 0
+        self._file_started: float = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, event: RecordedEvent) -> None:
+        if self._file is None or self._file_full():
+            self._rotate()
+        self._file.write(json.dumps(asdict(event)) + "\n")
+        self._file_events += 1
+        self.events_written += 1
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _file_full(self) -> bool:
+        return ((self.max_file_events and self._file_events >= self.max_file_events) or
+                (self.max_file_secs and time.monotonic() - self._file_started >= self.max_file_secs))
+
+    def _rotate(self) -> None:
+        self.close()
+        started = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+        path = os.path.join(self.directory, f"{RECORDING_PREFIX}{started}{RECORDING_SUFFIX}")
+        logging.info(f"Recording events to {path}")
+        self._file = gzip.open(path, mode='wt', encoding='utf-8')
+        self._file_events = 0
+        self._file_started = time.monotonic()
+
+        if self.max_files:
+            for old_path in recording_files(self.directory)[:-self.max_files]:
+                logging.info(f"Deleting old recording file {old_path}")
+                os.remove(old_path)
+
+
+def recording_files(path: str) -> list[str]:
+    """The files of the recording in the order they were written, path can be a directory or a single file"""
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, name) for name in os.listdir(path)
+                      if name.startswith(RECORDING_PREFIX) and name.endswith((RECORDING_SUFFIX, ".jsonl")))
+    return [path]
+
+
+def read_recording(path: str) -> Iterator[RecordedEvent]:
+    """The events in the recording, path can be a directory or a single file, which can be gzipped.
+
+    A file that was cut off, such as the last file when the record command was killed, is read up to the last
+    complete line and the rest of it is skipped.
+    """
+    for file_path in recording_files(path):
+        yield from _read_file(file_path)
+
+
+def _read_file(file_path: str) -> Iterator[RecordedEvent]:
+    opener = gzip.open if file_path.endswith(".gz") else open
+    with opener(file_path, mode='rt', encoding='utf-8') as file:
+        line_num = 0
+        while True:
+            try:
+                line = file.readline()
+                line_num += 1
+                if not line:
+                    return
+                if not line.strip():
+                    continue
+                event = _parse_line(line)
+            except (EOFError, OSError, zlib.error, ValueError, TypeError) as e:
+                # a truncated gzip stream raises EOFError, a partly written line does not parse
+                logging.warning(f"Skipping the rest of {file_path} from line {line_num}, it was cut off - {e!r}")
+                return
+            yield event
+
+
+def _parse_line(line: str) -> RecordedEvent:
+    doc = json.loads(line)
+    if "received_at" in doc and "data" in doc:
+        return RecordedEvent(**doc)
+    # an event on its own, the data is the line as it was written
+    return RecordedEvent(received_at=0.0, id="", type="message", data=line.strip())
+
+
+async def replay(events: Iterable[RecordedEvent], speed: float = 1.0) -> AsyncIterator[RecordedEvent]:
+    """Yield the events with the gaps between them they were received with, divided by the speed.
+
+    A speed of 0 yields them as fast as they are read. When the consumer falls behind the events are yielded without
+    waiting until it catches up, so the replay keeps to the original schedule rather than the gaps.
+    """
+    first_received: float | None = None
+    start = time.monotonic()
+    for event in events:
+        if speed > 0:
+            if first_received is None:
+                first_received = event.received_at
+            delay = start + (event.received_at - first_received) / speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        yield event
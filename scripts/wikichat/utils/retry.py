@@ -0,0 +1,146 @@
+"""
+When to retry an item that failed in a pipeline step, and where to keep the items that ran out of retries.
+
+Errors are identified by the codes from :func:`error_codes`, the Astra API errorCode or message, or the class name
+of the exception. A :class:`RetryPolicy` has a :class:`RetryRule` for some codes, and a default rule for the others.
+The retries themselves are scheduled by :class:`wikichat.utils.pipeline.RetryScheduler` so they do not hold a worker.
+
+Items that run out of retries are added to a :class:`DeadLetterStore`, a SQLite file they can be replayed from with
+the replay-dead-letters command.
+
+This module should not import other parts of the wikichat application.
+"""
+import json
+import logging
+import pickle
+import random
+import sqlite3
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterator
+
+from dataclasses_json import dataclass_json
+
+
+def error_codes(error: Exception) -> dict[str, int]:
+    """Count of each error code in the error, Astra API errors can have more than one"""
+    # API errors will be
+    # ValueError: [{"message": "Failed to update documents with _id ["recent_articles"]: Unable to complete transaction due to concurrent transactions", "errorCode": "CONCURRENCY_FAILURE"}]
+    # ValueError: [{"message": "Query timed out after PT30S"}]
+    codes: dict[str, int] = dict()
+
+    if isinstance(error, ValueError):
+        api_errors: list[Any] = []
+        try:
+            api_errors = json.loads(error.args[0])
+        except:
+            pass
+        if not isinstance(api_errors, list):
+            api_errors = []
+        for api_error in api_errors:
+            match api_error:
+                case {"errorCode": code}:
+                    codes[code] = codes.get(code, 0) + 1
+                case {"message": message}:
+                    codes[message] = codes.get(message, 0) + 1
+                case _:
+                    codes["Unknown API ERROR"] = codes.get("Unknown API ERROR", 0) + 1
+    if not codes:
+        # just collection by the error type
+        codes[error.__class__.__name__] = 1
+    return codes
+
+
+@dataclass_json
+@dataclass
+class RetryRule:
+    """Retry up to max_retries times, waiting base_delay_secs doubled for each attempt up to max_delay_secs"""
+    max_retries: int = 3
+    base_delay_secs: float = 1.0
+    max_delay_secs: float = 60.0
+
+    def delay_secs(self, attempt: int) -> float:
+        """Delay before retry number attempt, starting at 0, with jitter so failed items do not all retry together"""
+        delay = min(self.base_delay_secs * (2 ** attempt), self.max_delay_secs)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+# Transient errors from Astra, these are worth more retries
+DEFAULT_RETRY_RULES: dict[str, RetryRule] = {
+    "CONCURRENCY_FAILURE": RetryRule(max_retries=5, base_delay_secs=0.5),
+    "Query timed out after PT30S": RetryRule(max_retries=5, base_delay_secs=2.0),
+}
+
+
+@dataclass
+class RetryPolicy:
+    default: RetryRule = field(default_factory=RetryRule)
+    rules: dict[str, RetryRule] = field(default_factory=lambda: dict(DEFAULT_RETRY_RULES))
+
+    @classmethod
+    def from_json(cls, default: RetryRule, rules_json: str = "") -> 'RetryPolicy':
+        """Policy with the default rules, overridden by a JSON object of rules by error code"""
+        rules = dict(DEFAULT_RETRY_RULES)
+        if rules_json:
+            rules.update({code: RetryRule.from_dict(rule) for code, rule in json.loads(rules_json).items()})
+        return cls(default=default, rules=rules)
+
+    def rule_for(self, codes: dict[str, int]) -> RetryRule:
+        """Rule for the first of the codes that has one, otherwise the default"""
+        return next((self.rules[code] for code in codes if code in self.rules), self.default)
+
+
+@dataclass
+class DeadLetter:
+    id: int
+    step: str
+    priority: int
+    error_code: str
+    error: str
+    attempts: int
+    failed_at: float
+    item: Any
+
+
+class DeadLetterStore:
+    """Items that ran out of retries in a SQLite file, with the step they failed in so they can be put back there."""
+
+    def __init__(self, path: str, encode: Callable[[Any], bytes] = pickle.dumps,
+                 decode: Callable[[bytes], Any] = pickle.loads):
+        self.path: str = path
+        self._encode = encode
+        self._decode = decode
+        self._conn = sqlite3.connect(path, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS dead_letters ("
+                           "id INTEGER PRIMARY KEY AUTOINCREMENT, step TEXT NOT NULL, priority INTEGER NOT NULL, "
+                           "error_code TEXT NOT NULL, error TEXT NOT NULL, attempts INTEGER NOT NULL, "
+                           "failed_at REAL NOT NULL, payload BLOB NOT NULL)")
+
+    def add(self, step: str, priority: int, item: Any, error: Exception, error_code: str, attempts: int) -> int:
+        return self._conn.execute(
+            "INSERT INTO dead_letters (step, priority, error_code, error, attempts, failed_at, payload) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (step, int(priority), error_code, repr(error), attempts, time.time(), self._encode(item))).lastrowid
+
+    def remove(self, letter_id: int) -> None:
+        self._conn.execute("DELETE FROM dead_letters WHERE id = ?", (letter_id,))
+
+    def letters(self, error_code: str = "") -> Iterator[DeadLetter]:
+        """The dead letters oldest first, optionally only those with the error code"""
+        rows = self._conn.execute(
+            "SELECT id, step, priority, error_code, error, attempts, failed_at, payload FROM dead_letters "
+            "WHERE ? = '' OR error_code = ? ORDER BY id", (error_code, error_code)).fetchall()
+        for row in rows:
+            try:
+                item = self._decode(row[-1])
+            except Exception:
+                logging.exception(f"Skipping dead letter {row[0]} that could not be decoded")
+                continue
+            yield DeadLetter(*row[:-1], item=item)
+
+    def count(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM dead_letters").fetchone()[0]
+
+    def close(self) -> None:
+        self._conn.close()
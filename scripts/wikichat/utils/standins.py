@@ -0,0 +1,581 @@
+"""
+Local stand-ins for the external services the pipeline calls, so its throughput can be measured without the network,
+see the ingest-bench command.
+
+* wikipedia: article pages at /wiki/<title>, and a server-sent events stream of recent changes at
+  /v2/stream/recentchange that edits the articles. Pages are read from a directory of saved article HTML, and
+  generated for any other title. Each edit to an article changes one paragraph at the start of it. A listener that
+  reconnects with the Last-Event-ID header carries on after that event.
+* embeddings: the Cohere embed API at /v1/embed, the Cohere client uses it when CO_API_URL is set to the service.
+  The vectors are random but the same text always gets the same vector.
+* astra: an in memory document store that answers the Astra Data API commands astrapy sends for the calls made in
+  wikichat.database_setup, wikichat.database and the pipeline steps.
+
+Each service runs in its own process so the CPU it uses is not taken from the pipeline being measured. A service can
+wait before answering and fail a fraction of the requests, to see how the pipeline copes with a slow or unreliable
+service. The number of requests and injected errors are served at /_stand_in/stats.
+
+This module should not import other parts of the wikichat application, other than the recordings it replays.
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import socket
+import time
+import uuid
+import zlib
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Any, Iterator
+from urllib.parse import quote, unquote
+
+import numpy as np
+from aiohttp import web
+
+from wikichat.utils.recording import RecordedEvent, read_recording
+
+SERVICE_WIKIPEDIA = "wikipedia"
+SERVICE_EMBEDDINGS = "embeddings"
+SERVICE_ASTRA = "astra"
+
+CHANGES_PATH = "/v2/stream/recentchange"
+STATS_PATH = "/_stand_in/stats"
+
+# Mix of the generated recent changes, the rest are edits to english wikipedia articles
+_CANARY_FRACTION = 0.001
+_BOT_FRACTION = 0.15
+_OTHER_WIKI_FRACTION = 0.4
+# Edits to articles that were not bulk loaded
+_NEW_ARTICLE_FRACTION = 0.2
+
+# Astra returns at most this many documents per page
+_ASTRA_PAGE_SIZE = 20
+
+
+@dataclass
+class StandInOptions:
+    """How one service behaves, the options that do not apply to the service are ignored"""
+    # each request waits between half and one and a half times this
+    latency_ms: float = 0
+    # fraction of the requests that fail, with the error the real service returns when overloaded
+    error_rate: float = 0
+    seed: int = 0
+    # wikipedia: saved pages named <title>.html, and the sizes of the generated articles
+    corpus_dir: str = ""
+    article_chars: tuple[int, ...] = (2000, 10000, 50000)
+    # wikipedia: titles of the bulk loaded articles, the generated edits are mostly to these
+    titles: list[str] = field(default_factory=list)
+    # wikipedia: JSON lines file of recent change events to replay, can be gzipped or a directory recorded by the
+    # record command, empty to generate edits
+    events_file: str = ""
+    # wikipedia: 0 to send events as fast as the listener reads them
+    events_per_sec: float = 0
+    # wikipedia: close the recent changes stream after this many events, to make the listener reconnect, 0 to not
+    disconnect_every: int = 0
+    # embeddings
+    dimension: int = 1024
+
+
+def article_titles(corpus_dir: str = "", num_generated: int = 0) -> list[str]:
+    """Titles of the saved pages in the corpus directory, or of num_generated generated articles"""
+    if corpus_dir:
+        return sorted(name.removesuffix(".html") for name in os.listdir(corpus_dir) if name.endswith(".html"))
+    return [f"Bench_article_{i:05d}" for i in range(num_generated)]
+
+
+class StandIns:
+    """Starts each service in its own process, and stops them"""
+
+    def __init__(self, options: dict[str, StandInOptions], host: str = "127.0.0.1"):
+        unknown = set(options) - {SERVICE_WIKIPEDIA, SERVICE_EMBEDDINGS, SERVICE_ASTRA}
+        if unknown:
+            raise ValueError(f"Unknown stand-in services {sorted(unknown)}")
+        self.options: dict[str, StandInOptions] = options
+        self.host: str = host
+        self.urls: dict[str, str] = {}
+        self._processes: list[multiprocessing.Process] = []
+
+    def start(self, timeout_secs: float = 30) -> 'StandIns':
+        # spawned so the services do not inherit the state of this process
+        context = multiprocessing.get_context("spawn")
+        for service, options in self.options.items():
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=_serve, args=(service, options, self.host, sender), daemon=True,
+                                      name=f"stand-in-{service}")
+            process.start()
+            self._processes.append(process)
+            if not receiver.poll(timeout_secs):
+                self.stop()
+                raise RuntimeError(f"Stand-in {service} did not start within {timeout_secs} seconds")
+            self.urls[service] = f"http://{self.host}:{receiver.recv()}"
+            logging.info(f"Started stand-in {service} on {self.urls[service]}")
+        return self
+
+    def stop(self) -> None:
+        for process in self._processes:
+            process.terminate()
+        for process in self._processes:
+            process.join()
+        self._processes.clear()
+
+
+# ======================================================================================================================
+# Services, run in the stand-in processes
+# ======================================================================================================================
+
+def _serve(service: str, options: StandInOptions, host: str, sender) -> None:
+    asyncio.run(_run_service(service, options, host, sender))
+
+
+async def _run_service(service: str, options: StandInOptions, host: str, sender) -> None:
+    match service:
+        case "wikipedia":
+            handler = _WikipediaService(options)
+        case "embeddings":
+            handler = _EmbeddingService(options)
+        case _:
+            handler = _AstraService(options)
+
+    app = web.Application(client_max_size=256 * 1024 * 1024)
+    handler.add_routes(app)
+    app.router.add_get(STATS_PATH, handler.stats)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind((host, 0))
+    await web.SockSite(runner, sock).start()
+    sender.send(sock.getsockname()[1])
+    # runs until the process is terminated
+    await asyncio.Event().wait()
+
+
+class _Service:
+    """Counts the requests and injects the latency and errors"""
+
+    def __init__(self, options: StandInOptions):
+        self.options: StandInOptions = options
+        self.random = random.Random(options.seed)
+        self.requests: int = 0
+        self.errors: int = 0
+
+    def add_routes(self, app: web.Application) -> None:
+        raise NotImplementedError()
+
+    async def maybe_fail(self) -> bool:
+        """Wait for the latency of the service, returns True if this request should fail"""
+        self.requests += 1
+        if self.options.latency_ms > 0:
+            await asyncio.sleep(self.options.latency_ms * self.random.uniform(0.5, 1.5) / 1000)
+        if self.random.random() < self.options.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({"requests": self.requests, "errors": self.errors})
+
+
+class _WikipediaService(_Service):
+
+    def __init__(self, options: StandInOptions):
+        super().__init__(options)
+        self.corpus: dict[str, str] = {}
+        if options.corpus_dir:
+            for title in article_titles(options.corpus_dir):
+                with open(os.path.join(options.corpus_dir, f"{title}.html"), mode='r', encoding='utf-8') as file:
+                    self.corpus[title] = file.read()
+        # edits made to each article by the recent changes stream
+        self.revisions: dict[str, int] = {}
+        self.events_sent: int = 0
+        self.disconnects: int = 0
+
+    def add_routes(self, app: web.Application) -> None:
+        app.router.add_get("/wiki/{title}", self.article)
+        app.router.add_get(CHANGES_PATH, self.recent_changes)
+
+    async def article(self, request: web.Request) -> web.Response:
+        if await self.maybe_fail():
+            return web.Response(status=503, text="Service Unavailable (stand-in)")
+        title = unquote(request.match_info["title"])
+        return web.Response(text=self.page(title), content_type="text/html")
+
+    def page(self, title: str) -> str:
+        """The article as it is after the edits made to it so far"""
+        edited = f"<p>{_revision_text(title, self.revisions.get(title, 0))}</p>"
+        saved = self.corpus.get(title)
+        if saved is not None:
+            # the edited paragraph goes at the start of the content, saved pages without it are served unchanged
+            return _CONTENT_START.sub(lambda match: match.group(0) + edited, saved, count=1)
+
+        display_title = title.replace("_", " ")
+        return (f"<!DOCTYPE html><html><head><title>{display_title} - Wikipedia</title></head><body>"
+                f"<h1 id=\"firstHeading\">{display_title}</h1><div id=\"mw-content-text\">{edited}"
+                f"{_article_body(title, tuple(self.options.article_chars), self.options.seed)}</div></body></html>")
+
+    async def recent_changes(self, request: web.Request) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        base_url = f"{request.scheme}://{request.host}"
+        interval_secs = 1 / self.options.events_per_sec if self.options.events_per_sec > 0 else 0
+        next_send = time.monotonic()
+        # the events are the same each time the stream is read, so it carries on after the offset of the last event
+        # the listener saw, as EventStreams does
+        resume_offset = _last_event_offset(request.headers.get("Last-Event-ID", ""))
+        sent = 0
+        try:
+            for offset, event in enumerate(self._events(), start=1):
+                if offset <= resume_offset:
+                    continue
+                if interval_secs:
+                    next_send += interval_secs
+                    await asyncio.sleep(max(0.0, next_send - time.monotonic()))
+                self._edit(event, base_url)
+                self.events_sent += 1
+                event_id = json.dumps([{"topic": "stand-in.recentchange", "partition": 0, "offset": offset}])
+                await response.write(f"event: message\nid: {event_id}\ndata: {json.dumps(event)}\n\n".encode("utf-8"))
+                sent += 1
+                if self.options.disconnect_every and sent >= self.options.disconnect_every:
+                    self.disconnects += 1
+                    break
+        except ConnectionResetError:
+            # the listener has stopped
+            pass
+        return response
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({"requests": self.requests, "errors": self.errors, "events": self.events_sent,
+                                  "disconnects": self.disconnects,
+                                  "edited_articles": len(self.revisions)})
+
+    def _events(self) -> Iterator[dict[str, Any]]:
+        if self.options.events_file:
+            # the recording is replayed again from the start when it runs out
+            while True:
+                for recorded in read_recording(self.options.events_file):
+                    event = _recorded_event(recorded)
+                    if event is not None:
+                        yield event
+        else:
+            yield from self._generated_events()
+
+    def _generated_events(self) -> Iterator[dict[str, Any]]:
+        rand = random.Random(self.options.seed)
+        titles = self.options.titles or ["Bench_article_00000"]
+        new_articles = 0
+        while True:
+            draw = rand.random()
+            if draw < _CANARY_FRACTION:
+                event = _change_event("canary", "", "Canary", bot=False)
+                event["meta"]["domain"] = "canary"
+            elif draw < _CANARY_FRACTION + _BOT_FRACTION:
+                event = _change_event("enwiki", "https://en.wikipedia.org", rand.choice(titles), bot=True)
+            elif draw < _CANARY_FRACTION + _BOT_FRACTION + _OTHER_WIKI_FRACTION:
+                event = _change_event("dewiki", "https://de.wikipedia.org", rand.choice(titles), bot=False)
+            elif rand.random() < _NEW_ARTICLE_FRACTION:
+                new_articles += 1
+                event = _change_event("enwiki", "https://en.wikipedia.org", f"Bench_new_article_{new_articles:05d}",
+                                      bot=False)
+            else:
+                event = _change_event("enwiki", "https://en.wikipedia.org", rand.choice(titles), bot=False)
+            # the same id each time the stream is read, so the listener can tell when it is sent an event again
+            event["meta"]["id"] = str(uuid.UUID(int=rand.getrandbits(128), version=4))
+            yield event
+
+    def _edit(self, event: dict[str, Any], base_url: str) -> None:
+        """Apply an edit to an english wikipedia article, and point the event at the article on this server"""
+        match event:
+            case {"wiki": "enwiki", "namespace": 0, "type": "edit", "bot": False, "title_url": str(title_url)}:
+                title = unquote(title_url.rsplit("/wiki/", 1)[-1])
+                self.revisions[title] = self.revisions.get(title, 0) + 1
+                event["title_url"] = f"{base_url}/wiki/{quote(title)}"
+
+
+def _last_event_offset(last_event_id: str) -> int:
+    """The offset in the Last-Event-ID header the listener sends when it reconnects, 0 if there is not one"""
+    try:
+        return max(int(position.get("offset", 0)) for position in json.loads(last_event_id))
+    except (ValueError, TypeError, AttributeError):
+        return 0
+
+
+def _recorded_event(recorded: RecordedEvent) -> dict[str, Any] | None:
+    """The recent change event sent in a recorded server-sent event, None if it is not one"""
+    if recorded.type != "message":
+        return None
+    try:
+        return json.loads(recorded.data)
+    except ValueError:
+        return None
+
+
+class _EmbeddingService(_Service):
+
+    def add_routes(self, app: web.Application) -> None:
+        app.router.add_post("/v1/embed", self.embed)
+
+    async def embed(self, request: web.Request) -> web.Response:
+        if await self.maybe_fail():
+            return web.json_response({"message": "You are using a Trial key, which is limited (stand-in)"},
+                                     status=429)
+        body = await request.json()
+        texts: list[str] = body.get("texts") or []
+        return web.json_response({
+            "id": str(uuid.uuid4()),
+            "texts": texts,
+            "embeddings": [_text_vector(text, self.options.dimension).tolist() for text in texts],
+            "meta": {"api_version": {"version": "1"}, "billed_units": {"input_tokens": len(texts)}}
+        })
+
+
+class _AstraService(_Service):
+    """The collections are dicts of documents by _id, only the filters and options the application uses work"""
+
+    def __init__(self, options: StandInOptions):
+        super().__init__(options)
+        self.collections: dict[str, dict[str, dict[str, Any]]] = {}
+        self.collection_options: dict[str, dict[str, Any]] = {}
+
+    def add_routes(self, app: web.Application) -> None:
+        app.router.add_post("/api/json/v1/{keyspace}", self.command)
+        app.router.add_post("/api/json/v1/{keyspace}/{collection}", self.command)
+
+    async def command(self, request: web.Request) -> web.Response:
+        collection_name = request.match_info.get("collection")
+        # creating the collections before the benchmark starts does not fail
+        if collection_name is not None and await self.maybe_fail():
+            return web.json_response(_errors("Failed to update documents: Unable to complete transaction due to "
+                                             "concurrent transactions (stand-in)", "CONCURRENCY_FAILURE"))
+        body: dict[str, Any] = await request.json()
+        name, params = next(iter(body.items()))
+        try:
+            if collection_name is None:
+                return web.json_response(self._database_command(name, params or {}))
+            collection = self.collections.get(collection_name)
+            if collection is None:
+                return web.json_response(_errors(f"Collection does not exist, collection name: {collection_name}",
+                                                 "COLLECTION_NOT_EXIST"))
+            return web.json_response(_collection_command(collection, name, params or {}))
+        except _UnsupportedCommand as e:
+            return web.json_response(_errors(str(e), "UNSUPPORTED_BY_STAND_IN"))
+
+    def _database_command(self, name: str, params: dict[str, Any]) -> dict[str, Any]:
+        match name:
+            case "findCollections":
+                if params.get("options", {}).get("explain") in (True, "true"):
+                    return {"status": {"collections": [{"name": name, "options": options}
+                                                       for name, options in self.collection_options.items()]}}
+                return {"status": {"collections": list(self.collections)}}
+            case "createCollection":
+                self.collections.setdefault(params["name"], {})
+                self.collection_options[params["name"]] = params.get("options", {})
+                return {"status": {"ok": 1}}
+            case "deleteCollection":
+                self.collections.pop(params["name"], None)
+                self.collection_options.pop(params["name"], None)
+                return {"status": {"ok": 1}}
+        raise _UnsupportedCommand(f"Database command {name} is not supported")
+
+
+class _UnsupportedCommand(Exception):
+    pass
+
+
+def _collection_command(collection: dict[str, dict[str, Any]], name: str, params: dict[str, Any]) -> dict[str, Any]:
+    filter_ = params.get("filter") or {}
+    options = params.get("options") or {}
+    match name:
+        case "findOne":
+            docs = _find(collection, filter_, params.get("sort"))
+            return {"data": {"document": _project(docs[0], params.get("projection")) if docs else None}}
+        case "find":
+            docs = _find(collection, filter_, params.get("sort"))
+            if options.get("limit"):
+                docs = docs[:options["limit"]]
+            start = int(options.get("pagingState") or 0)
+            page = docs[start:start + _ASTRA_PAGE_SIZE]
+            if params.get("sort") and options.get("includeSimilarity"):
+                page = [{**doc, "$similarity": similarity} for doc, similarity in
+                        zip(page, _similarities(page, params["sort"]["$vector"]))]
+            return {"data": {
+                "documents": [_project(doc, params.get("projection")) for doc in page],
+                "nextPageState": str(start + _ASTRA_PAGE_SIZE) if start + _ASTRA_PAGE_SIZE < len(docs) else None
+            }}
+        case "insertOne" | "insertMany":
+            documents = [params["document"]] if name == "insertOne" else params.get("documents", [])
+            inserted, errors = [], []
+            for doc in documents:
+                doc_id = doc.setdefault("_id", str(uuid.uuid4()))
+                if doc_id in collection:
+                    errors.append({"message": f"Failed to insert document with _id '{doc_id}': Document already "
+                                              f"exists with the given _id",
+                                   "errorCode": "DOCUMENT_ALREADY_EXISTS"})
+                    continue
+                collection[doc_id] = doc
+                inserted.append(doc_id)
+            return {"status": {"insertedIds": inserted}, **({"errors": errors} if errors else {})}
+        case "deleteMany":
+            deleted = [doc["_id"] for doc in _find(collection, filter_, None)]
+            for doc_id in deleted:
+                del collection[doc_id]
+            return {"status": {"deletedCount": len(deleted)}}
+        case "findOneAndReplace":
+            docs = _find(collection, filter_, params.get("sort"))
+            replacement = dict(params["replacement"])
+            if docs:
+                replacement["_id"] = docs[0]["_id"]
+                collection[replacement["_id"]] = replacement
+                return {"data": {"document": docs[0]}, "status": {"matchedCount": 1, "modifiedCount": 1}}
+            if not options.get("upsert"):
+                return {"data": {"document": None}, "status": {"matchedCount": 0, "modifiedCount": 0}}
+            replacement.setdefault("_id", filter_.get("_id") or str(uuid.uuid4()))
+            collection[replacement["_id"]] = replacement
+            return {"data": {"document": None},
+                    "status": {"matchedCount": 0, "modifiedCount": 0, "upsertedId": replacement["_id"]}}
+    raise _UnsupportedCommand(f"Collection command {name} is not supported")
+
+
+def _find(collection: dict[str, dict[str, Any]], filter_: dict[str, Any],
+          sort: dict[str, Any] | None) -> list[dict[str, Any]]:
+    # the pipeline looks documents up by _id, so that does not scan the collection
+    match filter_:
+        case {"_id": {"$in": list(ids)}} if len(filter_) == 1:
+            docs = [collection[doc_id] for doc_id in ids if doc_id in collection]
+        case {"_id": str(doc_id)} if len(filter_) == 1:
+            docs = [collection[doc_id]] if doc_id in collection else []
+        case _:
+            docs = [doc for doc in collection.values() if _matches(doc, filter_)]
+
+    if sort:
+        if set(sort) != {"$vector"}:
+            raise _UnsupportedCommand(f"Sort {list(sort)} is not supported, only $vector")
+        docs = [doc for doc in docs if "$vector" in doc]
+        similarities = _similarities(docs, sort["$vector"])
+        docs = [docs[i] for i in np.argsort(-similarities, kind="stable")]
+    return docs
+
+
+def _matches(doc: dict[str, Any], filter_: dict[str, Any]) -> bool:
+    for key, condition in filter_.items():
+        match condition:
+            case {"$in": list(values)}:
+                if doc.get(key) not in values:
+                    return False
+            case {"$eq": value}:
+                if doc.get(key) != value:
+                    return False
+            case {"$ne": value}:
+                if doc.get(key) == value:
+                    return False
+            case dict():
+                raise _UnsupportedCommand(f"Filter {condition} on {key} is not supported")
+            case _:
+                if doc.get(key) != condition:
+                    return False
+    return True
+
+
+def _project(doc: dict[str, Any], projection: dict[str, Any] | None) -> dict[str, Any]:
+    if not projection:
+        return doc
+    included = {key for key, value in projection.items() if value}
+    if projection.get("_id", 1):
+        included.add("_id")
+    # the similarity is only in the results when asked for, not with the projection
+    included.add("$similarity")
+    return {key: value for key, value in doc.items() if key in included}
+
+
+def _similarities(docs: list[dict[str, Any]], vector: list[float]) -> np.ndarray:
+    """Cosine similarity scaled to 0 to 1, as Astra does"""
+    if not docs:
+        return np.zeros(0, dtype=np.float32)
+    matrix = np.asarray([doc["$vector"] for doc in docs], dtype=np.float32)
+    query = np.asarray(vector, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query)
+    cosine = matrix @ query / np.where(norms > 0, norms, 1)
+    return (cosine + 1) / 2
+
+
+def _errors(message: str, code: str) -> dict[str, Any]:
+    return {"errors": [{"message": message, "errorCode": code}]}
+
+
+# ======================================================================================================================
+# Generated content
+# ======================================================================================================================
+
+_CONTENT_START = re.compile(r'<[^>]*\bid="mw-content-text"[^>]*>')
+
+
+def _change_event(wiki: str, server_url: str, title: str, bot: bool) -> dict[str, Any]:
+    """Recent change event with the fields the listener uses, see listen_for_changes"""
+    now = datetime.now(timezone.utc)
+    return {
+        "meta": {"id": str(uuid.uuid4()), "dt": now.isoformat(), "domain": server_url.removeprefix("https://"),
+                 "stream": "mediawiki.recentchange"},
+        "type": "edit",
+        "namespace": 0,
+        "title": title.replace("_", " "),
+        "title_url": f"{server_url}/wiki/{quote(title)}",
+        "timestamp": int(now.timestamp()),
+        "bot": bot,
+        "wiki": wiki,
+    }
+
+
+@lru_cache(maxsize=4)
+def _vocabulary(seed: int) -> list[str]:
+    rand = random.Random(seed)
+    return ["".join(rand.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rand.randint(1, 12)))
+            for _ in range(5000)]
+
+
+def _words(rand: random.Random, vocab: list[str], num_chars: int) -> str:
+    # a few words are much more common than the rest, as in real text
+    words = rand.choices(vocab, cum_weights=_zipf_weights(len(vocab)), k=max(1, num_chars // 6))
+    return " ".join(words)[:num_chars]
+
+
+@lru_cache(maxsize=4)
+def _zipf_weights(size: int) -> list[float]:
+    return np.cumsum(1 / np.arange(1, size + 1)).tolist()
+
+
+@lru_cache(maxsize=10000)
+def _article_body(title: str, article_chars: tuple[int, ...], vocab_seed: int) -> str:
+    """Sections of paragraphs with citations and images, about the size picked for the title"""
+    vocab = _vocabulary(vocab_seed)
+    seed = zlib.crc32(title.encode("utf-8"))
+    rand = random.Random(seed)
+    num_chars = article_chars[seed % len(article_chars)]
+    parts: list[str] = []
+    length = 0
+    while length < num_chars:
+        if rand.random() < 0.15:
+            parts.append(f"<h2>{_words(rand, vocab, rand.randint(10, 30)).capitalize()}</h2>")
+        if rand.random() < 0.05:
+            parts.append(f"<img src=\"/static/{seed}.png\" alt=\"{_words(rand, vocab, 20)}\">")
+        text = _words(rand, vocab, rand.randint(200, 900))
+        length += len(text)
+        parts.append(f"<p>{text.capitalize()}<sup class=\"reference\">[{len(parts)}]</sup>.</p>")
+    return "".join(parts)
+
+
+def _revision_text(title: str, revision: int) -> str:
+    """The paragraph changed by each edit, the words are the same lengths in every revision so an edit only changes
+    the chunks with this paragraph in them, and not where the rest of the article is split"""
+    lengths = random.Random(zlib.crc32(title.encode("utf-8"))).choices(range(2, 10), k=60)
+    rand = random.Random(f"{title} {revision}")
+    return " ".join("".join(rand.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(length)) for length in lengths)
+
+
+@lru_cache(maxsize=100000)
+def _text_vector(text: str, dimension: int) -> np.ndarray:
+    vector = np.random.default_rng(zlib.crc32(text.encode("utf-8"))).standard_normal(dimension, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
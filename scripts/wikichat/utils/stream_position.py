@@ -0,0 +1,101 @@
+"""
+The position of the listener in a server-sent events stream, so after it reconnects, or the process restarts, it
+carries on from the last event it processed rather than from whatever the stream is sending now.
+
+The position is the id of the last event, sent in the Last-Event-ID header when connecting. Wikimedia EventStreams
+uses the Kafka topic, partition and offset of the event as its id, see
+https://wikitech.wikimedia.org/wiki/Event_Platform/EventStreams#Historical_Consumption . For streams that do not send
+ids the time of the last event is sent as the since parameter instead. Resuming can send some events again, so the
+keys of the recent events are kept and events with the same key are skipped.
+
+The position, and the keys of the most recent events, are saved to a JSON file at most every save_interval_secs and
+when it is closed.
+
+This module should not import other parts of the wikichat application.
+"""
+import json
+import logging
+import os
+import time
+from collections import deque
+from urllib.parse import urlencode
+
+LAST_EVENT_ID_HEADER = "Last-Event-ID"
+
+
+class StreamPosition:
+    """The last event processed from the stream, and the keys of the recent events to skip if they are sent again"""
+
+    def __init__(self, file: str = "", max_recent_keys: int = 10_000, max_saved_keys: int = 1000,
+                 save_interval_secs: float = 1.0):
+        self.file: str = file
+        self.max_saved_keys: int = max_saved_keys
+        self.save_interval_secs: float = save_interval_secs
+        self.last_event_id: str = ""
+        # ISO 8601 time of the last event
+        self.last_event_dt: str = ""
+        self._recent_keys: deque[str] = deque(maxlen=max_recent_keys)
+        self._recent_key_set: set[str] = set()
+        self._last_saved: float = 0.0
+        self._dirty: bool = False
+        if file and os.path.exists(file):
+            self._load()
+
+    @property
+    def has_position(self) -> bool:
+        return bool(self.last_event_id or self.last_event_dt)
+
+    def is_duplicate(self, event_key: str | None) -> bool:
+        return event_key is not None and event_key in self._recent_key_set
+
+    def update(self, event_id: str, event_dt: str | None, event_key: str | None) -> None:
+        """Called after the event has been processed"""
+        if event_id:
+            self.last_event_id = event_id
+        if event_dt:
+            self.last_event_dt = event_dt
+        if event_key is not None:
+            if len(self._recent_keys) == self._recent_keys.maxlen:
+                self._recent_key_set.discard(self._recent_keys[0])
+            self._recent_keys.append(event_key)
+            self._recent_key_set.add(event_key)
+        self._dirty = True
+        if self.file and time.monotonic() - self._last_saved >= self.save_interval_secs:
+            self.save()
+
+    def resume_request(self, url: str) -> tuple[str, dict[str, str]]:
+        """The url and headers to connect to the stream with, to resume from this position"""
+        if self.last_event_id:
+            return url, {LAST_EVENT_ID_HEADER: self.last_event_id}
+        if self.last_event_dt:
+            return f"{url}{'&' if '?' in url else '?'}{urlencode({'since': self.last_event_dt})}", {}
+        return url, {}
+
+    def save(self) -> None:
+        if not self.file or not self._dirty:
+            return
+        # written to a new file and renamed, so a crash while saving leaves the last position
+        tmp_file = f"{self.file}.tmp"
+        with open(tmp_file, mode='w') as file:
+            json.dump({
+                "last_event_id": self.last_event_id,
+                "last_event_dt": self.last_event_dt,
+                "recent_keys": list(self._recent_keys)[-self.max_saved_keys:]
+            }, file)
+        os.replace(tmp_file, self.file)
+        self._last_saved = time.monotonic()
+        self._dirty = False
+
+    def close(self) -> None:
+        self.save()
+
+    def _load(self) -> None:
+        with open(self.file, mode='r') as file:
+            doc = json.load(file)
+        self.last_event_id = doc.get("last_event_id", "")
+        self.last_event_dt = doc.get("last_event_dt", "")
+        for key in doc.get("recent_keys", []):
+            self._recent_keys.append(key)
+        self._recent_key_set = set(self._recent_keys)
+        logging.info(f"Loaded stream position from {self.file}, last event id={self.last_event_id or '-'} "
+                     f"time={self.last_event_dt or '-'}")
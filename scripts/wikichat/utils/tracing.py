@@ -0,0 +1,179 @@
+"""
+Sampled tracing of items through the pipeline, written as spans to a local file for the trace-report command.
+
+When an item is put into the pipeline a trace is started for a sample of them. The trace is carried with the item
+through the queues of the steps on :class:`wikichat.utils.pipeline.QueuedItem`, and each worker sets it in
+:data:`TRACE_CONTEXT_VAR` while it processes the item, in the same way as the worker name. The worker records a span
+for the time the item waited in the queue of the step and a span for processing it, and the calls to external
+services made while processing are recorded as spans inside that, see :meth:`Tracer.span`. When the item leaves the
+pipeline a span for the whole trace is recorded.
+
+Spans are written to a JSON lines file, one span per line::
+
+    {"trace_id": "...", "span_id": "...", "parent_id": "...", "name": "chunk_article", "kind": "step",
+     "start": 1700000000.123, "duration_secs": 0.042, "attributes": {}}
+
+The start is the wall clock time in seconds. Nothing is recorded for items that are not sampled, so tracing costs a
+context variable lookup for them.
+
+This module should not import other parts of the wikichat application.
+"""
+import contextvars
+import json
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field, asdict
+from typing import Any, Iterator, TextIO
+
+SPAN_KIND_TRACE = "trace"
+SPAN_KIND_QUEUE = "queue"
+SPAN_KIND_STEP = "step"
+SPAN_KIND_CLIENT = "client"
+
+
+@dataclass
+class TraceContext:
+    """A sampled trace, carried with the item through the pipeline"""
+    trace_id: str
+    name: str
+    # wall clock time the trace started
+    started_at: float = field(default_factory=time.time)
+    attributes: dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def root_span_id(self) -> str:
+        return self.trace_id
+
+
+@dataclass
+class SpanContext:
+    """The span that spans started now are inside of"""
+    trace: TraceContext
+    span_id: str
+
+
+@dataclass
+class Span:
+    trace_id: str
+    span_id: str
+    parent_id: str
+    name: str
+    kind: str
+    start: float
+    duration_secs: float
+    attributes: dict[str, Any] = field(default_factory=dict)
+
+
+# the span the current worker is in, None when the item it is processing is not traced
+TRACE_CONTEXT_VAR: contextvars.ContextVar[SpanContext | None] = contextvars.ContextVar('trace_context', default=None)
+
+
+def _new_id() -> str:
+    return os.urandom(8).hex()
+
+
+class Tracer:
+    """Samples the traces and writes their spans, disabled until configured with a file"""
+
+    def __init__(self):
+        self.path: str = ""
+        self.sample_rate: float = 0.0
+        self._file: TextIO | None = None
+
+    def configure(self, path: str = "", sample_rate: float = 0.01) -> 'Tracer':
+        """Write spans for sample_rate of the items to the file at path, appending to it. Empty path to disable."""
+        if not 0 <= sample_rate <= 1:
+            raise ValueError(f"sample_rate {sample_rate} must be between 0 and 1")
+        self.close()
+        self.path = path
+        self.sample_rate = sample_rate
+        if path:
+            self._file = open(path, mode='a', encoding='utf-8')
+            logging.info(f"Tracing {sample_rate:.2%} of the items to {path}")
+        return self
+
+    @property
+    def enabled(self) -> bool:
+        return self._file is not None and self.sample_rate > 0
+
+    def start_trace(self, name: str, **attributes) -> TraceContext | None:
+        """Start a trace if this item is sampled, returns None if it is not"""
+        if not self.enabled or random.random() >= self.sample_rate:
+            return None
+        return TraceContext(trace_id=_new_id(), name=name, attributes=attributes)
+
+    def end_trace(self, trace: TraceContext, **attributes) -> None:
+        """Record the span for the whole trace, from when it started until now"""
+        self._write(Span(trace_id=trace.trace_id, span_id=trace.root_span_id, parent_id="", name=trace.name,
+                         kind=SPAN_KIND_TRACE, start=trace.started_at, duration_secs=time.time() - trace.started_at,
+                         attributes={**trace.attributes, **attributes}))
+        self._file.flush()
+
+    def record(self, trace: TraceContext, name: str, kind: str, start: float, duration_secs: float,
+               parent_id: str = None, **attributes) -> str:
+        """Record a span that has already finished, returns its id. The parent is the root span by default."""
+        span_id = _new_id()
+        self._write(Span(trace_id=trace.trace_id, span_id=span_id,
+                         parent_id=trace.root_span_id if parent_id is None else parent_id, name=name, kind=kind,
+                         start=start, duration_secs=duration_secs, attributes=attributes))
+        return span_id
+
+    @contextmanager
+    def span(self, name: str, kind: str = SPAN_KIND_CLIENT, **attributes) -> Iterator[None]:
+        """Record a span around the block, inside the current span. Does nothing if the item is not traced."""
+        parent = TRACE_CONTEXT_VAR.get()
+        if parent is None or not self.enabled:
+            yield
+            return
+
+        span_id = _new_id()
+        token = TRACE_CONTEXT_VAR.set(SpanContext(parent.trace, span_id))
+        start = time.time()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            TRACE_CONTEXT_VAR.reset(token)
+            if error:
+                attributes["error"] = error
+            self._write(Span(trace_id=parent.trace.trace_id, span_id=span_id, parent_id=parent.span_id, name=name,
+                             kind=kind, start=start, duration_secs=time.time() - start, attributes=attributes))
+
+    @contextmanager
+    def detached(self) -> Iterator[None]:
+        """Run the block outside of any trace, for work shared by several items such as a batch of embeddings"""
+        token = TRACE_CONTEXT_VAR.set(None)
+        try:
+            yield
+        finally:
+            TRACE_CONTEXT_VAR.reset(token)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write(self, span: Span) -> None:
+        if self._file is not None:
+            self._file.write(json.dumps(asdict(span)) + "\n")
+
+
+def read_spans(path: str) -> Iterator[Span]:
+    """Spans from a file written by the Tracer, lines that cannot be read, such as a partly written last line, are
+    skipped"""
+    with open(path, mode='r', encoding='utf-8') as file:
+        for line_num, line in enumerate(file, start=1):
+            try:
+                yield Span(**json.loads(line))
+            except (ValueError, TypeError):
+                logging.warning(f"Skipping line {line_num} of {path} that is not a span")
+
+
+# Configured by wikichat.processing.create_pipeline
+TRACER = Tracer()